@@ -0,0 +1,288 @@
+# archive_upload.py
+import stat
+import time
+import queue
+import shlex
+import tarfile
+import zipfile
+import tempfile
+import posixpath
+import zstandard
+from helpers import SSHClient, logger
+from progress import PROGRESS
+
+ARCHIVE_QUEUE_CHUNKS = 16  # Request body chunks buffered between the upload and the extractor
+ARCHIVE_COPY_BYTES = 64 * 1024
+ARCHIVE_PROGRESS_INTERVAL = 0.25
+ARCHIVE_MAX_SKIPPED = 100  # Skipped entries listed in the result
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+ZIP_MAGICS = (b"PK\x03\x04", b"PK\x05\x06")
+
+class ArchiveStream:
+    """
+    Blocking, read-only file object over request body chunks pushed from the event loop.
+    At most ARCHIVE_QUEUE_CHUNKS chunks are held, so a slow extractor throttles the upload.
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue(maxsize=ARCHIVE_QUEUE_CHUNKS)
+        self._buf = bytearray()
+        self._pos = 0
+        self._eof = False
+        self.abandoned = False
+        self.consumed = 0
+
+    # === Producer side ===
+    def feed(self, chunk):
+        """Queue a chunk, None marks the end. Returns False once the reader has given up."""
+        while not self.abandoned:
+            try:
+                self._queue.put(chunk, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    # === Reader side ===
+    def read(self, n=-1):
+        while not self._eof and (n < 0 or len(self._buf) - self._pos < n):
+            chunk = self._queue.get()
+            if chunk is None:
+                self._eof = True
+                break
+            del self._buf[:self._pos]
+            self._pos = 0
+            self._buf += chunk
+        end = len(self._buf) if n < 0 else self._pos + n
+        data = bytes(self._buf[self._pos:end])
+        self._pos += len(data)
+        self.consumed += len(data)
+        return data
+
+    def peek(self, n):
+        data = self.read(n)
+        self._pos -= len(data)
+        self.consumed -= len(data)
+        return data
+
+    def abandon(self):
+        # Unblock the producer, let go of anything still queued and wake a waiting reader with EOF
+        self.abandoned = True
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                break
+        self._queue.put_nowait(None)
+
+class HostTarWriter:
+    """
+    Write-only file object feeding `tar -x` on the host over one SSH channel.
+    """
+
+    def __init__(self, ssh, dest: str):
+        dest = shlex.quote(dest)
+        self.channel = ssh.client.get_transport().open_session()
+        self.channel.exec_command(f"mkdir -p -- {dest} && exec tar -x -C {dest} --no-same-owner -f -")
+        self.stderr = b""
+
+    def write(self, data):
+        self.channel.sendall(data)
+        self._drain()
+        return len(data)
+
+    def _drain(self):
+        while self.channel.recv_stderr_ready():
+            self.stderr = (self.stderr + self.channel.recv_stderr(65536))[-65536:]
+
+    def abort(self):
+        self.channel.close()
+
+    def close(self):
+        self.channel.shutdown_write()
+        code = self.channel.recv_exit_status()
+        self._drain()
+        self.channel.close()
+        if code != 0:
+            raise RuntimeError(self.stderr.decode(errors="replace").strip() or f"tar exited with code {code}")
+
+def detect_format(stream: ArchiveStream) -> str:
+    head = stream.peek(4)
+    if head == ZSTD_MAGIC:
+        return "tar.zst"
+    if head in ZIP_MAGICS:
+        return "zip"
+    return "tar"  # tarfile detects gzip, bzip2 and xz on its own
+
+def safe_entry_name(name: str, links: set):
+    """
+    Normalize an archive entry name to a path relative to the extraction directory.
+    Returns (name, None) or (None, reason) for entries that would land outside of it.
+    """
+    normalized = posixpath.normpath(name.replace("\\", "/"))
+    if name.startswith("/") or normalized == ".." or normalized.startswith("../"):
+        return None, "path escapes the target directory"
+    if normalized in ("", "."):
+        return None, "empty path"
+    # A symlink from this archive must not be used as a directory to write through
+    parent = posixpath.dirname(normalized)
+    while parent:
+        if parent in links:
+            return None, f"path goes through symlink {parent}"
+        parent = posixpath.dirname(parent)
+    return normalized, None
+
+def safe_link_target(name: str, target: str, links: set, traversed: set):
+    """
+    Check the target of symlink `name`, returns None or the reason to skip it.
+    The target is followed component by component from the link's directory. It must stay inside
+    the extraction directory and must not pass through another symlink of this archive, which
+    would lead somewhere else on disk than the path suggests. `traversed` collects the directories
+    accepted targets pass through, a later symlink must not take the place of one of them.
+    """
+    if target.startswith("/"):
+        return "absolute link target"
+    if name in traversed:
+        return "symlink replaces a directory another link goes through"
+    parts = [part for part in posixpath.dirname(name).split("/") if part]
+    components = [c for c in target.split("/") if c not in ("", ".")]
+    through = []
+    for i, component in enumerate(components):
+        if component == "..":
+            if not parts:
+                return "link target escapes the target directory"
+            parts.pop()
+            continue
+        parts.append(component)
+        path = "/".join(parts)
+        if i < len(components) - 1:
+            if path in links:
+                return f"link target goes through symlink {path}"
+            through.append(path)
+    traversed.update(through)
+    return None
+
+def zip_members(zf: zipfile.ZipFile):
+    """Yield (TarInfo, fileobj or None) for every zip entry."""
+    for info in zf.infolist():
+        mode = info.external_attr >> 16
+        member = tarfile.TarInfo(info.filename)
+        member.mtime = time.mktime(info.date_time + (0, 0, -1))
+        if info.is_dir():
+            member.type = tarfile.DIRTYPE
+            member.mode = stat.S_IMODE(mode) or 0o755
+            yield member, None
+        elif stat.S_ISLNK(mode):
+            member.type = tarfile.SYMTYPE
+            member.linkname = zf.read(info).decode("utf-8", "surrogateescape")
+            yield member, None
+        else:
+            member.size = info.file_size
+            member.mode = stat.S_IMODE(mode) or 0o644
+            with zf.open(info) as f:
+                yield member, f
+
+def tar_members(tar: tarfile.TarFile):
+    for member in tar:
+        yield member, tar.extractfile(member) if member.isreg() else None
+
+def extract_archive(stream: ArchiveStream, dest: str, archive_format: str = "auto", progress_key: str = None):
+    """
+    Extract an archive read from `stream` into `dest` on the host.
+
+    Entries are validated and re-emitted as a plain tar stream into `tar -x` over SSH, so nothing is
+    written outside `dest` and only one chunk per entry is held in memory. Tar formats are extracted
+    while the upload arrives; zip needs its central directory and is spooled to disk first.
+    """
+    if archive_format == "auto":
+        archive_format = detect_format(stream)
+
+    entries = 0
+    skipped = []
+    links = set()
+    traversed = set()  # Directories the accepted symlinks resolve through
+    emitted = set()
+    last_report = 0.0
+    spool = None
+    source = None
+
+    def report(force=False):
+        nonlocal last_report
+        now = time.time()
+        if progress_key and (force or now - last_report >= ARCHIVE_PROGRESS_INTERVAL):
+            last_report = now
+            if archive_format == "zip":
+                PROGRESS.update(progress_key, done=entries, entries=entries)
+            else:
+                PROGRESS.update(progress_key, done=stream.consumed, entries=entries)
+
+    try:
+        if archive_format == "zip":
+            spool = tempfile.TemporaryFile()
+            while chunk := stream.read(ARCHIVE_COPY_BYTES):
+                spool.write(chunk)
+                if progress_key:
+                    PROGRESS.update(progress_key, done=stream.consumed)
+            source = zipfile.ZipFile(spool)
+            if progress_key:
+                PROGRESS.phase(progress_key, "extracting", total=len(source.infolist()))
+            members = zip_members(source)
+        elif archive_format == "tar.zst":
+            source = tarfile.open(fileobj=zstandard.ZstdDecompressor().stream_reader(stream, read_across_frames=True), mode="r|")
+            members = tar_members(source)
+        else:
+            source = tarfile.open(fileobj=stream, mode="r|*")
+            members = tar_members(source)
+
+        with SSHClient() as ssh:
+            writer = HostTarWriter(ssh, dest)
+            try:
+                with tarfile.open(fileobj=writer, mode="w|", format=tarfile.PAX_FORMAT) as out:
+                    for member, fileobj in members:
+                        if posixpath.normpath(member.name) == ".":
+                            continue  # The target directory itself
+                        name, reason = safe_entry_name(member.name, links)
+                        if reason is None and member.issym():
+                            reason = safe_link_target(name, member.linkname, links, traversed)
+                        elif reason is None and member.islnk():
+                            target, reason = safe_entry_name(member.linkname, links)
+                            if reason is None and target not in emitted:
+                                reason = "hard link to an entry not in the archive"
+                        elif reason is None and not (member.isreg() or member.isdir()):
+                            reason = "unsupported entry type"
+                        if reason:
+                            if len(skipped) < ARCHIVE_MAX_SKIPPED:
+                                skipped.append({"path": member.name, "reason": reason})
+                            continue
+
+                        entry = tarfile.TarInfo(name)
+                        entry.type = member.type if member.type != tarfile.AREGTYPE else tarfile.REGTYPE
+                        entry.mode = member.mode & 0o777  # No setuid/setgid from uploads
+                        entry.mtime = member.mtime
+                        if member.issym():
+                            entry.linkname = member.linkname
+                            links.add(name)
+                        elif member.islnk():
+                            entry.linkname = target
+                        elif member.isreg():
+                            entry.size = member.size
+                        out.addfile(entry, fileobj)
+                        emitted.add(name)
+                        entries += 1
+                        report()
+            except BaseException:
+                writer.abort()
+                raise
+            writer.close()
+    except (tarfile.TarError, zipfile.BadZipFile, zstandard.ZstdError) as e:
+        raise ValueError(f"Invalid {archive_format} archive: {e}")
+    finally:
+        stream.abandon()
+        if source is not None:
+            source.close()
+        if spool is not None:
+            spool.close()
+
+    report(force=True)
+    logger.info(f"Extracted {entries} entries into {dest}, skipped {len(skipped)}")
+    return {"entries": entries, "bytes": stream.consumed, "skipped": skipped}
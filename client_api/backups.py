@@ -0,0 +1,211 @@
+# backups.py
+import os
+import re
+import json
+import time
+import shutil
+import threading
+from pathlib import Path
+from fastapi import HTTPException
+from helpers import DEVICE_DIR, BACKUP_DIR, CURRENT_DIR, logger
+
+BACKUP_SETTINGS_FILE = Path(f"{DEVICE_DIR}/backup.json")
+DEFAULT_RETAIN = 3  # Snapshots kept, 0 turns snapshots off
+MAX_RETAIN = 20
+SNAPSHOT_META = ".snapshot.json"
+PARTIAL_SUFFIX = ".partial"
+UNSAFE_NAME_CHARS = re.compile(r"[^\w.-]")
+
+class SnapshotStore:
+    """
+    Versioned snapshots of the installed software in BACKUP_DIR, one directory each.
+
+    A file whose size, mtime and mode match the newest snapshot is hard linked to it instead of
+    copied, so every snapshot looks complete while unchanged files (usually the image tarballs)
+    are stored once. Taking one costs a stat per file plus the bytes that actually changed.
+    """
+
+    def __init__(self, root=BACKUP_DIR, settings_file=BACKUP_SETTINGS_FILE):
+        self.root = root
+        self.settings_file = settings_file
+        self._lock = threading.Lock()
+
+    # === Settings ===
+    def _settings(self):
+        try:
+            with open(self.settings_file, "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.warning(f"Warning: could not read backup settings: {e}")
+            return {}
+
+    @property
+    def retain(self):
+        return self._settings().get("retain", DEFAULT_RETAIN)
+
+    def set_retain(self, retain: int):
+        with self._lock:
+            tmp = self.settings_file.with_suffix(".tmp")
+            with open(tmp, "w") as f:
+                json.dump({**self._settings(), "retain": retain}, f)
+            os.replace(tmp, self.settings_file)
+            self._prune(retain)
+
+    # === Snapshots ===
+    def list(self):
+        """Complete snapshots, newest first."""
+        snapshots = []
+        for path in self.root.iterdir():
+            try:
+                with open(path / SNAPSHOT_META, "r") as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue  # Unfinished snapshot or something that is not one
+        return sorted(snapshots, key=lambda meta: meta["created"], reverse=True)
+
+    def path(self, name: str) -> Path:
+        path = self.root / name
+        if "/" in name or name.startswith(".") or not (path / SNAPSHOT_META).exists():
+            raise HTTPException(status_code=404, detail=f"Snapshot {name} not found")
+        return path
+
+    def create(self, source: Path = CURRENT_DIR, check_cancel=None):
+        """Snapshot `source`, drop the snapshots beyond the retained count and return the new one."""
+        with self._lock:
+            version = _read_version(source) or "unknown"
+            created = time.time()
+            stamp = f"{time.strftime('%Y%m%d-%H%M%S', time.localtime(created))}-{UNSAFE_NAME_CHARS.sub('_', version)}"
+            name, suffix = stamp, 1
+            while (self.root / name).exists():
+                suffix += 1
+                name = f"{stamp}~{suffix}"
+
+            for stale in self.root.glob(f"*{PARTIAL_SUFFIX}"):
+                shutil.rmtree(stale, ignore_errors=True)
+            previous = self.list()
+            base = self.root / previous[0]["name"] if previous else None
+            partial = self.root / f"{name}{PARTIAL_SUFFIX}"
+
+            started = time.time()
+            stats = {"files": 0, "linked": 0, "copied": 0, "bytes": 0, "copied_bytes": 0}
+            try:
+                _snapshot_tree(source.resolve(), partial, base, stats, check_cancel)
+                meta = {
+                    "name": name,
+                    "version": version,
+                    "created": created,
+                    "base": previous[0]["name"] if previous else None,
+                    "secs": round(time.time() - started, 2),
+                    **stats,
+                }
+                with open(partial / SNAPSHOT_META, "w") as f:
+                    json.dump(meta, f)
+                os.rename(partial, self.root / name)
+            except BaseException:
+                shutil.rmtree(partial, ignore_errors=True)
+                raise
+            self._prune(self.retain)
+        logger.info(
+            f"Snapshot {name}: {stats['files']} files, {stats['copied']} copied ({stats['copied_bytes']} bytes), "
+            f"{stats['linked']} linked in {meta['secs']}s"
+        )
+        return meta
+
+    def delete(self, name: str):
+        with self._lock:
+            shutil.rmtree(self.path(name))
+
+    def restore(self, name: str, dest: Path):
+        """
+        Copy a snapshot into `dest` (an inactive slot). Image tarballs are hard linked, the rest
+        is copied so the running version cannot change the snapshot through a shared inode.
+        """
+        with self._lock:
+            source = self.path(name)
+            for root, dirs, files in os.walk(source):
+                root = Path(root)
+                target = dest / root.relative_to(source)
+                target.mkdir(exist_ok=True)
+                for entry in dirs + files:
+                    path = root / entry
+                    if path.is_symlink():
+                        os.symlink(os.readlink(path), target / entry)
+                        if entry in dirs:
+                            dirs.remove(entry)
+                for entry in files:
+                    path = root / entry
+                    if path.is_symlink() or (root == source and entry == SNAPSHOT_META):
+                        continue
+                    if path.relative_to(source).parts[0] == "images":
+                        try:
+                            os.link(path, target / entry)
+                            continue
+                        except OSError:
+                            pass
+                    shutil.copy2(path, target / entry)
+
+    def _prune(self, retain):
+        # Call with lock held. Removing a snapshot only frees what no other snapshot links to
+        for meta in self.list()[max(0, retain):]:
+            shutil.rmtree(self.root / meta["name"], ignore_errors=True)
+            logger.info(f"Removed snapshot {meta['name']}")
+
+def _read_version(source: Path):
+    try:
+        with open(source / ".version", "r") as f:
+            return f.readline().strip()
+    except OSError:
+        return None
+
+def _unchanged(st, base_st):
+    return (
+        base_st.st_size == st.st_size
+        and base_st.st_mtime_ns == st.st_mtime_ns
+        and base_st.st_mode == st.st_mode
+    )
+
+def _snapshot_tree(source: Path, dest: Path, base: Path, stats: dict, check_cancel=None):
+    """Copy `source` to `dest`, hard linking files that are unchanged since the snapshot `base`."""
+    copied_dirs = []
+    for root, dirs, files in os.walk(source):
+        if check_cancel:
+            check_cancel()
+        root = Path(root)
+        relative = root.relative_to(source)
+        target = dest / relative
+        target.mkdir(parents=True, exist_ok=True)
+        copied_dirs.append((root, target))
+        for entry in list(dirs):
+            path = root / entry
+            if path.is_symlink():
+                os.symlink(os.readlink(path), target / entry)
+                dirs.remove(entry)
+        for entry in files:
+            path = root / entry
+            if path.is_symlink():
+                os.symlink(os.readlink(path), target / entry)
+                continue
+            st = path.stat()
+            stats["files"] += 1
+            stats["bytes"] += st.st_size
+            if base is not None:
+                previous = base / relative / entry
+                try:
+                    if _unchanged(st, previous.lstat()):
+                        os.link(previous, target / entry)
+                        stats["linked"] += 1
+                        continue
+                except OSError:
+                    pass  # Not in the previous snapshot, or too many links: copy it
+            shutil.copy2(path, target / entry)
+            stats["copied"] += 1
+            stats["copied_bytes"] += st.st_size
+
+    # Directory times and modes last and deepest first: adding entries changes the mtime, and a
+    # read-only mode would have blocked filling the directory
+    for root, target in reversed(copied_dirs):
+        shutil.copystat(root, target)
+
+BACKUPS = SnapshotStore()
@@ -9,7 +9,7 @@ from pydantic import root_model
 from datetime import datetime, timedelta
 from fastapi import APIRouter, Form, HTTPException, WebSocket, WebSocketDisconnect, Depends
 from fastapi.responses import StreamingResponse
-from helpers import CURRENT_DIR, USER_ROLE, CURRENT_STATE_FILE, SSHClient, get_version, clean_ansi_and_whitespace, logger
+from helpers import CURRENT_DIR, COMPOSE_COMMAND, USER_ROLE, CURRENT_STATE_FILE, SSHClient, get_version, clean_ansi_and_whitespace, logger
 from users import get_current_user, get_current_user_manual
 
 router = APIRouter(tags=["Base"])
@@ -396,7 +396,7 @@ def restart_services():
                 transport = ssh.client.get_transport()
                 channel = transport.open_session()
                 channel.set_combine_stderr(True)
-                script = f"cd {CURRENT_DIR} && docker-compose down && docker-compose up -d"
+                script = f"cd {CURRENT_DIR} && {COMPOSE_COMMAND} down && {COMPOSE_COMMAND} up -d"
                 channel.exec_command(script)
 
                 while True:
@@ -0,0 +1,227 @@
+# bundle.py
+import os
+import json
+import time
+import hashlib
+import posixpath
+import tarfile
+import threading
+from fastapi import HTTPException
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.padding import PKCS7
+from helpers import STAGE_DIR, get_version, logger
+from progress import PROGRESS
+from archive_upload import ArchiveStream
+from update_delta import DELTA_MANIFEST, DeltaError, parse_delta_manifest
+from decompress import BUNDLE_EXTENSIONS, DecompressError, ParallelDecompressor, detect_compression
+from integrity import INTEGRITY_MANIFEST, IntegrityError, parse_integrity_manifest
+
+# Compatible with `openssl enc -aes-256-cbc -salt -pbkdf2` (PBKDF2-HMAC-SHA256, 10000 iterations)
+OPENSSL_MAGIC = b"Salted__"
+OPENSSL_HEADER_BYTES = 16  # Magic + 8 byte salt
+PBKDF2_ITERATIONS = 10000
+BUNDLE_STEM = "bundle"  # Stored as bundle.tar.gz, bundle.tar.zst or bundle.tar.xz after its compression
+REQUIRED_FILES = {"docker-compose.yml", ".version", ".env"}
+REQUIRED_DIRS = {"cmount", "images"}
+DELTA_REQUIRED_FILES = {".version", DELTA_MANIFEST}  # The rest of a delta comes from the installed version
+
+def derive_key_iv(password: str, salt: bytes):
+    material = hashlib.pbkdf2_hmac("sha256", password.encode(), salt, PBKDF2_ITERATIONS, 32 + 16)
+    return material[:32], material[32:]
+
+def inspect_bundle(stream: ArchiveStream):
+    """
+    Walk the tar headers of a gzip, zstd or xz compressed bundle as it streams in.
+    Returns what was found; nothing is extracted except the .version contents.
+    """
+    compression = detect_compression(stream.peek(6))
+    if compression is None:
+        raise HTTPException(status_code=500, detail="File decryption failed: wrong device token or corrupt bundle")
+
+    found_files = set()
+    found_dirs = set()
+    version_string = None
+    contains_override = False
+    delta = None
+    integrity = None
+    members = set()  # Everything but directories, to check the integrity manifest against
+    entries = 0
+
+    source = ParallelDecompressor(stream, compression)
+    try:
+        with tarfile.open(fileobj=source, mode="r|") as tar:
+            for member in tar:
+                entries += 1
+                name = member.name.split("/")[-1]
+                path = posixpath.normpath(member.name)
+                if not member.isdir():
+                    members.add(path)
+
+                if name in REQUIRED_FILES or name in DELTA_REQUIRED_FILES:
+                    found_files.add(name)
+                if name in REQUIRED_DIRS:
+                    found_dirs.add(name)
+                if name == "override.sh" and member.isfile():
+                    contains_override = True
+                if name == ".version" and member.isfile():
+                    version_file = tar.extractfile(member)
+                    if version_file:
+                        version_string = version_file.read().decode("utf-8", errors="ignore").strip()
+                if path == DELTA_MANIFEST and member.isfile():
+                    delta = parse_delta_manifest(tar.extractfile(member).read().decode("utf-8", errors="replace"))
+                if path == INTEGRITY_MANIFEST and member.isfile():
+                    integrity = parse_integrity_manifest(tar.extractfile(member).read().decode("utf-8", errors="replace"))
+    except (tarfile.TarError, DecompressError, EOFError) as e:
+        raise HTTPException(status_code=500, detail=f"Failed to read archive: {e}")
+    except (DeltaError, IntegrityError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    finally:
+        # Trailing padding after the end of archive is not needed, wake the read-ahead so it can stop
+        stream.abandon()
+        source.close()
+
+    return {
+        "compression": compression,
+        "found_files": found_files,
+        "found_dirs": found_dirs,
+        "version": version_string,
+        "contains_override": contains_override,
+        "delta": delta,
+        "integrity": integrity,
+        "members": members,
+        "entries": entries,
+    }
+
+class BundlePipeline:
+    """
+    Single pass over an uploaded `bundle.tar.gz.enc` (or .tar.zst.enc, .tar.xz.enc): every chunk is decrypted as it arrives,
+    written to the stage directory and handed to a thread that decompresses it and checks the tar headers.
+    Bad tokens and corrupt archives fail on the first bytes instead of after the whole upload.
+    The plaintext bundle only appears under its final name once it has been fully verified.
+    """
+
+    def __init__(self, password: str, progress_key: str = None, stage_dir=STAGE_DIR):
+        self.password = password
+        self.progress_key = progress_key
+        self.stage_dir = stage_dir
+        self.received = 0
+        self.busy_secs = 0.0  # Time spent decrypting and validating, excluding waits for the network
+        self.part_path = stage_dir / f"{BUNDLE_STEM}.part"
+        self._out = open(self.part_path, "wb")
+        self._header = b""
+        self._decryptor = None
+        self._unpadder = PKCS7(algorithms.AES.block_size).unpadder()
+        self._stream = ArchiveStream()
+        self._result = None
+        self._error = None
+        self._thread = threading.Thread(target=self._inspect, daemon=True)
+        self._thread.start()
+
+    def _inspect(self):
+        try:
+            self._result = inspect_bundle(self._stream)
+        except HTTPException as e:
+            self._error = e
+        except Exception as e:
+            self._error = HTTPException(status_code=500, detail=f"Failed to read archive: {e}")
+        finally:
+            self._stream.abandon()
+
+    def _check(self):
+        if self._error is not None:
+            raise self._error
+
+    def _write(self, plain: bytes):
+        if not plain:
+            return
+        self._out.write(plain)
+        self._stream.feed(plain)
+        self._check()
+
+    def feed(self, chunk: bytes):
+        started = time.perf_counter()
+        try:
+            self._feed(chunk)
+        finally:
+            self.busy_secs += time.perf_counter() - started
+
+    def _feed(self, chunk: bytes):
+        self.received += len(chunk)
+        if self._decryptor is None:
+            self._header += chunk
+            if len(self._header) < OPENSSL_HEADER_BYTES:
+                return
+            if not self._header.startswith(OPENSSL_MAGIC):
+                raise HTTPException(status_code=500, detail="File decryption failed: not an openssl salted bundle")
+            key, iv = derive_key_iv(self.password, self._header[len(OPENSSL_MAGIC):OPENSSL_HEADER_BYTES])
+            self._decryptor = Cipher(algorithms.AES(key), modes.CBC(iv)).decryptor()
+            chunk = self._header[OPENSSL_HEADER_BYTES:]
+            self._header = b""
+
+        self._write(self._unpadder.update(self._decryptor.update(chunk)))
+        if self.progress_key:
+            PROGRESS.update(self.progress_key, done=self.received)
+
+    def finish(self):
+        """Verify the end of the upload and move the plaintext bundle into place."""
+        if self._decryptor is None:
+            raise HTTPException(status_code=500, detail="File decryption failed: upload is too short")
+        self._check()
+        try:
+            final = self._unpadder.update(self._decryptor.finalize()) + self._unpadder.finalize()
+        except ValueError:
+            raise HTTPException(status_code=500, detail="File decryption failed: bad padding, wrong device token or truncated upload")
+        started = time.perf_counter()
+        self._write(final)
+        self._stream.feed(None)
+        self._thread.join()
+        self.busy_secs += time.perf_counter() - started
+        self._out.close()
+        self._check()
+
+        result = self._result
+        delta = result["delta"]
+        if delta:
+            missing_files = DELTA_REQUIRED_FILES - result["found_files"]
+            missing_dirs = set()
+        else:
+            missing_files = REQUIRED_FILES - result["found_files"]
+            missing_dirs = REQUIRED_DIRS - result["found_dirs"]
+        if missing_files or missing_dirs:
+            detail = ""
+            if missing_files:
+                detail += f"Missing required file(s): {', '.join(missing_files)}. "
+            if missing_dirs:
+                detail += f"Missing required directory(s): {', '.join(missing_dirs)}."
+            raise HTTPException(status_code=400, detail=detail.strip())
+        integrity = result["integrity"]
+        if integrity and not delta:
+            # Hashes are checked after extraction, a file that is not even in the archive fails now
+            absent = sorted(set(integrity) - result["members"])
+            if absent:
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"{INTEGRITY_MANIFEST} lists {len(absent)} file(s) missing from the bundle: {', '.join(absent[:5])}",
+                )
+        result["integrity_files"] = len(integrity) if integrity else None
+        if delta and delta["base_version"] != get_version():
+            raise HTTPException(
+                status_code=409,
+                detail=f"Delta bundle applies to version {delta['base_version']}, this device runs {get_version()}",
+            )
+
+        os.replace(self.part_path, self.stage_dir / f"{BUNDLE_STEM}{BUNDLE_EXTENSIONS[result['compression']]}")
+        if delta:
+            with open(self.stage_dir / DELTA_MANIFEST, "w") as df:
+                json.dump(delta, df)
+        if result["version"] is not None:
+            with open(self.stage_dir / ".version", "w", encoding="utf-8") as vf:
+                vf.write(result["version"])
+        kind = f"{result['compression']} delta from {delta['base_version']}" if delta else f"{result['compression']} bundle"
+        logger.info(f"Bundle {result['version']} ({kind}) verified: {result['entries']} entries, {self.received} bytes")
+        return result
+
+    def abort(self):
+        self._stream.abandon()
+        self._out.close()
+        self.part_path.unlink(missing_ok=True)
@@ -0,0 +1,290 @@
+# decompress.py
+import os
+import sys
+import lzma
+import zlib
+import struct
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import zstandard as zstd
+from archive_upload import ArchiveStream, ZSTD_MAGIC
+
+GZIP = "gzip"
+ZSTD = "zstd"
+XZ = "xz"
+GZIP_MAGIC = b"\x1f\x8b"
+XZ_MAGIC = b"\xfd7zXZ\x00"
+BUNDLE_EXTENSIONS = {GZIP: ".tar.gz", ZSTD: ".tar.zst", XZ: ".tar.xz"}
+DECOMPRESS_WORKERS = os.cpu_count() or 1
+DECOMPRESS_READ_BYTES = 1024 * 1024
+DECOMPRESS_TASK_BYTES = 1024 * 1024  # Compressed bytes handed to a worker at a time
+DECOMPRESS_MAX_UNIT_BYTES = 32 * 1024 * 1024  # A bigger member or frame is decompressed in order instead
+BGZF_BLOCK_BYTES = 64 * 1024 - 256  # Input per BGZF block, leaves room for the header and incompressible data
+ZSTD_FRAME_BYTES = 4 * 1024 * 1024  # Input per frame when writing multi-frame zstd
+ZSTD_FRAME_MAGIC = 0xFD2FB528
+ZSTD_SKIPPABLE_MASK = 0xFFFFFFF0
+ZSTD_SKIPPABLE_MAGIC = 0x184D2A50
+
+class DecompressError(Exception):
+    pass
+
+def detect_compression(head: bytes):
+    """Compression of a bundle from its first bytes, None if it is none we read."""
+    if head.startswith(GZIP_MAGIC):
+        return GZIP
+    if head.startswith(ZSTD_MAGIC):
+        return ZSTD
+    if len(head) >= 4 and struct.unpack_from("<I", head)[0] & ZSTD_SKIPPABLE_MASK == ZSTD_SKIPPABLE_MAGIC:
+        return ZSTD  # pzstd output starts with a skippable frame
+    if head.startswith(XZ_MAGIC):
+        return XZ
+    return None
+
+# === Splitting into independent units ===
+# A splitter returns the size of the unit starting at `pos`, negative for one that carries no data,
+# 0 if it cannot tell the size (not splittable) and None if `buf` ends before the answer does.
+
+def bgzf_block_size(buf, pos):
+    """Size of the BGZF block (a gzip member with a "BC" extra field holding its size) at `pos`."""
+    if len(buf) - pos < 12:
+        return None
+    if buf[pos:pos + 3] != b"\x1f\x8b\x08" or not buf[pos + 3] & 0x04:
+        return 0
+    xlen = struct.unpack_from("<H", buf, pos + 10)[0]
+    if len(buf) - pos < 12 + xlen:
+        return None
+    offset, end = pos + 12, pos + 12 + xlen
+    while offset + 4 <= end:
+        slen = struct.unpack_from("<H", buf, offset + 2)[0]
+        if buf[offset:offset + 2] == b"BC" and slen == 2:
+            return struct.unpack_from("<H", buf, offset + 4)[0] + 1
+        offset += 4 + slen
+    return 0
+
+def zstd_frame_size(buf, pos):
+    """Size of the zstd frame at `pos`, read from the frame and block headers."""
+    avail = len(buf) - pos
+    if avail < 8:
+        return None
+    magic = struct.unpack_from("<I", buf, pos)[0]
+    if magic & ZSTD_SKIPPABLE_MASK == ZSTD_SKIPPABLE_MAGIC:
+        return -(8 + struct.unpack_from("<I", buf, pos + 4)[0])
+    if magic != ZSTD_FRAME_MAGIC:
+        return 0
+    descriptor = buf[pos + 4]
+    single_segment = descriptor >> 5 & 1
+    size = 5 + (not single_segment) + (0, 1, 2, 4)[descriptor & 3] + (single_segment, 2, 4, 8)[descriptor >> 6]
+    while True:
+        if avail < size + 3:
+            return None
+        header = int.from_bytes(buf[pos + size:pos + size + 3], "little")
+        block_type = header >> 1 & 3
+        if block_type == 3:
+            return 0  # Reserved, corrupt: leave the error to the decoder
+        size += 3 + (1 if block_type == 1 else header >> 3)
+        if header & 1:
+            break
+    return size + (4 if descriptor & 0x04 else 0)  # Content checksum
+
+SPLITTERS = {GZIP: bgzf_block_size, ZSTD: zstd_frame_size}
+
+# === Decoding ===
+class StreamDecoder:
+    """Incremental decoder for a stream of any number of concatenated gzip members, zstd frames or xz streams."""
+
+    def __init__(self, compression):
+        self.compression = compression
+        self._decoder = self._new()
+        self._pending = False  # Inside a member that has not ended yet
+
+    def _new(self):
+        if self.compression == GZIP:
+            return zlib.decompressobj(wbits=31)
+        if self.compression == ZSTD:
+            return zstd.ZstdDecompressor().decompressobj()
+        return lzma.LZMADecompressor(format=lzma.FORMAT_XZ)
+
+    def decompress(self, data: bytes) -> bytes:
+        out = []
+        try:
+            while data:
+                self._pending = True
+                out.append(self._decoder.decompress(data))
+                if not self._decoder.eof:
+                    break
+                self._pending = False
+                data = self._decoder.unused_data
+                if self.compression == XZ:
+                    data = data.lstrip(b"\0")  # Stream padding
+                self._decoder = self._new()
+        except (zlib.error, zstd.ZstdError, lzma.LZMAError) as e:
+            raise DecompressError(f"Corrupt {self.compression} data: {e}")
+        return b"".join(out)
+
+    def finish(self):
+        if self._pending:
+            raise DecompressError(f"Truncated {self.compression} data")
+
+def _decompress_task(compression, data):
+    decoder = StreamDecoder(compression)
+    out = decoder.decompress(data)
+    decoder.finish()
+    return out
+
+class _Abandoned(Exception):
+    pass
+
+class ParallelDecompressor:
+    """
+    Read-only file object with the decompressed contents of `source`, for `tarfile.open(mode="r|")`.
+
+    A background thread reads ahead and decompresses while the caller extracts, so the two overlap.
+    BGZF gzip (`bgzip`) and multi-frame zstd (`pzstd`) are split into their independent blocks and
+    frames, which a pool of DECOMPRESS_WORKERS threads decompresses in parallel (zlib and zstd
+    release the GIL). Anything else, plain gzip, single-frame zstd and xz, is decompressed in order
+    on the background thread. Output is handed over through a bounded ArchiveStream, so memory use
+    does not depend on how far extraction lags behind.
+    """
+
+    def __init__(self, source, compression, workers=DECOMPRESS_WORKERS):
+        if compression not in BUNDLE_EXTENSIONS:
+            raise DecompressError(f"Unsupported compression: {compression}")
+        self.source = source
+        self.compression = compression
+        self.workers = max(1, workers)
+        self.parallel_bytes = 0  # Compressed bytes that went through the worker pool
+        self.parallel_tasks = 0
+        self._stream = ArchiveStream()
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def read(self, n=-1):
+        data = self._stream.read(n)
+        if self._error is not None and (n < 0 or len(data) < n):
+            raise self._error
+        return data
+
+    def close(self):
+        """Stop reading ahead, the caller may stop before the end (tar stops at its end-of-archive)."""
+        self._stream.abandon()
+        self._thread.join()
+
+    def _emit(self, data):
+        view = memoryview(data)
+        for offset in range(0, len(view), DECOMPRESS_READ_BYTES):
+            if not self._stream.feed(bytes(view[offset:offset + DECOMPRESS_READ_BYTES])):
+                raise _Abandoned()
+
+    def _run(self):
+        try:
+            self._decompress()
+        except _Abandoned:
+            pass
+        except DecompressError as e:
+            self._error = e
+        except Exception as e:
+            self._error = DecompressError(f"Decompression failed: {e}")
+        finally:
+            self._stream.feed(None)
+
+    def _decompress(self):
+        split = SPLITTERS.get(self.compression)
+        buf, pos, eof = bytearray(), 0, False
+        pending, task = deque(), bytearray()
+        pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="decompress")
+        try:
+            while split is not None:
+                size = split(buf, pos) if pos < len(buf) else None
+                if size == 0:
+                    break  # Not (or no longer) splittable, decompress the rest in order
+                if size is not None and pos + abs(size) <= len(buf):
+                    if size > 0:
+                        task += buf[pos:pos + size]
+                        if len(task) >= DECOMPRESS_TASK_BYTES:
+                            self._submit(pool, pending, task)
+                            task = bytearray()
+                    pos += abs(size)
+                    continue
+                if eof or len(buf) - pos > DECOMPRESS_MAX_UNIT_BYTES:
+                    break
+                chunk = self.source.read(DECOMPRESS_READ_BYTES)
+                if not chunk:
+                    eof = True
+                    continue
+                del buf[:pos]
+                pos = 0
+                buf += chunk
+            if task:
+                self._submit(pool, pending, task)
+            while pending:
+                self._emit(pending.popleft().result())
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+        decoder = StreamDecoder(self.compression)
+        self._emit(decoder.decompress(bytes(buf[pos:])))
+        del buf
+        while not eof:
+            chunk = self.source.read(DECOMPRESS_READ_BYTES)
+            if not chunk:
+                break
+            self._emit(decoder.decompress(chunk))
+        decoder.finish()
+
+    def _submit(self, pool, pending, task):
+        self.parallel_bytes += len(task)
+        self.parallel_tasks += 1
+        pending.append(pool.submit(_decompress_task, self.compression, bytes(task)))
+        # Keep every worker busy while bounding what is held in memory
+        while len(pending) > self.workers:
+            self._emit(pending.popleft().result())
+
+# === Writing splittable bundles ===
+def compress_bgzf(data: bytes, level: int = 6) -> bytes:
+    """Gzip `data` as BGZF, the format `bgzip` writes: independent members that record their size."""
+    out = bytearray()
+    for offset in range(0, len(data), BGZF_BLOCK_BYTES):
+        block = data[offset:offset + BGZF_BLOCK_BYTES]
+        deflater = zlib.compressobj(level, zlib.DEFLATED, -15)
+        body = deflater.compress(block) + deflater.flush()
+        out += b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00"
+        out += struct.pack("<H", 18 + len(body) + 8 - 1)
+        out += body
+        out += struct.pack("<II", zlib.crc32(block), len(block))
+    out += bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")  # BGZF end-of-file block
+    return bytes(out)
+
+def compress_zstd_frames(data: bytes, level: int = 3) -> bytes:
+    """Zstd `data` as one frame per ZSTD_FRAME_BYTES, which can be decompressed in parallel."""
+    compressor = zstd.ZstdCompressor(level=level, write_checksum=True, write_content_size=True)
+    return b"".join(
+        compressor.compress(data[offset:offset + ZSTD_FRAME_BYTES])
+        for offset in range(0, len(data), ZSTD_FRAME_BYTES)
+    )
+
+if __name__ == "__main__":
+    # Recompress a bundle so the device decompresses it on all cores:
+    #   python decompress.py bundle.tar.gz bundle.tar.zst
+    # The output format follows the extension (.tar.gz writes BGZF, .tar.zst multi-frame zstd).
+    if len(sys.argv) != 3 or not sys.argv[2].endswith((".tar.gz", ".tar.zst")):
+        sys.exit("usage: decompress.py <input bundle> <output.tar.gz|output.tar.zst>")
+    with open(sys.argv[1], "rb") as f:
+        compression = detect_compression(f.read(6))
+        f.seek(0)
+        if compression is None:
+            plain = f.read()
+        else:
+            with ParallelDecompressor(f, compression) as source:
+                plain = source.read()
+    packed = compress_bgzf(plain) if sys.argv[2].endswith(".tar.gz") else compress_zstd_frames(plain)
+    with open(sys.argv[2], "wb") as out:
+        out.write(packed)
+    print(f"{sys.argv[2]}: {len(plain)} bytes -> {len(packed)} bytes")
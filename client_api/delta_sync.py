@@ -0,0 +1,331 @@
+# delta_sync.py
+import json
+import time
+import uuid
+import shlex
+import shutil
+import hashlib
+import posixpath
+from pathlib import Path
+from typing import List, Optional
+from pydantic import BaseModel, Field
+from fastapi import HTTPException
+from helpers import DEVICE_DIR, SSHClient, logger
+
+SYNC_DIR = Path(f"{DEVICE_DIR}/sync") # One sub directory per sync session, apart from the update stage dir that updates clear
+SYNC_SESSION_TTL_SECONDS = 24 * 3600
+SYNC_DEFAULT_BLOCK_SIZE = 128 * 1024
+SYNC_MIN_BLOCK_SIZE = 4 * 1024
+SYNC_MAX_BLOCK_SIZE = 4 * 1024 * 1024
+SYNC_MAX_HASH_FILES = 10000  # Device files outside the manifest hashed as block sources, smallest first
+SYNC_MAX_HASH_BYTES = 1024 * 1024 * 1024
+
+# Moves each staged file into place, answering "ok" or "error <msg>" per (src, dst, mode) triple on stdin.
+# Without an explicit mode the replaced file keeps its mode and owner.
+SYNC_INSTALL_SCRIPT = r"""
+while IFS= read -r -d '' src && IFS= read -r -d '' dst && IFS= read -r -d '' mode; do
+    if err=$( {
+        mkdir -p -- "$(dirname -- "$dst")" &&
+        if [ -n "$mode" ]; then
+            chmod "$mode" -- "$src"
+        elif [ -e "$dst" ]; then
+            chmod --reference="$dst" -- "$src" && chown --reference="$dst" -- "$src"
+        fi &&
+        mv -fT -- "$src" "$dst"
+    } 2>&1 ); then
+        printf 'ok\0'
+    else
+        printf 'error %s\0' "$err"
+    fi
+done
+"""
+
+class SyncFile(BaseModel):
+    path: str  # Relative to the sync root
+    size: int = Field(..., ge=0)
+    mode: Optional[str] = None  # Octal, e.g. "644"; unset keeps the mode of the file it replaces
+    blocks: List[str]  # sha256 hex digest of every block_size block, the last one may be shorter
+
+class SyncManifest(BaseModel):
+    root: str  # Directory on the device the tree is synced into
+    block_size: int = Field(SYNC_DEFAULT_BLOCK_SIZE, ge=SYNC_MIN_BLOCK_SIZE, le=SYNC_MAX_BLOCK_SIZE)
+    files: List[SyncFile]
+    delete: bool = False  # Remove files below root that are not in the manifest
+
+def block_length(size: int, block_size: int, index: int) -> int:
+    return min(block_size, size - index * block_size)
+
+def hash_blocks(f, block_size: int):
+    digests = []
+    while block := f.read(block_size):
+        digests.append(hashlib.sha256(block).hexdigest())
+    return digests
+
+def session_dir(session_id: str) -> Path:
+    path = SYNC_DIR / session_id
+    if not session_id.isalnum() or not path.is_dir():
+        raise HTTPException(status_code=404, detail="Sync session not found")
+    return path
+
+def load_session(session_id: str):
+    with open(session_dir(session_id) / "session.json", "r") as f:
+        return json.load(f)
+
+def save_session(session):
+    path = SYNC_DIR / session["id"] / "session.json"
+    tmp = path.with_suffix(".tmp")
+    with open(tmp, "w") as f:
+        json.dump(session, f)
+    tmp.replace(path)
+
+def delete_session(session_id: str):
+    shutil.rmtree(session_dir(session_id), ignore_errors=True)
+
+def cleanup_sessions():
+    if not SYNC_DIR.exists():
+        return
+    for path in SYNC_DIR.iterdir():
+        if time.time() - path.stat().st_mtime > SYNC_SESSION_TTL_SECONDS:
+            shutil.rmtree(path, ignore_errors=True)
+
+def validate_manifest(manifest: SyncManifest):
+    for f in manifest.files:
+        normalized = posixpath.normpath(f.path)
+        if f.path.startswith("/") or normalized == ".." or normalized.startswith("../") or normalized == ".":
+            raise HTTPException(status_code=400, detail=f"Invalid path in manifest: {f.path}")
+        f.path = normalized
+        expected = -(-f.size // manifest.block_size)
+        if len(f.blocks) != expected:
+            raise HTTPException(status_code=400, detail=f"{f.path}: expected {expected} block hashes, got {len(f.blocks)}")
+        if f.mode is not None:
+            try:
+                int(f.mode, 8)
+            except ValueError:
+                raise HTTPException(status_code=400, detail=f"{f.path}: invalid mode {f.mode}")
+
+def create_plan(manifest: SyncManifest):
+    """
+    Compare a manifest against the device and decide, block by block, where every file's content
+    comes from: a block already on the device (any file below root, any offset) or the upload.
+    Files at a manifest path are always hashed; other device files, so moved or renamed content is
+    reused too, up to SYNC_MAX_HASH_FILES files and SYNC_MAX_HASH_BYTES, smallest first.
+    """
+    validate_manifest(manifest)
+    cleanup_sessions()
+    root = manifest.root.rstrip("/") or "/"
+    block_size = manifest.block_size
+
+    existing = {}  # rel -> (kind, size)
+    available = {}  # digest -> (rel, offset) of a block already on the device
+    current = {}  # rel -> digests of the file currently on the device
+    with SSHClient() as ssh:
+        try:
+            for record in ssh.run_records(f"LC_ALL=C find {shlex.quote(root)} -mindepth 1 -printf '%y %s %P\\0'"):
+                kind, size, rel = record.split(" ", 2)
+                existing[rel] = (kind, int(size))
+        except RuntimeError:
+            pass  # Root does not exist yet, everything is uploaded
+
+        in_manifest = {f.path for f in manifest.files}
+        to_hash = [f.path for f in manifest.files if existing.get(f.path, ("",))[0] == "f"]
+        others = sorted(
+            (size, rel) for rel, (kind, size) in existing.items()
+            if kind == "f" and size > 0 and rel not in in_manifest
+        )
+        budget = SYNC_MAX_HASH_BYTES
+        for size, rel in others[:SYNC_MAX_HASH_FILES]:
+            if size > budget:
+                break
+            budget -= size
+            to_hash.append(rel)
+
+        sftp = ssh.open_sftp()
+        try:
+            for rel in to_hash:
+                try:
+                    with sftp.open(posixpath.join(root, rel), "rb") as remote:
+                        remote.prefetch()
+                        digests = hash_blocks(remote, block_size)
+                except OSError:
+                    continue  # Unreadable or gone since the listing, its content is uploaded
+                if rel in in_manifest:
+                    current[rel] = digests
+                for index, digest in enumerate(digests):
+                    available.setdefault(digest, (rel, index * block_size))
+        finally:
+            sftp.close()
+
+    session_id = uuid.uuid4().hex
+    upload = []  # Blocks the client has to send, in this order
+    uploaded = {}  # digest -> offset in blocks.bin
+    upload_offset = 0
+    files = []
+    needed = []
+    unchanged = 0
+    reused_bytes = 0
+
+    for f in manifest.files:
+        if current.get(f.path) == f.blocks:
+            unchanged += 1
+            continue
+
+        sources = []
+        missing = []
+        for index, digest in enumerate(f.blocks):
+            length = block_length(f.size, block_size, index)
+            if digest in available:
+                rel, offset = available[digest]
+                sources.append(["device", rel, offset, length, digest])
+                reused_bytes += length
+            else:
+                if digest not in uploaded:
+                    uploaded[digest] = upload_offset
+                    upload.append({"digest": digest, "length": length})
+                    upload_offset += length
+                    missing.append(index)
+                sources.append(["upload", None, uploaded[digest], length, digest])
+        files.append({"path": f.path, "mode": f.mode, "sources": sources})
+        if missing:
+            needed.append({"path": f.path, "blocks": missing})
+
+    delete = []
+    if manifest.delete:
+        keep = {f.path for f in manifest.files}
+        delete = sorted(rel for rel, (kind, _) in existing.items() if kind != "d" and rel not in keep)
+
+    path = SYNC_DIR / session_id
+    path.mkdir(parents=True)
+    (path / "blocks.bin").touch()
+    save_session({
+        "id": session_id,
+        "root": root,
+        "block_size": block_size,
+        "files": files,
+        "upload": upload,
+        "received": 0,
+        "delete": delete,
+    })
+
+    return {
+        "session_id": session_id,
+        "block_size": block_size,
+        "needed": needed,
+        "needed_blocks": len(upload),
+        "needed_bytes": upload_offset,
+        "reused_bytes": reused_bytes,
+        "changed": len(files),
+        "unchanged": unchanged,
+        "delete": delete,
+    }
+
+def receive_blocks(session_id: str, stream):
+    """
+    Append uploaded blocks to the session, verifying each against its digest.
+    Blocks are expected in plan order; an interrupted upload resumes at the first missing block.
+    """
+    session = load_session(session_id)
+    upload = session["upload"]
+    received = session["received"]
+
+    try:
+        with open(session_dir(session_id) / "blocks.bin", "r+b") as out:
+            out.seek(sum(b["length"] for b in upload[:received]))
+            out.truncate()
+            while received < len(upload):
+                block = upload[received]
+                data = stream.read(block["length"])
+                while data and len(data) < block["length"]:
+                    more = stream.read(block["length"] - len(data))
+                    if not more:
+                        break
+                    data += more
+                if len(data) < block["length"]:
+                    break
+                if hashlib.sha256(data).hexdigest() != block["digest"]:
+                    raise HTTPException(status_code=400, detail=f"Block {received} does not match its digest")
+                out.write(data)
+                received += 1
+    finally:
+        session["received"] = received
+        save_session(session)
+
+    return {"received": received, "remaining": len(upload) - received}
+
+def commit_session(session_id: str):
+    """
+    Assemble every changed file from device and uploaded blocks in the session directory,
+    then move them into place and apply deletions.
+    """
+    session = load_session(session_id)
+    if session["received"] < len(session["upload"]):
+        raise HTTPException(status_code=409, detail=f"{len(session['upload']) - session['received']} blocks still missing")
+
+    path = session_dir(session_id)
+    root = session["root"]
+    staged = []
+    results = []
+
+    with SSHClient() as ssh:
+        sftp = ssh.open_sftp()
+        handles = {}
+        try:
+            with open(path / "blocks.bin", "rb") as blocks:
+                for n, f in enumerate(session["files"]):
+                    target = path / f"file-{n}"
+                    try:
+                        with open(target, "wb") as out:
+                            for kind, rel, offset, length, digest in f["sources"]:
+                                if kind == "upload":
+                                    blocks.seek(offset)
+                                    out.write(blocks.read(length))
+                                    continue
+                                if rel not in handles:
+                                    handles[rel] = sftp.open(posixpath.join(root, rel), "rb")
+                                handles[rel].seek(offset)
+                                data = handles[rel].read(length)
+                                # The device file may have changed since the plan was made
+                                if hashlib.sha256(data).hexdigest() != digest:
+                                    raise ValueError(f"{rel} changed on the device since the sync was planned")
+                                out.write(data)
+                        staged.append((str(target), posixpath.join(root, f["path"]), f["mode"] or "", f["path"]))
+                    except Exception as e:
+                        results.append({"path": f["path"], "status": "error", "error": str(e)})
+        finally:
+            for handle in handles.values():
+                handle.close()
+            sftp.close()
+
+        records = [value for src, dst, mode, _ in staged for value in (src, dst, mode)]
+        answers = []
+        missing = "No answer from the install script"
+        if staged:
+            # Run to the end so the exit status is checked, files without an answer failed
+            try:
+                for answer in ssh.run_records(SYNC_INSTALL_SCRIPT, records):
+                    answers.append(answer)
+            except RuntimeError as e:
+                logger.warning(f"Warning: sync install failed: {e}")
+                missing = f"Install failed: {e}"
+        for n, (_, _, _, rel) in enumerate(staged):
+            if n < len(answers):
+                status, _, error = answers[n].partition(" ")
+                results.append({"path": rel, "status": status, "error": error.strip() or None})
+            else:
+                results.append({"path": rel, "status": "error", "error": missing})
+
+        deleted = 0
+        if session["delete"]:
+            try:
+                list(ssh.run_records(f"cd {shlex.quote(root)} && xargs -0 -r rm -f --", session["delete"]))
+                deleted = len(session["delete"])
+            except RuntimeError as e:
+                logger.warning(f"Warning: sync deletions failed: {e}")
+                results.append({"path": root, "status": "error", "error": f"Deletion failed: {e}"})
+
+    delete_session(session_id)
+    return {
+        "updated": sum(r["status"] == "ok" for r in results),
+        "failed": sum(r["status"] == "error" for r in results),
+        "deleted": deleted,
+        "results": results,
+    }
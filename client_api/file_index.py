@@ -0,0 +1,285 @@
+# file_index.py
+import re
+import time
+import bisect
+import shlex
+import posixpath
+import threading
+from itertools import accumulate
+from helpers import SSHClient, CommandError, logger
+
+INDEX_ROOTS = ["/"]
+INDEX_PRUNE = ["/proc", "/sys", "/dev", "/run", "/tmp", "/var/lib/docker", "/var/lib/containerd"]
+INDEX_REFRESH_SECONDS = 30  # Incremental rescan of directories whose mtime changed
+INDEX_FULL_RESCAN_SECONDS = 3600  # Full rescan, also picks up size/mtime changes of files edited in place
+ENTRY_FORMAT = "%y %s %T@ %p\\0"
+PARTIAL_SCAN_CODES = (1, 123)  # find could not read some entries (xargs: one of its finds did not)
+
+def glob_to_regex(pattern: str, match_path: bool = False) -> str:
+    """
+    Translate a shell glob into a regex matching one line of the index blob.
+    On paths `*` stays within one directory and `**` crosses directories.
+    """
+    any_char = "[^\n/]" if match_path else "[^\n]"
+    out = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == "*":
+            if match_path and pattern.startswith("**", i):
+                out.append("[^\n]*")
+                i += 1
+            else:
+                out.append(any_char + "*")
+        elif c == "?":
+            out.append(any_char)
+        elif c == "[" and (end := pattern.find("]", i + 2)) != -1:
+            body = pattern[i + 1:end].replace("\\", "\\\\")
+            if body.startswith("!"):
+                body = "^\n" + body[1:]
+            out.append(f"[{body}]")
+            i = end
+        else:
+            out.append(re.escape(c))
+        i += 1
+    return "^" + "".join(out) + "$"
+
+class IndexSnapshot:
+    """
+    Immutable, query-friendly view of the index.
+    Paths are sorted; names and paths are also kept as newline-joined blobs so substring and
+    glob queries run as a single regex scan in C instead of a Python loop per entry.
+    """
+
+    def __init__(self, entries):
+        self.paths = sorted(entries)
+        self.kinds = [entries[p][0] for p in self.paths]
+        self.sizes = [entries[p][1] for p in self.paths]
+        self.mtimes = [entries[p][2] for p in self.paths]
+        names = [posixpath.basename(p).replace("\n", "?") or p for p in self.paths]
+        self.name_blob = "\n".join(names) + "\n"
+        self.name_offsets = [0] + list(accumulate(len(n) + 1 for n in names))[:-1]
+        self.path_blob = "\n".join(p.replace("\n", "?") for p in self.paths) + "\n"
+        self.path_offsets = [0] + list(accumulate(len(p) + 1 for p in self.paths))[:-1]
+
+    def match(self, regex: str, on_path: bool, flags: int):
+        blob, offsets = (self.path_blob, self.path_offsets) if on_path else (self.name_blob, self.name_offsets)
+        last = -1
+        for m in re.finditer(regex, blob, flags | re.MULTILINE):
+            index = bisect.bisect_right(offsets, m.start()) - 1
+            if index != last:
+                last = index
+                yield index
+
+class FileIndex:
+    """
+    Filename index of the host file system, built with one `find` over SSH and kept up to date
+    by mtime-diff rescans: only directories whose mtime changed since the last scan are re-listed.
+    """
+
+    def __init__(self, roots=INDEX_ROOTS, prune=INDEX_PRUNE):
+        self.roots = roots
+        self.prune = prune
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        self._entries = {}  # path -> (kind, size, mtime)
+        self._children = {}  # dir -> set of child paths
+        self._dir_mtimes = {}  # dir -> raw mtime string from find
+        self._snapshot = None
+        self._built_at = None
+        self._refreshed_at = None
+        self._refresher = None
+
+    # === Scanning ===
+    def _find(self, expression: str) -> str:
+        roots = " ".join(shlex.quote(r) for r in self.roots)
+        if not self.prune:
+            return f"LC_ALL=C find {roots} -ignore_readdir_race -xdev {expression}"
+        prune = " -o ".join(f"-path {shlex.quote(p)}" for p in self.prune)
+        return f"LC_ALL=C find {roots} -ignore_readdir_race -xdev \\( {prune} \\) -prune -o {expression}"
+
+    @staticmethod
+    def _records(ssh, command, records=None):
+        """
+        Records of a scan. On a live host some entries are routinely unreadable or gone by the time
+        they are visited, so a scan that exits with one of PARTIAL_SCAN_CODES but produced records
+        is kept and its stderr logged.
+        """
+        count = 0
+        try:
+            for record in ssh.run_records(command, records):
+                count += 1
+                yield record
+        except CommandError as e:
+            if e.code not in PARTIAL_SCAN_CODES or not count:
+                raise
+            logger.warning(f"Warning: file index scan incomplete: {e}")
+
+    @staticmethod
+    def _parse(record):
+        kind, size, mtime, path = record.split(" ", 3)
+        return path, (kind, int(size), int(float(mtime))), mtime
+
+    def rebuild(self):
+        """Full scan, replaces the whole index."""
+        entries = {}
+        children = {}
+        dir_mtimes = {}
+        started = time.time()
+        with SSHClient() as ssh:
+            for record in self._records(ssh, self._find(f"-printf '{ENTRY_FORMAT}'")):
+                path, meta, raw_mtime = self._parse(record)
+                entries[path] = meta
+                parent = posixpath.dirname(path)
+                if parent != path:
+                    children.setdefault(parent, set()).add(path)
+                if meta[0] == "d":
+                    dir_mtimes[path] = raw_mtime
+
+        with self._lock:
+            self._entries, self._children, self._dir_mtimes = entries, children, dir_mtimes
+            self._snapshot = None
+            self._built_at = self._refreshed_at = time.time()
+        logger.info(f"File index built: {len(entries)} entries in {time.time() - started:.1f}s")
+
+    def refresh(self):
+        """Re-list only directories that were added or whose mtime changed since the last scan."""
+        if time.time() - self._built_at > INDEX_FULL_RESCAN_SECONDS:
+            self.rebuild()
+            return
+
+        with SSHClient() as ssh:
+            dirs = {}
+            for record in self._records(ssh, self._find("-type d -printf '%T@ %p\\0'")):
+                mtime, path = record.split(" ", 1)
+                dirs[path] = mtime
+
+            with self._lock:
+                changed = [d for d, mtime in dirs.items() if self._dir_mtimes.get(d) != mtime]
+                removed = [d for d in self._dir_mtimes if d not in dirs]
+
+            listings = {d: {} for d in changed}
+            if changed:
+                lister = f"LC_ALL=C find \"$@\" -ignore_readdir_race -mindepth 1 -maxdepth 1 -printf '{ENTRY_FORMAT}'"
+                for record in self._records(ssh, f"xargs -0 -r sh -c {shlex.quote(lister)} _", changed):
+                    path, meta, _ = self._parse(record)
+                    parent = posixpath.dirname(path)
+                    if parent in listings and path not in self.prune:
+                        listings[parent][path] = meta
+
+        with self._lock:
+            for d in removed:
+                self._remove_tree(d)
+            for d in changed:
+                listing = listings[d]
+                for path in self._children.get(d, set()) - listing.keys():
+                    self._remove_tree(path)
+                for path, meta in listing.items():
+                    self._entries[path] = meta
+                    self._children.setdefault(d, set()).add(path)
+                self._dir_mtimes[d] = dirs[d]
+            if changed or removed:
+                self._snapshot = None
+            self._refreshed_at = time.time()
+
+    def _remove_tree(self, path):
+        # Call with lock held
+        parent = posixpath.dirname(path)
+        if parent in self._children:
+            self._children[parent].discard(path)
+        stack = [path]
+        while stack:
+            current = stack.pop()
+            self._entries.pop(current, None)
+            self._dir_mtimes.pop(current, None)
+            stack.extend(self._children.pop(current, ()))
+
+    # === Lifecycle ===
+    def ensure_ready(self):
+        """Build the index on first use and start the background refresher."""
+        if self._built_at is not None and self._refresher is not None:
+            return
+        with self._build_lock:
+            if self._built_at is None:
+                self.rebuild()
+            if self._refresher is None:
+                self._refresher = threading.Thread(target=self._refresh_loop, daemon=True)
+                self._refresher.start()
+
+    def _refresh_loop(self):
+        while True:
+            time.sleep(INDEX_REFRESH_SECONDS)
+            try:
+                with self._build_lock:
+                    self.refresh()
+            except Exception as e:
+                logger.warning(f"Warning: file index refresh failed: {e}")
+
+    def snapshot(self) -> IndexSnapshot:
+        self.ensure_ready()
+        with self._lock:
+            if self._snapshot is None:
+                self._snapshot = IndexSnapshot(self._entries)
+            return self._snapshot
+
+    def status(self):
+        return {
+            "entries": len(self._entries),
+            "built_at": self._built_at,
+            "refreshed_at": self._refreshed_at,
+        }
+
+    # === Queries ===
+    def search(self, q=None, glob=None, under=None, kind=None, min_size=None, max_size=None,
+               modified_after=None, modified_before=None, case_sensitive=False, offset=0, limit=100):
+        """
+        Return (total, page) of entries matching every given filter, in path order.
+        `q` is a substring of the name, `glob` matches the name, or the full path if it contains "/".
+        """
+        snap = self.snapshot()
+        flags = 0 if case_sensitive else re.IGNORECASE
+
+        lo, hi = 0, len(snap.paths)
+        if under and under != "/":
+            under = under.rstrip("/")
+            # Everything below `under` sorts between "under" and "under0" ("0" follows "/")
+            lo = bisect.bisect_left(snap.paths, under)
+            hi = bisect.bisect_left(snap.paths, under + "0")
+
+        if glob:
+            candidates = snap.match(glob_to_regex(glob, "/" in glob), "/" in glob, flags)
+        elif q:
+            candidates = snap.match(re.escape(q.replace("\n", "?")), False, flags)
+        else:
+            candidates = range(lo, hi)
+        needle = q if case_sensitive or not q else q.lower()
+
+        total = 0
+        page = []
+        for i in candidates:
+            if i < lo or i >= hi:
+                continue
+            path = snap.paths[i]
+            if under and under != "/" and path != under and not path.startswith(under + "/"):
+                continue
+            if glob and q:
+                name = posixpath.basename(path)
+                if needle not in (name if case_sensitive else name.lower()):
+                    continue
+            if kind and snap.kinds[i] != kind:
+                continue
+            size, mtime = snap.sizes[i], snap.mtimes[i]
+            if min_size is not None and size < min_size:
+                continue
+            if max_size is not None and size > max_size:
+                continue
+            if modified_after is not None and mtime < modified_after:
+                continue
+            if modified_before is not None and mtime > modified_before:
+                continue
+            if offset <= total < offset + limit:
+                page.append({"path": path, "is_dir": snap.kinds[i] == "d", "size": size, "mtime": mtime})
+            total += 1
+        return total, page
+
+FILE_INDEX = FileIndex()
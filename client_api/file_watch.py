@@ -0,0 +1,312 @@
+# file_watch.py
+import time
+import shlex
+import socket
+import posixpath
+import threading
+from helpers import SSHClient, logger
+
+WATCH_DEBOUNCE_SECONDS = 0.2  # Quiet time before a batch of events is pushed
+WATCH_MAX_DELAY_SECONDS = 1.0  # Longest an event waits while changes keep coming
+WATCH_POLL_SECONDS = 2.0  # Listing interval when inotify is not available
+WATCH_QUEUE_SIZE = 64  # Batches buffered per subscriber before it is told to re-list
+INOTIFY_EVENTS = "create,delete,modify,attrib,close_write,moved_from,moved_to,delete_self,move_self"
+
+# inotifywait in the background so closing our end of the channel (stdin) kills it,
+# while its own exit status (e.g. no inotify watches left) is still reported.
+INOTIFY_SCRIPT = """
+exec 3<&0
+inotifywait -m -q --format '%e %f' -e {events} -- {path} &
+pid=$!
+{{ read _ <&3; kill $pid; }} >/dev/null 2>&1 &
+wait $pid
+"""
+
+CREATED = "created"
+MODIFIED = "modified"
+DELETED = "deleted"
+RENAMED = "renamed"
+
+def _offer(queue, message):
+    # A subscriber that cannot keep up gets one overflow marker instead of an unbounded backlog.
+    # Messages that end a watch are kept, the client has to learn that it stopped.
+    if queue.full():
+        ended = []
+        while not queue.empty():
+            dropped = queue.get_nowait()
+            if dropped.get("stopped"):
+                ended.append(dropped)
+        overflow = {"path": message["path"], "overflow": True}
+        if message.get("stopped"):
+            overflow["stopped"] = True
+        for item in [overflow] + ended[:queue.maxsize - 1]:
+            queue.put_nowait(item)
+    else:
+        queue.put_nowait(message)
+
+class DirectoryWatch:
+    """
+    Watches one directory on the host and pushes debounced, coalesced event batches to its subscribers.
+    Uses inotifywait over SSH when available, otherwise diffs directory listings every WATCH_POLL_SECONDS.
+    """
+
+    def __init__(self, path, on_stop):
+        self.path = path
+        self.mode = None
+        self._on_stop = on_stop
+        self._lock = threading.Lock()
+        self._subscribers = set()  # (loop, queue)
+        self._pending = {}  # name -> event, in arrival order
+        self._moved_from = None  # (name, is_dir) waiting for its MOVED_TO
+        self._first_pending = None
+        self._last_event = None
+        self._channel = None
+        self._final = None  # Message that ends the watch, sent once it stopped
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    # === Subscribers ===
+    def add(self, subscriber):
+        with self._lock:
+            self._subscribers.add(subscriber)
+
+    def remove(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+            return len(self._subscribers)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        channel = self._channel
+        if channel is not None:
+            channel.close()
+
+    @property
+    def stopped(self):
+        return self._stopped.is_set()
+
+    def _publish(self, message):
+        message["path"] = self.path
+        message["mode"] = self.mode
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for loop, queue in subscribers:
+            try:
+                loop.call_soon_threadsafe(_offer, queue, message)
+            except RuntimeError:
+                # Subscriber's event loop is gone
+                self.remove((loop, queue))
+
+    # === Batching ===
+    def _add(self, kind, name, is_dir, old=None):
+        now = time.time()
+        if self._first_pending is None:
+            self._first_pending = now
+        self._last_event = now
+
+        previous = self._pending.get(name)
+        if kind == MODIFIED and previous:
+            return  # Already reported as created/modified/renamed in this batch
+        if kind == DELETED and previous and previous["type"] == CREATED:
+            del self._pending[name]
+            return
+        if kind == CREATED and previous and previous["type"] == DELETED:
+            kind = MODIFIED
+        if kind == RENAMED:
+            earlier = self._pending.pop(old, None)
+            if earlier and earlier["type"] == CREATED:
+                kind, old = CREATED, None  # Created and renamed within one batch
+            elif earlier and earlier["type"] == RENAMED:
+                old = posixpath.basename(earlier["from"])
+
+        event = {"type": kind, "path": posixpath.join(self.path, name), "is_dir": is_dir}
+        if old is not None:
+            event["from"] = posixpath.join(self.path, old)
+        self._pending.pop(name, None)
+        self._pending[name] = event
+
+    def _settle_move(self):
+        # A MOVED_FROM without a matching MOVED_TO was moved out of the directory
+        if self._moved_from:
+            name, is_dir = self._moved_from
+            self._moved_from = None
+            self._add(DELETED, name, is_dir)
+
+    def _flush(self, force=False):
+        if self._moved_from and (force or time.time() - self._last_event >= WATCH_DEBOUNCE_SECONDS):
+            self._settle_move()
+        if not self._pending:
+            self._first_pending = None
+            return
+        now = time.time()
+        quiet = now - self._last_event >= WATCH_DEBOUNCE_SECONDS
+        overdue = now - self._first_pending >= WATCH_MAX_DELAY_SECONDS
+        if force or quiet or overdue:
+            events = list(self._pending.values())
+            self._pending.clear()
+            self._first_pending = None
+            self._publish({"events": events})
+
+    # === Watching ===
+    def _run(self):
+        try:
+            with SSHClient() as ssh:
+                _, _, code = ssh.run_command("command -v inotifywait")
+                if code == 0 and self._watch_inotify(ssh):
+                    return
+                if not self.stopped:
+                    self._watch_poll(ssh)
+        except Exception as e:
+            logger.warning(f"Warning: watching {self.path} failed: {e}")
+            self._final = {"error": str(e)}
+        finally:
+            self._stopped.set()
+            self._on_stop(self)
+        # Only now, so a client subscribing again on it gets a new watch instead of this one
+        if self._final is not None:
+            self._flush(force=True)
+            self._publish({**self._final, "stopped": True})
+
+    def _watch_inotify(self, ssh):
+        """Returns False if inotify could not be used for this directory."""
+        self.mode = "inotify"
+        self._channel = channel = ssh.client.get_transport().open_session()
+        channel.settimeout(WATCH_DEBOUNCE_SECONDS)
+        channel.exec_command(INOTIFY_SCRIPT.format(events=INOTIFY_EVENTS, path=shlex.quote(self.path)))
+
+        buf = b""
+        while not self.stopped:
+            try:
+                chunk = channel.recv(65536)
+            except socket.timeout:
+                self._flush()
+                continue
+            if not chunk:
+                break
+            buf += chunk
+            *lines, buf = buf.split(b"\n")
+            for line in lines:
+                if self._handle_inotify(line.decode("utf-8", "surrogateescape")):
+                    channel.close()
+                    return True
+            self._flush()
+
+        if self.stopped:
+            return True
+        code = channel.recv_exit_status()
+        stderr = channel.recv_stderr(65536).decode(errors="replace").strip() if channel.recv_stderr_ready() else ""
+        channel.close()
+        logger.warning(f"Warning: inotify watch on {self.path} ended ({code}): {stderr}, polling instead")
+        return False
+
+    def _handle_inotify(self, line):
+        """Apply one inotifywait line, returns True once the directory itself is gone."""
+        flags, _, name = line.partition(" ")
+        flags = set(flags.split(","))
+        is_dir = "ISDIR" in flags
+        if flags & {"DELETE_SELF", "MOVE_SELF"}:
+            self._final = {"events": [{"type": DELETED, "path": self.path, "is_dir": True}]}
+            return True
+
+        if "MOVED_TO" not in flags:
+            self._settle_move()
+        if "MOVED_FROM" in flags:
+            self._moved_from = (name, is_dir)
+            self._last_event = time.time()
+        elif "MOVED_TO" in flags:
+            if self._moved_from:
+                old, _ = self._moved_from
+                self._moved_from = None
+                self._add(RENAMED, name, is_dir, old)
+            else:
+                self._add(CREATED, name, is_dir)
+        elif "CREATE" in flags:
+            self._add(CREATED, name, is_dir)
+        elif "DELETE" in flags:
+            self._add(DELETED, name, is_dir)
+        elif name:
+            self._add(MODIFIED, name, is_dir)
+        return False
+
+    def _list(self, ssh):
+        entries = {}
+        command = f"LC_ALL=C find {shlex.quote(self.path)} -mindepth 1 -maxdepth 1 -printf '%i %y %s %T@ %f\\0'"
+        for record in ssh.run_records(command):
+            inode, kind, size, mtime, name = record.split(" ", 4)
+            entries[name] = (inode, kind == "d", size, mtime)
+        return entries
+
+    def _watch_poll(self, ssh):
+        self.mode = "poll"
+        listing = self._list(ssh)
+        while not self._stopped.wait(WATCH_POLL_SECONDS):
+            try:
+                current = self._list(ssh)
+            except RuntimeError:
+                self._final = {"events": [{"type": DELETED, "path": self.path, "is_dir": True}]}
+                return
+
+            removed = {name: meta for name, meta in listing.items() if name not in current}
+            # Same inode, type, size and mtime under a new name is a rename; inodes alone get reused
+            moved = {meta: name for name, meta in removed.items()}
+            for name, meta in current.items():
+                old = listing.get(name)
+                if old is None:
+                    previous = moved.pop(meta, None)
+                    if previous is not None:
+                        del removed[previous]
+                        self._add(RENAMED, name, meta[1], previous)
+                    else:
+                        self._add(CREATED, name, meta[1])
+                elif old != meta:
+                    self._add(DELETED if old[1] != meta[1] else MODIFIED, name, meta[1])
+                    if old[1] != meta[1]:
+                        self._add(CREATED, name, meta[1])
+            for name, meta in removed.items():
+                self._add(DELETED, name, meta[1])
+            listing = current
+            self._flush(force=True)
+
+class WatchRegistry:
+    """
+    Shared directory watches: every directory is watched once, however many clients subscribe to it.
+    The watch stops when its last subscriber leaves.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._watches = {}  # path -> DirectoryWatch
+
+    def subscribe(self, path, subscriber):
+        with self._lock:
+            watch = self._watches.get(path)
+            if watch is None or watch.stopped:
+                watch = DirectoryWatch(path, self._stopped)
+                self._watches[path] = watch
+                watch.add(subscriber)
+                watch.start()
+            else:
+                watch.add(subscriber)
+
+    def unsubscribe(self, path, subscriber):
+        with self._lock:
+            watch = self._watches.get(path)
+            if watch is None or watch.remove(subscriber):
+                return
+            del self._watches[path]
+        watch.stop()
+
+    def _stopped(self, watch):
+        with self._lock:
+            if self._watches.get(watch.path) is watch:
+                del self._watches[watch.path]
+
+def normalize_watch_path(path: str) -> str:
+    if not path.startswith("/"):
+        raise ValueError(f"Watch path must be absolute: {path}")
+    return posixpath.normpath("/" + path.lstrip("/"))
+
+WATCHES = WatchRegistry()
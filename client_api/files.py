@@ -1,21 +1,48 @@
 import os
+import re
 import hmac
+import asyncio
+import json
 import stat
 import time
+import shlex
 import base64
+import codecs
 import hashlib
 import zipfile
+import posixpath
+import threading
+from collections import OrderedDict
 from io import BytesIO
 from urllib.parse import quote
-from fastapi import APIRouter, HTTPException, Query, UploadFile, File, Depends, Form
+from fastapi import APIRouter, HTTPException, Query, UploadFile, File, Depends, Form, Request, WebSocket, WebSocketDisconnect
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import StreamingResponse
-from pydantic import BaseModel
-from typing import List
-from helpers import ADMIN_ROLE, STAGE_DIR, SSHClient, logger
-from users import JWT_SECRET, get_current_user
+from starlette.requests import ClientDisconnect
+from pydantic import BaseModel, Field
+from typing import List, Literal, Optional
+from helpers import ADMIN_ROLE, STAGE_DIR, SSHClient, CommandError, logger
+from users import JWT_SECRET, get_current_user, get_current_user_manual
+from progress import PROGRESS, progress_event_stream
+from file_index import FILE_INDEX
+from archive_upload import ArchiveStream, extract_archive
+from file_watch import WATCHES, WATCH_QUEUE_SIZE, normalize_watch_path
+from delta_sync import SyncManifest, create_plan, receive_blocks, commit_session, delete_session
 
-upload_progress = {}
 EXPIRATION_SECONDS = 60
+MAX_BATCH_OPERATIONS = 1000
+PARALLEL_WORKERS = 4  # Parallel command streams used by /copy and /checksum
+PROGRESS_INTERVAL = 0.25  # Seconds between streamed progress events
+CHECKSUM_COMMANDS = {"sha256": "sha256sum", "blake2": "b2sum", "xxhash": "xxhsum"}
+CHECKSUM_CACHE_SIZE = 100000
+CHECKSUM_CACHE = OrderedDict()  # (algorithm, device, inode, size, mtime) -> digest
+CHECKSUM_CACHE_LOCK = threading.Lock()
+READ_MAX_BYTES = 1024 * 1024  # Largest range /read returns at once
+READ_BLOCK_BYTES = 64 * 1024
+READ_SAMPLE_BYTES = 8192  # Head of the file used to detect binary content / encoding
+FOLLOW_POLL_SECONDS = 0.5
+FOLLOW_MAX_SECONDS = 3600
+FIND_ERROR = re.compile(r"^find: (cannot delete )?'(.*)': (.*)$")
 router = APIRouter(tags=["Files"])
 
 class FileEntry(BaseModel):
@@ -24,6 +51,26 @@ class FileEntry(BaseModel):
     size: int
     mtime: int  # epoch seconds
 
+class BatchOperation(BaseModel):
+    op: Literal["mkdir", "rename", "move", "touch", "chmod", "chown", "symlink"]
+    path: str
+    dest: Optional[str] = None  # rename/move: new path (move into it if it is a directory)
+    target: Optional[str] = None  # symlink: what the link at `path` points to
+    mode: Optional[str] = None  # chmod: octal string, e.g. "755"
+    uid: Optional[int] = None  # chown: numeric ids, unset keeps the current owner/group
+    gid: Optional[int] = None
+
+class BatchRequest(BaseModel):
+    operations: List[BatchOperation] = Field(..., max_length=MAX_BATCH_OPERATIONS)
+    atomic: bool = False  # Stop at the first failure and undo the operations already applied
+
+class BatchResult(BaseModel):
+    index: int
+    op: str
+    path: str
+    status: Literal["ok", "error", "skipped", "rolled_back"]
+    error: Optional[str] = None
+
 def is_dir(sftp_attrs):
     if stat.S_ISDIR(sftp_attrs):
         return True
@@ -45,20 +92,479 @@ def verify_signature(path: str, expires: int, sig: str) -> bool:
     expected_b64 = base64.urlsafe_b64encode(expected_sig).decode()
     return hmac.compare_digest(expected_b64, sig)
 
-def delete_path_recursive(sftp, path: str):
+def upload_progress_key(upload_id: str) -> str:
+    return f"files:{upload_id}"
+
+def ndjson_response(events):
+    """
+    Stream an event generator as newline-delimited JSON.
+    The generator runs up to its first event first, so setup errors are still plain HTTP errors.
+    """
+    first = next(events)
+
+    def stream():
+        yield json.dumps(first) + "\n"
+        for event in events:
+            yield json.dumps(event) + "\n"
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+def bulk_delete(path: str, dry_run: bool = False, one_file_system: bool = False):
+    """
+    Recursively delete `path` on the host with a single `find -depth -delete`.
+
+    Yields dicts: a "started" event once the path is known to exist, periodic "progress"
+    events with running entry/byte totals, one "error" event for every entry that could
+    not be removed (the rest of the tree is still processed) and a final "complete" summary.
+    With `dry_run` nothing is removed and the totals are what would have been deleted.
+    """
+    if not path.startswith("/"):
+        # Also keeps find from reading a path like "-delete" as part of its expression
+        raise HTTPException(status_code=400, detail=f"Path must be absolute: {path}")
+    if posixpath.normpath(path) in ("/", "//"):
+        raise HTTPException(status_code=400, detail="Refusing to delete the root directory")
+
+    quoted = shlex.quote(path)
+    cmd = f"LC_ALL=C find {quoted} -depth"
+    if one_file_system:
+        cmd += " -xdev"
+    cmd += " -printf '%y %s %p\\0'"
+    if not dry_run:
+        cmd += " -delete"
+
+    with SSHClient() as ssh:
+        _, _, code = ssh.run_command(f"[ -e {quoted} ] || [ -L {quoted} ]")
+        if code != 0:
+            raise HTTPException(status_code=404, detail="Path not found")
+        yield {"event": "started", "path": path, "dry_run": dry_run}
+
+        channel = ssh.client.get_transport().open_session()
+        channel.exec_command(cmd)
+
+        entries = 0
+        total_bytes = 0
+        failed = 0
+        undeleted = 0  # Entries find printed but could not remove
+        out_buf = b""
+        err_buf = b""
+        last_report = time.time()
+
+        while True:
+            errors = []
+            while channel.recv_ready():
+                out_buf += channel.recv(65536)
+                *records, out_buf = out_buf.split(b"\0")
+                for record in records:
+                    kind, size, _ = record.decode("utf-8", errors="replace").split(" ", 2)
+                    entries += 1
+                    if kind != "d":
+                        total_bytes += int(size)
+
+            while channel.recv_stderr_ready():
+                err_buf += channel.recv_stderr(65536)
+                *lines, err_buf = err_buf.split(b"\n")
+                errors.extend(line.decode("utf-8", errors="replace") for line in lines if line)
+
+            finished = channel.exit_status_ready() and not channel.recv_ready() and not channel.recv_stderr_ready()
+            if finished and err_buf:
+                errors.append(err_buf.decode("utf-8", errors="replace"))
+
+            for line in errors:
+                failed += 1
+                match = FIND_ERROR.match(line)
+                if match:
+                    undeleted += bool(match.group(1))
+                    yield {"event": "error", "path": match.group(2), "error": match.group(3)}
+                else:
+                    yield {"event": "error", "path": None, "error": line}
+
+            if finished:
+                break
+
+            if time.time() - last_report >= PROGRESS_INTERVAL:
+                last_report = time.time()
+                yield {"event": "progress", "entries": entries, "bytes": total_bytes, "failed": failed}
+
+            time.sleep(0.05)  # small delay to avoid busy-wait
+
+        channel.recv_exit_status()
+
+    # Every entry is printed before find tries to delete it, failed ones are reported on stderr
+    yield {
+        "event": "complete",
+        "path": path,
+        "dry_run": dry_run,
+        "entries": entries - undeleted,
+        "bytes": total_bytes,
+        "failed": failed,
+    }
+
+# Copies one file per NUL-terminated relative path on stdin, answering "ok" or "error <msg>" for each.
+# GNU cp clones (reflink) or uses copy_file_range where the file system allows it and keeps holes.
+COPY_FILES_SCRIPT = r"""
+while IFS= read -r -d '' f; do
+    if err=$(cp --no-dereference --preserve=all --reflink=auto --sparse=auto -- "$SRC${f:+/$f}" "$DST${f:+/$f}" 2>&1); then
+        printf 'ok\0'
+    else
+        printf 'error %s\0' "$err"
+    fi
+done
+"""
+
+# Applies owner, mode and timestamps of every source directory on stdin to its copy
+COPY_DIR_METADATA_SCRIPT = r"""
+while IFS= read -r -d '' f; do
+    chown --reference="$SRC${f:+/$f}" "$DST${f:+/$f}"
+    chmod --reference="$SRC${f:+/$f}" "$DST${f:+/$f}"
+    touch --no-dereference -r "$SRC${f:+/$f}" "$DST${f:+/$f}"
+done
+true
+"""
+
+def copy_tree(src: str, dest: str, workers: int = PARALLEL_WORKERS):
+    """
+    Copy `src` (file or directory tree) to `dest` on the host, spreading the files over
+    `workers` parallel cp streams on one SSH connection.
+
+    Yields dicts like bulk_delete: "started" with the totals, periodic "progress", one "error"
+    per entry that failed to copy and a final "complete" summary.
+    """
+    src = src.rstrip("/") or "/"
+    dest = dest.rstrip("/")
+    if not dest:
+        raise HTTPException(status_code=400, detail="Invalid destination")
+    env = f"SRC={shlex.quote(src)} DST={shlex.quote(dest)}; export SRC DST;"
+
+    with SSHClient() as ssh:
+        _, _, code = ssh.run_command(f"[ -e {shlex.quote(src)} ]")
+        if code != 0:
+            raise HTTPException(status_code=404, detail="Source not found")
+        _, _, code = ssh.run_command(f"[ -e {shlex.quote(dest)} ] || [ -L {shlex.quote(dest)} ]")
+        if code == 0:
+            raise HTTPException(status_code=409, detail="Destination already exists")
+
+        # One find for the whole tree: type, size and path relative to src
+        dirs = []
+        files = []
+        try:
+            for record in ssh.run_records(f"find {shlex.quote(src)} -printf '%y %s %P\\0'"):
+                kind, size, rel = record.split(" ", 2)
+                if kind == "d":
+                    dirs.append(rel)
+                else:
+                    files.append((rel, int(size) if kind == "f" else 0))
+        except RuntimeError as e:
+            raise HTTPException(status_code=500, detail=f"Failed to scan source: {e}")
+
+        total_bytes = sum(size for _, size in files)
+        yield {"event": "started", "src": src, "dest": dest, "files": len(files), "dirs": len(dirs), "bytes": total_bytes}
+
+        if dirs:
+            try:
+                list(ssh.run_records(f"{env} mkdir -p \"$DST\" && cd \"$DST\" && xargs -0 -r mkdir -p --", [d for d in dirs if d]))
+            except RuntimeError as e:
+                raise HTTPException(status_code=500, detail=f"Failed to create directories: {e}")
+
+        copied = 0
+        copied_bytes = 0
+        failed = 0
+        last_report = time.time()
+        for item in ssh.run_parallel(env + COPY_FILES_SCRIPT, files, workers, timeout=PROGRESS_INTERVAL):
+            if item is not None:
+                (rel, size), result = item
+                if result == "ok":
+                    copied += 1
+                    copied_bytes += size
+                else:
+                    failed += 1
+                    path = posixpath.join(src, rel) if rel is not None else None
+                    yield {"event": "error", "path": path, "error": result[len("error "):].strip()}
+
+            if time.time() - last_report >= PROGRESS_INTERVAL:
+                last_report = time.time()
+                yield {"event": "progress", "files": copied, "bytes": copied_bytes, "failed": failed}
+
+        # Directory times change while files are added, so restore them last, deepest first
+        if dirs:
+            try:
+                list(ssh.run_records(env + COPY_DIR_METADATA_SCRIPT, reversed(dirs)))
+            except RuntimeError as e:
+                yield {"event": "error", "path": dest, "error": f"Failed to copy directory metadata: {e}"}
+
+    yield {
+        "event": "complete",
+        "src": src,
+        "dest": dest,
+        "files": copied,
+        "dirs": len(dirs),
+        "bytes": copied_bytes,
+        "failed": failed,
+    }
+
+# Hashes one file per NUL-terminated path on stdin with $HASH, answering "ok <digest>" or "error <msg>"
+CHECKSUM_FILES_SCRIPT = r"""
+while IFS= read -r -d '' f; do
+    if h=$($HASH 2>&1 < "$f"); then
+        printf 'ok %s\0' "${h%% *}"
+    else
+        printf 'error %s\0' "$h"
+    fi
+done
+"""
+
+def checksum_cache_get(key):
+    with CHECKSUM_CACHE_LOCK:
+        digest = CHECKSUM_CACHE.get(key)
+        if digest is not None:
+            CHECKSUM_CACHE.move_to_end(key)
+        return digest
+
+def checksum_cache_put(key, digest):
+    with CHECKSUM_CACHE_LOCK:
+        CHECKSUM_CACHE[key] = digest
+        CHECKSUM_CACHE.move_to_end(key)
+        while len(CHECKSUM_CACHE) > CHECKSUM_CACHE_SIZE:
+            CHECKSUM_CACHE.popitem(last=False)
+
+def compute_checksums(paths: List[str], algorithm: str = "sha256", workers: int = PARALLEL_WORKERS):
+    """
+    Hash files and directory trees on the host with its coreutils/xxhsum tools.
+
+    Digests are cached by (device, inode, size, mtime), so unchanged files are never read twice.
+    Files that still need hashing are spread over `workers` parallel streams.
+    A directory yields a manifest of every regular file below it.
+    """
+    command = CHECKSUM_COMMANDS.get(algorithm)
+    if command is None:
+        raise HTTPException(status_code=400, detail=f"Unsupported algorithm, use one of: {', '.join(CHECKSUM_COMMANDS)}")
+
+    results = []
+    pending = []  # (path, size) still to hash, each path once
+    queued = {}  # path -> its index in pending
+    files = []  # Per pending file: (manifest entries to fill in, cache key)
+    hashed = 0
+    cached = 0
+
+    with SSHClient() as ssh:
+        _, _, code = ssh.run_command(f"command -v {command}")
+        if code != 0:
+            raise HTTPException(status_code=400, detail=f"{command} is not available on the device")
+
+        for path in paths:
+            result = {"path": path}
+            results.append(result)
+            records = []
+            try:
+                for record in ssh.run_records(f"LC_ALL=C find -H {shlex.quote(path)} -printf '%y %D %i %s %T@ %P\\0'"):
+                    records.append(record)
+            except CommandError as e:
+                # find exits 1 when some of the tree could not be read, keep what it did list
+                if e.code != 1 or not records:
+                    result["error"] = str(e)
+                    continue
+                result["warning"] = str(e)
+
+            for record in records:
+                kind, device, inode, size, mtime, rel = record.split(" ", 5)
+                if not rel:
+                    result["type"] = "directory" if kind == "d" else "file"
+                if kind != "f":
+                    continue
+                full_path = posixpath.join(path, rel) if rel else path
+                if rel:
+                    entry = {"path": rel}
+                    result.setdefault("manifest", []).append(entry)
+                else:
+                    entry = result
+                key = (algorithm, device, inode, size, mtime)
+                entry.update(size=int(size), hash=checksum_cache_get(key))
+                if entry["hash"] is None:
+                    # The same file may be asked for twice, directly or through overlapping paths
+                    if full_path not in queued:
+                        queued[full_path] = len(pending)
+                        pending.append((full_path, int(size)))
+                        files.append(([], key))
+                    files[queued[full_path]][0].append(entry)
+                else:
+                    cached += 1
+
+            if result.get("type") == "directory":
+                manifest = result.setdefault("manifest", [])
+                manifest.sort(key=lambda e: e["path"])
+                result["files"] = len(manifest)
+                result["bytes"] = sum(e["size"] for e in manifest)
+
+        env = f"HASH={shlex.quote(command)};"
+        for item in ssh.run_parallel(env + CHECKSUM_FILES_SCRIPT, pending, workers):
+            if item is None:
+                continue
+            (full_path, _), answer = item
+            status, _, value = answer.partition(" ")
+            if full_path is None:
+                raise HTTPException(status_code=500, detail=f"Checksum worker failed: {value}")
+            entries, key = files[queued[full_path]]
+            if status == "ok":
+                checksum_cache_put(key, value)
+                hashed += 1
+            for entry in entries:
+                if status == "ok":
+                    entry["hash"] = value
+                else:
+                    entry["error"] = value.strip()
+
+    return {"algorithm": algorithm, "results": results, "hashed": hashed, "cached": cached}
+
+def detect_encoding(sample: bytes):
+    """
+    Guess the encoding of a file from its first bytes, None means binary.
+    UTF-16 counts as binary too: lines and byte ranges are cut at single newline bytes and
+    arbitrary offsets, which split its two-byte characters.
+    """
+    if sample.startswith((b"\xff\xfe", b"\xfe\xff")) or b"\0" in sample:
+        return None
+    try:
+        # The sample may end inside a multi-byte character
+        codecs.getincrementaldecoder("utf-8")().decode(sample, final=False)
+        return "utf-8"
+    except UnicodeDecodeError:
+        pass
+    control = sum(1 for b in sample if b < 32 and b not in (9, 10, 12, 13, 27))
+    if sample and control / len(sample) > 0.1:
+        return None
+    return "latin-1"
+
+def read_head_lines(f, size: int, start_line: int, lines: int):
+    """Return (start, data) holding `lines` lines from 1-based `start_line`, reading forward in blocks."""
+    f.seek(0)
+    pos = 0  # File offset of data[0]
+    data = b""
+    to_skip = start_line - 1
+    while block := f.read(READ_BLOCK_BYTES):
+        data += block
+        # Drop skipped lines as they arrive so memory stays bounded
+        start = 0
+        while to_skip:
+            cut = data.find(b"\n", start)
+            if cut == -1:
+                start = len(data)
+                break
+            start = cut + 1
+            to_skip -= 1
+        pos += start
+        data = data[start:]
+        if not to_skip and (data.count(b"\n") >= lines or len(data) >= READ_MAX_BYTES):
+            break
+
+    if to_skip:
+        return size, b""
+    cut = -1
+    for _ in range(lines):
+        cut = data.find(b"\n", cut + 1)
+        if cut == -1:
+            break
+    if cut != -1:
+        data = data[:cut + 1]
+    return pos, data[:READ_MAX_BYTES]
+
+def read_tail_lines(f, size: int, lines: int):
+    """Return (start, data) holding the last `lines` lines, seeking backwards from the end in blocks."""
+    pos = size
+    data = b""
+    # A trailing newline terminates the last line, it does not start a new one
+    wanted = lines + 1 if size else lines
+    while pos > 0 and len(data) < READ_MAX_BYTES:
+        step = min(READ_BLOCK_BYTES, pos)
+        pos -= step
+        f.seek(pos)
+        data = f.read(step) + data
+        if data.count(b"\n") >= wanted:
+            break
+
+    if not data.endswith(b"\n"):
+        wanted -= 1
+    cut = len(data)
+    for _ in range(wanted):
+        cut = data.rfind(b"\n", 0, cut)
+        if cut == -1:
+            break
+    if cut != -1 and wanted:
+        data = data[cut + 1:]
+    elif pos > 0 or len(data) > READ_MAX_BYTES:
+        data = data[-READ_MAX_BYTES:]
+    return size - len(data), data
+
+def sftp_exists(sftp, path: str):
     try:
-        attr = sftp.stat(path)
-        if attr.st_mode & 0o040000:  # Directory
-            for item in sftp.listdir_attr(path):
-                item_path = os.path.join(path, item.filename)
-                delete_path_recursive(sftp, item_path)
-            sftp.rmdir(path)
-        else:
-            sftp.remove(path)
+        return sftp.lstat(path)
     except FileNotFoundError:
-        raise HTTPException(status_code=404, detail="Path not found")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to delete path: {str(e)}")
+        return None
+
+def apply_batch_operation(sftp, op: BatchOperation):
+    """
+    Apply a single batch operation over an open SFTP session.
+    Returns a callable that reverts it, used by atomic batches.
+    """
+    if op.op == "mkdir":
+        # mkdir -p: create every missing component, undo removes them deepest first
+        created = []
+        current = "/" if op.path.startswith("/") else ""
+        for part in [p for p in op.path.split("/") if p]:
+            current = posixpath.join(current, part)
+            if sftp_exists(sftp, current) is None:
+                sftp.mkdir(current)
+                created.append(current)
+            elif not is_dir(sftp.stat(current).st_mode):
+                raise NotADirectoryError(f"Not a directory: {current}")
+
+        def undo():
+            for created_path in reversed(created):
+                sftp.rmdir(created_path)
+        return undo
+
+    if op.op in ("rename", "move"):
+        if not op.dest:
+            raise ValueError(f"{op.op} requires dest")
+        dest = op.dest
+        if op.op == "move":
+            if sftp_exists(sftp, dest) and is_dir(sftp.stat(dest).st_mode):
+                dest = posixpath.join(dest, posixpath.basename(op.path.rstrip("/")))
+        if sftp_exists(sftp, dest) is not None:
+            raise FileExistsError(f"Destination exists: {dest}")
+        sftp.rename(op.path, dest)
+        return lambda: sftp.rename(dest, op.path)
+
+    if op.op == "touch":
+        attrs = sftp_exists(sftp, op.path)
+        if attrs is None:
+            with sftp.file(op.path, mode="w") as f:
+                f.write("")
+            return lambda: sftp.remove(op.path)
+        sftp.utime(op.path, None)
+        return lambda: sftp.utime(op.path, (attrs.st_atime, attrs.st_mtime))
+
+    if op.op == "chmod":
+        if not op.mode:
+            raise ValueError("chmod requires mode")
+        attrs = sftp.stat(op.path)
+        sftp.chmod(op.path, int(op.mode, 8))
+        return lambda: sftp.chmod(op.path, stat.S_IMODE(attrs.st_mode))
+
+    if op.op == "chown":
+        if op.uid is None and op.gid is None:
+            raise ValueError("chown requires uid and/or gid")
+        attrs = sftp.stat(op.path)
+        uid = attrs.st_uid if op.uid is None else op.uid
+        gid = attrs.st_gid if op.gid is None else op.gid
+        sftp.chown(op.path, uid, gid)
+        return lambda: sftp.chown(op.path, attrs.st_uid, attrs.st_gid)
+
+    if op.op == "symlink":
+        if not op.target:
+            raise ValueError("symlink requires target")
+        sftp.symlink(op.target, op.path)
+        return lambda: sftp.remove(op.path)
+
+    raise ValueError(f"Unknown operation: {op.op}")
 
 @router.get("/list", response_model=List[FileEntry], dependencies=[Depends(get_current_user(ADMIN_ROLE))])
 def list_files(path: str = Query("/", description="Directory to list")):
@@ -83,6 +589,115 @@ def list_files(path: str = Query("/", description="Directory to list")):
         entries.sort(key=lambda e: (not e.is_dir, e.name.lower()))
         return entries
 
+@router.get("/search", dependencies=[Depends(get_current_user(ADMIN_ROLE))])
+def search_files(
+    q: Optional[str] = Query(None, description="Substring of the file name"),
+    glob: Optional[str] = Query(None, description="Glob on the file name, or on the full path if it contains '/'"),
+    under: Optional[str] = Query(None, description="Only return entries below this directory"),
+    type: Optional[Literal["file", "dir", "symlink"]] = Query(None),
+    min_size: Optional[int] = Query(None, ge=0),
+    max_size: Optional[int] = Query(None, ge=0),
+    modified_after: Optional[int] = Query(None, description="Epoch seconds"),
+    modified_before: Optional[int] = Query(None, description="Epoch seconds"),
+    case_sensitive: bool = Query(False),
+    offset: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=1000),
+):
+    """
+    Search the whole device file system through an in-memory filename index.
+    The first call builds the index, after that it is kept current in the background.
+    """
+    kinds = {"file": "f", "dir": "d", "symlink": "l"}
+    try:
+        total, results = FILE_INDEX.search(
+            q=q, glob=glob, under=under, kind=kinds.get(type),
+            min_size=min_size, max_size=max_size,
+            modified_after=modified_after, modified_before=modified_before,
+            case_sensitive=case_sensitive, offset=offset, limit=limit,
+        )
+    except RuntimeError as e:
+        raise HTTPException(status_code=500, detail=f"Failed to build file index: {e}")
+    except re.error as e:
+        raise HTTPException(status_code=400, detail=f"Invalid pattern: {e}")
+    return {"total": total, "offset": offset, "limit": limit, "results": results, "index": FILE_INDEX.status()}
+
+@router.post("/search/reindex", dependencies=[Depends(get_current_user(ADMIN_ROLE))])
+def reindex_files():
+    try:
+        FILE_INDEX.rebuild()
+    except RuntimeError as e:
+        raise HTTPException(status_code=500, detail=f"Failed to build file index: {e}")
+    return FILE_INDEX.status()
+
+@router.websocket("/watch")
+async def watch_directories(websocket: WebSocket):
+    """
+    Push create, modify, delete and rename events for the subscribed directories.
+    Directories are given as `path` query parameters and changed with
+    {"subscribe": [...]} / {"unsubscribe": [...]} messages. Each message sent is one
+    debounced batch {"path", "mode", "events"}, or {"path", "overflow": true} if the
+    client fell behind and should re-list. The last message of a watch that ended (its
+    directory deleted, or {"error"} when watching failed) carries "stopped": true; the
+    path may then be subscribed to again.
+    """
+    token = websocket.query_params.get("token")
+    if token is None:
+        await websocket.close(code=1008)
+        return
+
+    try:
+        get_current_user_manual(token, required_role=ADMIN_ROLE)
+    except HTTPException:
+        await websocket.close(code=1008)
+        return
+
+    await websocket.accept()
+
+    queue = asyncio.Queue(maxsize=WATCH_QUEUE_SIZE)
+    subscriber = (asyncio.get_running_loop(), queue)
+    watched = set()
+
+    async def update(subscribe=(), unsubscribe=()):
+        errors = []
+        for path in subscribe:
+            try:
+                path = normalize_watch_path(path)
+            except ValueError as e:
+                errors.append(str(e))
+                continue
+            if path not in watched:
+                watched.add(path)
+                WATCHES.subscribe(path, subscriber)
+        for path in unsubscribe:
+            try:
+                path = normalize_watch_path(path)
+            except ValueError:
+                continue
+            if path in watched:
+                watched.discard(path)
+                WATCHES.unsubscribe(path, subscriber)
+        await websocket.send_json({"subscribed": sorted(watched), "errors": errors})
+
+    async def sender():
+        while True:
+            message = await queue.get()
+            if message.get("stopped"):
+                watched.discard(message["path"])
+            await websocket.send_json(message)
+
+    sending = asyncio.create_task(sender())
+    try:
+        await update(subscribe=websocket.query_params.getlist("path"))
+        while True:
+            message = await websocket.receive_json()
+            await update(message.get("subscribe", []), message.get("unsubscribe", []))
+    except (WebSocketDisconnect, ValueError, AttributeError):
+        pass
+    finally:
+        sending.cancel()
+        for path in watched:
+            WATCHES.unsubscribe(path, subscriber)
+
 @router.get("/download-url", dependencies=[Depends(get_current_user(ADMIN_ROLE))])
 def get_signed_url(path: str):
     return {"url": create_signed_url(path)}
@@ -200,6 +815,225 @@ def new_file(
         finally:
             sftp.close()
 
+@router.post("/batch", dependencies=[Depends(get_current_user(ADMIN_ROLE))])
+def batch_operations(request: BatchRequest):
+    """
+    Run an ordered list of file operations over one SSH connection and SFTP session.
+    Every operation gets a result. In atomic mode the batch stops at the first failure
+    and the operations already applied are reverted in reverse order (best effort).
+    """
+    results = []
+    undo_stack = []
+    failed = False
+
+    with SSHClient() as ssh:
+        sftp = ssh.open_sftp()
+        try:
+            for index, op in enumerate(request.operations):
+                if failed and request.atomic:
+                    results.append(BatchResult(index=index, op=op.op, path=op.path, status="skipped"))
+                    continue
+                try:
+                    undo_stack.append((index, apply_batch_operation(sftp, op)))
+                    results.append(BatchResult(index=index, op=op.op, path=op.path, status="ok"))
+                except Exception as e:
+                    failed = True
+                    results.append(BatchResult(index=index, op=op.op, path=op.path, status="error", error=str(e) or type(e).__name__))
+
+            if failed and request.atomic:
+                for index, undo in reversed(undo_stack):
+                    try:
+                        undo()
+                        results[index].status = "rolled_back"
+                    except Exception as e:
+                        logger.warning(f"Warning: failed to roll back batch operation {index}: {e}")
+                        results[index].error = f"Rollback failed: {e}"
+        finally:
+            sftp.close()
+
+    return {
+        "results": results,
+        "succeeded": sum(r.status == "ok" for r in results),
+        "failed": sum(r.status == "error" for r in results),
+        "rolled_back": failed and request.atomic,
+    }
+
+@router.post("/copy", dependencies=[Depends(get_current_user(ADMIN_ROLE))])
+def copy_path(
+    src: str = Query(..., description="File or folder to copy"),
+    dest: str = Query(..., description="New path for the copy, must not exist"),
+    workers: int = Query(PARALLEL_WORKERS, ge=1, le=16, description="Parallel copy streams"),
+):
+    """
+    Copy a file or folder tree on the device, keeping ownership, modes, timestamps and holes.
+    Uses reflinks/copy_file_range where the file system supports them.
+    Progress is streamed as newline-delimited JSON.
+    """
+    return ndjson_response(copy_tree(src, dest, workers=workers))
+
+@router.get("/checksum", dependencies=[Depends(get_current_user(ADMIN_ROLE))])
+def checksum(
+    path: List[str] = Query(..., description="Files or folders to hash, repeatable"),
+    algorithm: Literal["sha256", "blake2", "xxhash"] = Query("sha256"),
+    workers: int = Query(PARALLEL_WORKERS, ge=1, le=16, description="Parallel hash streams"),
+):
+    """
+    Compute checksums on the device to verify transfers without downloading them again.
+    Folders return a manifest of every file below them.
+    """
+    return compute_checksums(path, algorithm=algorithm, workers=workers)
+
+@router.get("/read", dependencies=[Depends(get_current_user(ADMIN_ROLE))])
+def read_file(
+    path: str = Query(...),
+    mode: Literal["bytes", "head", "tail"] = Query("tail"),
+    offset: int = Query(0, description="bytes: start offset, negative counts from the end"),
+    length: int = Query(65536, ge=1, le=READ_MAX_BYTES, description="bytes: number of bytes"),
+    lines: int = Query(100, ge=1, le=100000, description="head/tail: number of lines"),
+    start_line: int = Query(1, ge=1, description="head: first line to return"),
+):
+    """
+    Return part of a text file without transferring the whole file: a byte range,
+    lines from the start or the last lines. Binary files are refused after a small sample.
+    """
+    with SSHClient() as ssh:
+        sftp = ssh.open_sftp()
+        try:
+            try:
+                attrs = sftp.stat(path)
+            except FileNotFoundError:
+                raise HTTPException(status_code=404, detail="File not found")
+            if is_dir(attrs.st_mode):
+                raise HTTPException(status_code=400, detail="Path is a directory")
+
+            size = attrs.st_size
+            with sftp.open(path, "rb") as f:
+                encoding = detect_encoding(f.read(READ_SAMPLE_BYTES))
+                if encoding is None:
+                    raise HTTPException(status_code=415, detail="File looks binary")
+
+                if mode == "bytes":
+                    start = max(0, size + offset) if offset < 0 else min(offset, size)
+                    f.seek(start)
+                    data = f.read(min(length, size - start))
+                elif mode == "head":
+                    start, data = read_head_lines(f, size, start_line, lines)
+                else:
+                    start, data = read_tail_lines(f, size, lines)
+        finally:
+            sftp.close()
+
+    end = start + len(data)
+    return {
+        "path": path,
+        "size": size,
+        "mtime": int(attrs.st_mtime),
+        "encoding": encoding,
+        "start": start,
+        "end": end,
+        "eof": end >= size,
+        "text": data.decode(encoding, errors="replace"),
+    }
+
+@router.get("/read/follow")
+def follow_file(
+    path: str = Query(...),
+    token: str = Query(...),
+    lines: int = Query(10, ge=0, le=10000, description="Lines of history to send first"),
+):
+    """
+    Server-Sent Events stream of a growing file, like `tail -f`.
+    Sends the last `lines` lines, then every appended chunk. Truncation restarts from the beginning.
+    Authenticated with a `token` query parameter since EventSource cannot send headers.
+    """
+    get_current_user_manual(token, required_role=ADMIN_ROLE)
+
+    ssh = SSHClient()
+    ssh.connect()
+    try:
+        sftp = ssh.open_sftp()
+        attrs = sftp.stat(path)
+        if is_dir(attrs.st_mode):
+            raise HTTPException(status_code=400, detail="Path is a directory")
+        f = sftp.open(path, "rb")
+        encoding = detect_encoding(f.read(READ_SAMPLE_BYTES))
+        if encoding is None:
+            raise HTTPException(status_code=415, detail="File looks binary")
+    except FileNotFoundError:
+        ssh.close()
+        raise HTTPException(status_code=404, detail="File not found")
+    except Exception:
+        ssh.close()
+        raise
+
+    def event(name, payload):
+        return f"event: {name}\ndata: {json.dumps(payload)}\n\n"
+
+    def stream():
+        decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+        try:
+            size = attrs.st_size
+            if lines:
+                _, data = read_tail_lines(f, size, lines)
+                yield event("data", {"text": decoder.decode(data)})
+            pos = size
+            deadline = time.time() + FOLLOW_MAX_SECONDS
+            last_ping = time.time()
+
+            while time.time() < deadline:
+                size = sftp.stat(path).st_size
+                if size < pos:
+                    pos = 0
+                    decoder.reset()
+                    yield event("truncated", {"size": size})
+                while pos < size:
+                    f.seek(pos)
+                    data = f.read(min(READ_BLOCK_BYTES, size - pos))
+                    if not data:
+                        break
+                    pos += len(data)
+                    yield event("data", {"text": decoder.decode(data)})
+                if time.time() - last_ping > 15:
+                    last_ping = time.time()
+                    yield ": keep-alive\n\n"
+                time.sleep(FOLLOW_POLL_SECONDS)
+        except FileNotFoundError:
+            yield event("deleted", {})
+        finally:
+            f.close()
+            ssh.close()
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return StreamingResponse(stream(), media_type="text/event-stream", headers=headers)
+
+@router.post("/sync/plan", dependencies=[Depends(get_current_user(ADMIN_ROLE))])
+def sync_plan(manifest: SyncManifest):
+    """
+    Delta sync, step 1: send a manifest of relative paths, sizes and per-block sha256 digests.
+    The reply lists the blocks the device does not have yet, in the order they must be uploaded.
+    """
+    return create_plan(manifest)
+
+@router.post("/sync/{session_id}/blocks", dependencies=[Depends(get_current_user(ADMIN_ROLE))])
+def sync_blocks(session_id: str, blocks: UploadFile = File(...)):
+    """
+    Delta sync, step 2: upload the needed blocks concatenated in plan order.
+    May be split over several requests, each continues where the last one stopped.
+    """
+    return receive_blocks(session_id, blocks.file)
+
+@router.post("/sync/{session_id}/commit", dependencies=[Depends(get_current_user(ADMIN_ROLE))])
+def sync_commit(session_id: str):
+    """
+    Delta sync, step 3: rebuild the changed files from device and uploaded blocks and move them into place.
+    """
+    return commit_session(session_id)
+
+@router.delete("/sync/{session_id}", dependencies=[Depends(get_current_user(ADMIN_ROLE))])
+def sync_abort(session_id: str):
+    delete_session(session_id)
+    return {"detail": f"Sync session {session_id} removed"}
+
 @router.post("/upload", dependencies=[Depends(get_current_user(ADMIN_ROLE))])
 def upload_file(
     path: str = Query(...),
@@ -213,39 +1047,140 @@ def upload_file(
     total_size = upload.file.tell()
     upload.file.seek(0)
 
+    key = upload_progress_key(upload_id)
+    PROGRESS.start(key, phase="writing", total=total_size, filename=upload.filename)
+
     bytes_written = 0
-    with open(temp_path, "wb") as f:
-        while chunk := upload.file.read(32768):
-            f.write(chunk)
-            bytes_written += len(chunk)
-            upload_progress[upload_id] = int((bytes_written / total_size) * 100)
+    try:
+        with open(temp_path, "wb") as f:
+            while chunk := upload.file.read(32768):
+                f.write(chunk)
+                bytes_written += len(chunk)
+                PROGRESS.update(key, done=bytes_written)
 
-    # Move file into final host location using SSH context
-    with SSHClient() as ssh:
-        cmd = f"mv '{temp_path}' '{path.rstrip('/')}/{upload.filename}'"
-        _, stderr, code = ssh.run_command(cmd)
-        if code != 0:
-            raise HTTPException(
-                status_code=500,
-                detail=f"Failed to move file to {path}: {stderr.strip()}",
-            )
+        # Move file into final host location using SSH context
+        PROGRESS.phase(key, "moving")
+        with SSHClient() as ssh:
+            cmd = f"mv '{temp_path}' '{path.rstrip('/')}/{upload.filename}'"
+            _, stderr, code = ssh.run_command(cmd)
+            if code != 0:
+                raise HTTPException(
+                    status_code=500,
+                    detail=f"Failed to move file to {path}: {stderr.strip()}",
+                )
+    except Exception as e:
+        # Otherwise the entry stays "running" and the UI keeps polling a dead upload
+        PROGRESS.fail(key, e.detail if isinstance(e, HTTPException) else e)
+        raise
 
-    upload_progress[upload_id] = 100
+    PROGRESS.finish(key)
     return {"upload_id": upload_id}
 
+@router.post("/upload-archive", dependencies=[Depends(get_current_user(ADMIN_ROLE))])
+async def upload_archive(
+    request: Request,
+    path: str = Query(..., description="Directory to extract into, created if missing"),
+    upload_id: str = Query(...),
+    format: Literal["auto", "tar", "tar.gz", "tar.zst", "zip"] = Query("auto"),
+):
+    """
+    Upload a whole directory as one tar, tar.gz, tar.zst or zip request body and extract it on the fly.
+    Progress is reported under `upload_id` with the number of extracted entries.
+    """
+    total = request.headers.get("content-length")
+    key = upload_progress_key(upload_id)
+    PROGRESS.start(key, phase="extracting", total=int(total) if total else None, entries=0)
+
+    stream = ArchiveStream()
+    extraction = asyncio.get_running_loop().run_in_executor(None, extract_archive, stream, path, format, key)
+    interrupted = None
+    try:
+        async for chunk in request.stream():
+            if not await run_in_threadpool(stream.feed, chunk):
+                break  # Extraction stopped, its error is raised below
+    except Exception as e:
+        interrupted = e  # E.g. ClientDisconnect
+    finally:
+        await run_in_threadpool(stream.feed, None)
+
+    if interrupted is not None:
+        try:
+            await extraction  # Fails on the truncated archive, the interrupted upload is what to report
+        except Exception:
+            pass
+        reason = "the client disconnected" if isinstance(interrupted, ClientDisconnect) else str(interrupted)
+        PROGRESS.fail(key, f"Upload interrupted: {reason}")
+        raise interrupted
+
+    try:
+        result = await extraction
+    except ValueError as e:
+        PROGRESS.fail(key, e)
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        PROGRESS.fail(key, e)
+        raise HTTPException(status_code=500, detail=f"Failed to extract archive into {path}: {e}")
+
+    PROGRESS.finish(key, entries=result["entries"])
+    return {"upload_id": upload_id, **result}
+
 @router.get("/upload-progress")
 def get_upload_progress(upload_id: str):
-    progress = upload_progress.get(upload_id, 0)
-    return {"progress": progress}
+    snapshot = PROGRESS.get(upload_progress_key(upload_id))
+    if snapshot is None:
+        return {"progress": 0}
+
+    # Writing to the stage dir counts for the whole bar, the final move is reported as 99%
+    progress = snapshot["percent"] or 0
+    if snapshot["phase"] == "moving":
+        progress = 99
+    return {
+        "progress": progress,
+        "phase": snapshot["phase"],
+        "status": snapshot["status"],
+        "rate_bps": snapshot["rate_bps"],
+        "eta_secs": snapshot["eta_secs"],
+        "error": snapshot["error"],
+    }
+
+@router.get("/upload-progress/stream")
+def stream_upload_progress(upload_id: str, token: str = Query(...)):
+    """
+    Server-Sent Events stream of upload progress, pushed as it changes.
+    Authenticated with a `token` query parameter since EventSource cannot send headers.
+    """
+    get_current_user_manual(token, required_role=ADMIN_ROLE)
+    return progress_event_stream(PROGRESS, upload_progress_key(upload_id))
 
 @router.post("/delete", dependencies=[Depends(get_current_user(ADMIN_ROLE))])
 def delete_file(
-    path: str = Query(..., description="Remote file or folder to delete")
+    path: str = Query(..., description="Remote file or folder to delete"),
+    one_file_system: bool = Query(False, description="Do not descend into other mounted file systems"),
 ):
-    with SSHClient() as ssh:
-        sftp = ssh.open_sftp()
-        try:
-            delete_path_recursive(sftp, path)
-            return {"detail": f"Deleted: {path}"}
-        finally:
-            sftp.close()
+    failures = []
+    summary = {}
+    for event in bulk_delete(path, one_file_system=one_file_system):
+        if event["event"] == "error":
+            failures.append(event)
+        elif event["event"] == "complete":
+            summary = event
+
+    if failures:
+        first = "; ".join(f"{f['path'] or path}: {f['error']}" for f in failures[:5])
+        raise HTTPException(
+            status_code=500,
+            detail=f"Failed to delete {len(failures)} entries under {path}: {first}",
+        )
+    return {"detail": f"Deleted: {path}", "entries": summary["entries"], "bytes": summary["bytes"]}
+
+@router.post("/delete/stream", dependencies=[Depends(get_current_user(ADMIN_ROLE))])
+def delete_file_stream(
+    path: str = Query(..., description="Remote file or folder to delete"),
+    dry_run: bool = Query(False, description="Only count what would be deleted"),
+    one_file_system: bool = Query(False, description="Do not descend into other mounted file systems"),
+):
+    """
+    Delete a file or folder tree on the host in one operation and stream progress as
+    newline-delimited JSON. Failing entries are reported individually, the rest is still removed.
+    """
+    return ndjson_response(bulk_delete(path, dry_run=dry_run, one_file_system=one_file_system))
@@ -1,9 +1,11 @@
 import os
 import re
 import sys
+import queue
 import shutil
 import logging
 import paramiko
+import threading
 from pathlib import Path
 
 ADMIN_ROLE = "admin"
@@ -12,19 +14,19 @@ KEY = paramiko.RSAKey.from_private_key_file("/root/.ssh/id_rsa")
 ANSI_ESCAPE = re.compile(r"\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])")
 DEVICE_DIR = Path("/etc/device.d")
 DEVICE_TOKEN_FILE = Path(f"{DEVICE_DIR}/iot_token.txt")
-CURRENT_DIR = Path(f"{DEVICE_DIR}/current") # Contains all code and tools associated with the current software
+CURRENT_DIR = Path(f"{DEVICE_DIR}/current") # Contains all code and tools associated with the current software, links to the active slot
+SLOTS_DIR = Path(f"{DEVICE_DIR}/slots") # A/B slots, an update is installed into the inactive one
+SLOTS = ("a", "b")
 CURRENT_STATE_FILE = Path(f"{CURRENT_DIR}/.state")
 CURRENT_VERSION_FILE = Path(f"{CURRENT_DIR}/.version")
 CURRENT_OVERRIDE_SCRIPT_PATH = Path(f"{CURRENT_DIR}/override.sh")
-BACKUP_DIR = Path(f"{DEVICE_DIR}/backup") # Used to preserve the current system state in case an update fails
-BACKUP_STATE_FILE = Path(f"{BACKUP_DIR}/.state")
-BACKUP_VERSION_FILE = Path(f"{BACKUP_DIR}/.version")
-BACKUP_OVERRIDE_SCRIPT_PATH = Path(f"{BACKUP_DIR}/override.sh")
+BACKUP_DIR = Path(f"{DEVICE_DIR}/backup") # Snapshots of previously installed versions, see backups.py
 STAGE_DIR = Path(f"{DEVICE_DIR}/stage") # Used to upload/store update bundles
 STAGE_VERSION_FILE = Path(f"{STAGE_DIR}/.version")
-os.makedirs(CURRENT_DIR, exist_ok=True)
 os.makedirs(BACKUP_DIR, exist_ok=True)
 os.makedirs(STAGE_DIR, exist_ok=True)
+# Keeps the project name (and with it volume names) the same whichever slot is active
+COMPOSE_COMMAND = f"docker-compose --project-directory {CURRENT_DIR}"
 
 logging.basicConfig(
     level=logging.INFO,
@@ -40,28 +42,52 @@ def clean_ansi_and_whitespace(s: str) -> str:
     clean_str = ANSI_ESCAPE.sub("", s)
     return "\n".join(line.rstrip() for line in clean_str.splitlines())
 
-def clear_current_dir():
-    shutil.rmtree(CURRENT_DIR)
-    os.makedirs(CURRENT_DIR)
+def init_slots():
+    """Create the slots and turn a CURRENT_DIR from before A/B slots into slot a."""
+    for slot in SLOTS:
+        os.makedirs(SLOTS_DIR / slot, exist_ok=True)
+    if CURRENT_DIR.is_symlink():
+        return
+    if CURRENT_DIR.exists():
+        shutil.rmtree(SLOTS_DIR / SLOTS[0])
+        os.rename(CURRENT_DIR, SLOTS_DIR / SLOTS[0])
+    os.symlink(f"{SLOTS_DIR.name}/{SLOTS[0]}", CURRENT_DIR)
 
-def clear_backup_dir():
-    shutil.rmtree(BACKUP_DIR)
-    os.makedirs(BACKUP_DIR)
+def slot_dir(slot: str) -> Path:
+    return SLOTS_DIR / slot
+
+def active_slot() -> str:
+    return os.path.basename(os.readlink(CURRENT_DIR))
+
+def inactive_slot() -> str:
+    active = active_slot()
+    return next(slot for slot in SLOTS if slot != active)
+
+def switch_slot(slot: str):
+    """Point CURRENT_DIR at `slot`. Renaming a new link over the old one is atomic."""
+    link = Path(f"{DEVICE_DIR}/.current.tmp")
+    if os.path.lexists(link):
+        link.unlink()
+    os.symlink(f"{SLOTS_DIR.name}/{slot}", link)
+    os.replace(link, CURRENT_DIR)
+
+def clear_slot(slot: str):
+    shutil.rmtree(slot_dir(slot))
+    os.makedirs(slot_dir(slot))
+
+def get_slot_version(slot: str):
+    version_file = slot_dir(slot) / ".version"
+    if version_file.exists():
+        with open(version_file, "r") as f:
+            return f.readline().strip()
+    return None
+
+init_slots()
 
 def clear_stage_dir():
     shutil.rmtree(STAGE_DIR)
     os.makedirs(STAGE_DIR)
 
-def create_backup():
-    clear_backup_dir()
-    for item in os.listdir(CURRENT_DIR):
-        source = os.path.join(CURRENT_DIR, item)
-        destination = os.path.join(BACKUP_DIR, item)
-        if os.path.isdir(source):
-            shutil.copytree(source, destination, dirs_exist_ok=True)
-        else:
-            shutil.copy2(source, destination)
-
 def get_device_token():
     if DEVICE_TOKEN_FILE.exists():
         with open(DEVICE_TOKEN_FILE, "r") as f:
@@ -80,6 +106,13 @@ def get_stage_version():
             return f.readline().strip()
     return "Unknown"
 
+class CommandError(RuntimeError):
+    """A remote command exited non-zero. `code` is its exit status, the message its stderr."""
+
+    def __init__(self, message, code):
+        super().__init__(message)
+        self.code = code
+
 class SSHClient:
     def __init__(self):
         """
@@ -120,6 +153,110 @@ class SSHClient:
         exit_status = stdout.channel.recv_exit_status()
         return stdout.read().decode(), stderr.read().decode(), exit_status
 
+    def run_records(self, command, records=None, sep=b"\0"):
+        """
+        Run `command` on the host and yield its stdout split on `sep` as it arrives.
+        If `records` is given they are written to the command's stdin, `sep` terminated.
+        Raises CommandError with the command's stderr and exit status if it exits non-zero,
+        after everything it printed has been yielded.
+        """
+        if not self.client:
+            raise RuntimeError("SSH client not connected. Call connect() first.")
+
+        channel = self.client.get_transport().open_session()
+        channel.exec_command(command)
+
+        if records is not None:
+            def feed():
+                try:
+                    for record in records:
+                        channel.sendall(record.encode("utf-8", "surrogateescape") + sep)
+                except Exception as e:
+                    logger.warning(f"Warning: failed to feed remote command: {e}")
+                finally:
+                    channel.shutdown_write()
+            # Feed from a separate thread so a large input cannot deadlock against our reads
+            threading.Thread(target=feed, daemon=True).start()
+
+        stderr = bytearray()
+        def drain():
+            # Read stderr as it comes, a full stderr window would block the command and so its stdout
+            while chunk := channel.recv_stderr(65536):
+                stderr.extend(chunk)
+                del stderr[:-65536]
+        drainer = threading.Thread(target=drain, daemon=True)
+        drainer.start()
+
+        try:
+            buf = b""
+            while chunk := channel.recv(65536):
+                buf += chunk
+                *items, buf = buf.split(sep)
+                for item in items:
+                    yield item.decode("utf-8", "surrogateescape")
+            if buf:
+                yield buf.decode("utf-8", "surrogateescape")
+
+            code = channel.recv_exit_status()
+            drainer.join(timeout=self.timeout)
+            if code != 0:
+                raise CommandError(bytes(stderr).decode(errors="replace").strip() or f"Command exited with code {code}", code)
+        finally:
+            # Also when the caller stops early
+            channel.close()
+
+    def run_parallel(self, command, items, workers, timeout=0.25):
+        """
+        Run `command` on `workers` channels of one SSH connection and spread `items` over them.
+        Items are (record, weight) pairs, balanced by weight; `command` must answer each NUL-terminated
+        record on its stdin with one NUL-terminated result, in order.
+
+        Yields (item, result) as results arrive, ((None, 0), "error <msg>") if a worker fails,
+        and None whenever nothing arrived for `timeout` seconds so callers can report progress.
+        """
+        # Heaviest first onto the least loaded worker keeps the streams balanced
+        buckets = [[] for _ in range(max(1, min(workers, len(items))))]
+        loads = [0] * len(buckets)
+        for item in sorted(items, key=lambda i: i[1], reverse=True):
+            i = loads.index(min(loads))
+            buckets[i].append(item)
+            loads[i] += item[1]
+
+        results = queue.Queue()
+
+        def worker(bucket):
+            answers = self.run_records(command, [record for record, _ in bucket])
+            try:
+                # Run to the end so the exit status is checked, extra results are an error too
+                count = 0
+                for result in answers:
+                    if count < len(bucket):
+                        results.put((bucket[count], result))
+                    count += 1
+                if count != len(bucket):
+                    results.put(((None, 0), f"error Expected {len(bucket)} results, got {count}"))
+            except Exception as e:
+                results.put(((None, 0), f"error {e}"))
+            finally:
+                answers.close()
+                results.put(None)
+
+        threads = [threading.Thread(target=worker, args=(bucket,), daemon=True) for bucket in buckets if bucket]
+        for thread in threads:
+            thread.start()
+
+        running = len(threads)
+        while running:
+            try:
+                result = results.get(timeout=timeout)
+            except queue.Empty:
+                yield None
+                continue
+            if result is None:
+                running -= 1
+            else:
+                yield result
+
     def start_interactive_shell(self, term="xterm"):
         """
         Start an interactive shell session (for WebSocket streaming).
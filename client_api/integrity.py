@@ -0,0 +1,135 @@
+# integrity.py
+import os
+import stat
+import time
+import posixpath
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from update_delta import file_sha256
+
+INTEGRITY_MANIFEST = "SHA256SUMS"  # `sha256sum` output for the bundle's files, paths relative to its root
+VERIFY_WORKERS = os.cpu_count() or 1
+VERIFY_MAX_REPORTED = 50  # Paths listed per kind of problem, the counts are always complete
+NOT_HASHED = {INTEGRITY_MANIFEST, ".image_tags"}  # Top level files the bundle cannot list (written on the device)
+HEX_DIGITS = set("0123456789abcdefABCDEF")
+SUM_ESCAPES = {"\\": "\\", "n": "\n", "r": "\r"}
+
+class IntegrityError(Exception):
+    pass
+
+def unescape_path(path):
+    """Undo the escaping `sha256sum` applies to names with a backslash or line break ("\\\\", "\\n", "\\r")."""
+    out, chars = [], iter(path)
+    for char in chars:
+        if char != "\\":
+            out.append(char)
+            continue
+        escaped = next(chars, "")
+        if escaped not in SUM_ESCAPES:
+            raise ValueError(path)
+        out.append(SUM_ESCAPES[escaped])
+    return "".join(out)
+
+def parse_integrity_manifest(text):
+    """
+    {path: sha256} from `sha256sum` output, in text ("<hash>  <path>") or binary ("<hash> *<path>") mode.
+    Lines starting with a backslash carry an escaped path.
+    """
+    files = {}
+    for number, line in enumerate(text.split("\n"), 1):
+        line = line.removesuffix("\r")
+        if not line.strip() or line.startswith("#"):
+            continue
+        escaped = line.startswith("\\")
+        digest, _, path = line[escaped:].partition(" ")
+        if len(digest) != 64 or not set(digest) <= HEX_DIGITS or path[:1] not in (" ", "*") or not path[1:]:
+            raise IntegrityError(f"{INTEGRITY_MANIFEST} line {number} is not '<sha256>  <path>'")
+        path = path[1:]
+        if escaped:
+            try:
+                path = unescape_path(path)
+            except ValueError:
+                raise IntegrityError(f"{INTEGRITY_MANIFEST} line {number}: invalid escape in path")
+        path = posixpath.normpath(path)
+        if path.startswith("/") or path == ".." or path.startswith("../"):
+            raise IntegrityError(f"{INTEGRITY_MANIFEST} line {number}: path escapes the bundle: {path}")
+        files[path] = digest.lower()
+    if not files:
+        raise IntegrityError(f"{INTEGRITY_MANIFEST} lists no files")
+    return files
+
+def read_integrity_manifest(root: Path):
+    """The manifest at the top of `root`, None if the bundle did not carry one."""
+    try:
+        with open(root / INTEGRITY_MANIFEST, "r", encoding="utf-8", newline="") as f:
+            return parse_integrity_manifest(f.read())
+    except FileNotFoundError:
+        return None
+    except (OSError, UnicodeDecodeError) as e:
+        raise IntegrityError(f"Could not read {INTEGRITY_MANIFEST}: {e}")
+
+def _unlisted(root: Path, files: dict):
+    unlisted = []
+    for current, dirs, names in os.walk(root):
+        relative = Path(current).relative_to(root).as_posix()
+        for name in names:
+            path = name if relative == "." else f"{relative}/{name}"
+            if path not in files and path not in NOT_HASHED:
+                unlisted.append(path)
+    return unlisted
+
+def verify_tree(root: Path, files: dict, workers=VERIFY_WORKERS, check_cancel=None, on_progress=None):
+    """
+    Hash every file `files` lists under `root` on a pool of `workers` threads (hashlib releases the
+    GIL, so they run on separate cores) and compare. Biggest files go first so no worker is left
+    with one large image at the end. `on_progress(done_bytes, total_bytes)` is called from the workers.
+    """
+    started = time.time()
+    root = Path(root)
+    sizes, missing = {}, []
+    for path in files:
+        try:
+            st = (root / path).stat()
+        except OSError:
+            st = None
+        if st is None or not stat.S_ISREG(st.st_mode):
+            missing.append(path)
+            continue
+        sizes[path] = st.st_size
+    total = sum(sizes.values())
+    done = 0
+    lock = threading.Lock()
+
+    def check(path):
+        nonlocal done
+        if check_cancel:
+            check_cancel()
+        try:
+            digest = file_sha256(root / path, check_cancel)
+        except OSError:
+            digest = None
+        with lock:
+            done += sizes[path]
+            if on_progress:
+                on_progress(done, total)
+        return path, digest
+
+    mismatched = []
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="verify") as pool:
+        for path, digest in pool.map(check, sorted(sizes, key=sizes.get, reverse=True)):
+            if digest != files[path]:
+                mismatched.append(path)
+    unlisted = _unlisted(root, files)
+
+    return {
+        "ok": not mismatched and not missing,
+        "files": len(files),
+        "bytes": total,
+        "workers": max(1, workers),
+        "secs": round(time.time() - started, 2),
+        "counts": {"mismatched": len(mismatched), "missing": len(missing), "unlisted": len(unlisted)},
+        "mismatched": sorted(mismatched)[:VERIFY_MAX_REPORTED],
+        "missing": sorted(missing)[:VERIFY_MAX_REPORTED],
+        "unlisted": sorted(unlisted)[:VERIFY_MAX_REPORTED],  # Reported only, e.g. files the services wrote
+    }
@@ -0,0 +1,124 @@
+# interfaces.py
+import os
+import time
+import socket
+import select
+import threading
+from pathlib import Path
+from fastapi import HTTPException
+from helpers import logger
+
+SYSFS_NET = Path("/sys/class/net")  # The container shares the host's network namespace (--network=host)
+ETHERNET = "ethernet"
+WIFI = "wifi"
+INTERFACE_SCAN_SECS = 10.0  # Rescan interval without netlink, and a safety net with it
+INTERFACE_SETTLE_SECS = 0.2  # Quiet time after a link event before rescanning, events come in bursts
+INTERFACE_MISS_RESCAN_SECS = 1.0  # An unknown name triggers a rescan at most this often
+RTMGRP_LINK = 0x1  # Multicast group of link added/removed/changed messages
+
+def scan_interfaces(root: Path = SYSFS_NET):
+    """
+    {"ethernet": [...], "wifi": [...]} of the physical interfaces under `root`. Interfaces without a
+    `device` link (loopback, bridges, veths, tunnels) are virtual and left out.
+    """
+    found = {ETHERNET: [], WIFI: []}
+    try:
+        entries = sorted(os.scandir(root), key=lambda e: e.name)
+    except FileNotFoundError:
+        return found
+    for entry in entries:
+        path = Path(entry.path)
+        if not (path / "device").exists():
+            continue
+        kind = WIFI if (path / "wireless").is_dir() or (path / "phy80211").exists() else ETHERNET
+        found[kind].append(entry.name)
+    return found
+
+class InterfaceInventory:
+    """
+    The device's network interfaces, scanned from sysfs and kept in memory.
+
+    A background thread listens for link events on a netlink socket and rescans when one arrives,
+    so USB NICs and Wi-Fi dongles show up (and go away) within a moment of being plugged. Without
+    netlink it rescans every INTERFACE_SCAN_SECS. A scan reads a few sysfs entries per interface,
+    so lookups and the rescans they may trigger stay cheap.
+    """
+
+    def __init__(self, root=SYSFS_NET):
+        self.root = root
+        self.mode = None  # "netlink" or "poll" once the watcher runs
+        self._lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._interfaces = None
+        self._scanned_at = 0.0
+        self._watcher = None
+
+    def refresh(self):
+        interfaces = scan_interfaces(self.root)
+        with self._lock:
+            if interfaces != self._interfaces and self._interfaces is not None:
+                logger.info(f"Network interfaces changed: {interfaces}")
+            self._interfaces = interfaces
+            self._scanned_at = time.monotonic()
+        return interfaces
+
+    def ensure_ready(self):
+        """Scan on first use and start the background watcher."""
+        if self._watcher is not None:
+            return
+        with self._start_lock:
+            if self._watcher is None:
+                self.refresh()
+                self._watcher = threading.Thread(target=self._watch, daemon=True)
+                self._watcher.start()
+
+    # === Queries ===
+    def get(self):
+        self.ensure_ready()
+        with self._lock:
+            return {kind: list(names) for kind, names in self._interfaces.items()}
+
+    def require(self, name: str, kind: str = None):
+        """Raise 422 unless `name` is a current interface (of `kind`, if given)."""
+        self.ensure_ready()
+        kinds = [kind] if kind else [ETHERNET, WIFI]
+        interfaces = self._interfaces
+        if any(name in interfaces[k] for k in kinds):
+            return name
+        # Plugged in before its event was handled, look again rather than reject it
+        if time.monotonic() - self._scanned_at >= INTERFACE_MISS_RESCAN_SECS:
+            if any(name in self.refresh()[k] for k in kinds):
+                return name
+        label = f"{kind} interface" if kind else "interface"
+        raise HTTPException(status_code=422, detail=f"Unknown {label}: {name}")
+
+    # === Watcher ===
+    def _link_socket(self):
+        try:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+            sock.bind((0, RTMGRP_LINK))
+            return sock
+        except (AttributeError, OSError) as e:
+            logger.warning(f"Warning: no netlink link events ({e}), polling interfaces every {INTERFACE_SCAN_SECS}s")
+            return None
+
+    def _watch(self):
+        sock = self._link_socket()
+        self.mode = "netlink" if sock else "poll"
+        while True:
+            try:
+                if sock is None:
+                    time.sleep(INTERFACE_SCAN_SECS)
+                else:
+                    readable, _, _ = select.select([sock], [], [], INTERFACE_SCAN_SECS)
+                    if readable:
+                        # Let the burst (new link, renames, udev settling) pass, then drain it
+                        time.sleep(INTERFACE_SETTLE_SECS)
+                        while select.select([sock], [], [], 0)[0]:
+                            sock.recv(65536)
+                self.refresh()
+            except Exception as e:
+                logger.warning(f"Warning: interface scan failed: {e}")
+                time.sleep(INTERFACE_SCAN_SECS)
+
+INTERFACES = InterfaceInventory()
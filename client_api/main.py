@@ -1,4 +1,5 @@
 # main.py
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from base import router as base_router
@@ -6,9 +7,18 @@ from network import router as network_router
 from update import router as update_router
 from files import router as files_router
 from users import router as user_router
+from update_jobs import UPDATE_JOBS
+from passwords import HASHER
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # An update interrupted by an API restart (e.g. compose recreating this container) carries on
+    UPDATE_JOBS.resume()
+    yield
+    HASHER.shutdown()
 
 app = FastAPI(
-    root_path="/api", docs_url="/docs", redoc_url=None,
+    root_path="/api", docs_url="/docs", redoc_url=None, lifespan=lifespan,
     openapi_tags=[
         {
             "name": "Base",
@@ -1,48 +1,14 @@
 # network.py
 from pathlib import Path
-from enum import Enum
 from fastapi import APIRouter, Form, HTTPException, Body, Depends
 from helpers import USER_ROLE, SSHClient
+from interfaces import INTERFACES, ETHERNET, WIFI
 from users import get_current_user
 
 def netmask_to_cidr(netmask: str) -> int:
     binary_str = ''.join(bin(int(octet))[2:].zfill(8) for octet in netmask.split('.'))
     return binary_str.count('1')
 
-def get_sysfs_interfaces():
-    with SSHClient() as sshContext:
-        stdout, _, _ = sshContext.run_command(
-            r"""for iface in /sys/class/net/*; do
-    name=$(basename "$iface")
-    if [ -d "$iface/device" ]; then
-        if [ -d "$iface/wireless" ]; then
-            echo "$name:wifi"
-        else
-            echo "$name:ethernet"
-        fi
-    else
-        echo "$name:virtual"
-    fi
-done"""
-        )
-
-    ethernet = []
-    wifi = []
-
-    for line in stdout.strip().split("\n"):
-        if not line:
-            continue
-        name, dev_type = line.split(":", 1)
-        if dev_type == "ethernet":
-            ethernet.append(name)
-        elif dev_type == "wifi":
-            wifi.append(name)
-
-    return {
-        "ethernet": ethernet,
-        "wifi": wifi
-    }
-
 def get_wifi_ssids():
     with SSHClient() as sshContext:
         stdout, _, _ = sshContext.run_command(
@@ -55,14 +21,10 @@ def get_wifi_ssids():
 
 router = APIRouter(tags=["Network"])
 HOSTS_FILE = Path("/etc/hosts")
-INTERFACES = get_sysfs_interfaces()
-InterfaceEnum = Enum("EthernetInterfaceEnum", {name: name for name in INTERFACES["ethernet"] + INTERFACES["wifi"]})
-EthernetInterfaceEnum = Enum("EthernetInterfaceEnum", {eth: eth for eth in INTERFACES["ethernet"]})
-WiFiInterfaceEnum = Enum("WiFiInterfaceEnum", {wifi: wifi for wifi in INTERFACES["wifi"]})
 
 @router.get("/list_interfaces", dependencies=[Depends(get_current_user(USER_ROLE))])
 def list_network_interfaces():
-    return INTERFACES
+    return INTERFACES.get()
 
 @router.get("/wifi/ssids", dependencies=[Depends(get_current_user(USER_ROLE))])
 def list_wifi_ssids():
@@ -89,10 +51,11 @@ def set_local_dns(content: str = Body(..., embed=True)):
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.get("/interface/{interface}", dependencies=[Depends(get_current_user(USER_ROLE))])
-def get_network_interface_details(interface: InterfaceEnum):
+def get_network_interface_details(interface: str):
+    INTERFACES.require(interface)
     with SSHClient() as sshContext:
         # Run nmcli device show to get interface details and connection name
-        stdout, stderr, code = sshContext.run_command(f"nmcli device show {interface.value}")
+        stdout, stderr, code = sshContext.run_command(f"nmcli device show {interface}")
         if code != 0:
             raise HTTPException(status_code=500, detail=f"nmcli device show failed: {stderr.strip()}")
 
@@ -125,7 +88,7 @@ def get_network_interface_details(interface: InterfaceEnum):
         friendly = method_map.get(method, "Unmanaged")
 
         return {
-            "interface": interface.value,
+            "interface": interface,
             "type": parsed.get("GENERAL.TYPE", "—"),
             "mtu": parsed.get("GENERAL.MTU", "—"),
             "status": parsed.get("WIRED-PROPERTIES.CARRIER", "—"),
@@ -140,44 +103,45 @@ def get_network_interface_details(interface: InterfaceEnum):
         }
 
 @router.post("/ethernet/dhcp", dependencies=[Depends(get_current_user(USER_ROLE))])
-def set_eth_dhcp(interface: EthernetInterfaceEnum = Form(...)):
+def set_eth_dhcp(interface: str = Form(...)):
+    INTERFACES.require(interface, ETHERNET)
     try:
         with SSHClient() as sshContext:
             # Step 1: Disconnect the interface (ignore errors)
-            sshContext.run_command(f"nmcli device disconnect {interface.value} 2>/dev/null || true")
+            sshContext.run_command(f"nmcli device disconnect {interface} 2>/dev/null || true")
 
             # Step 2: Delete existing temp connection (ignore errors)
-            sshContext.run_command(f"nmcli con delete temp_{interface.value} 2>/dev/null || true")
+            sshContext.run_command(f"nmcli con delete temp_{interface} 2>/dev/null || true")
 
             # Step 3: Add new ethernet connection with DHCP (auto IP)
             add_cmd = (
-                f"nmcli con add type ethernet ifname {interface.value} "
-                f"con-name temp_{interface.value} ipv4.method auto"
+                f"nmcli con add type ethernet ifname {interface} "
+                f"con-name temp_{interface} ipv4.method auto"
             )
             stdout, stderr, code = sshContext.run_command(add_cmd)
             if code != 0:
                 raise HTTPException(
                     status_code=500,
-                    detail=f"Failed to add DHCP connection temp_{interface.value}: {(stderr or stdout).strip()}"
+                    detail=f"Failed to add DHCP connection temp_{interface}: {(stderr or stdout).strip()}"
                 )
 
             # Step 4: Bring up the new connection
-            up_cmd = f"nmcli con up temp_{interface.value}"
+            up_cmd = f"nmcli con up temp_{interface}"
             stdout, stderr, code = sshContext.run_command(up_cmd)
             combined_output = (stdout + "\n" + stderr).lower()
             if code != 0 or "error" in combined_output:
                 raise HTTPException(
                     status_code=500,
-                    detail=f"Failed to activate DHCP connection temp_{interface.value}: {(stderr or stdout).strip()}"
+                    detail=f"Failed to activate DHCP connection temp_{interface}: {(stderr or stdout).strip()}"
                 )
 
             # Optional Step 5: Verify the interface is connected
-            verify_cmd = f"nmcli -t -f GENERAL.STATE device show {interface.value}"
+            verify_cmd = f"nmcli -t -f GENERAL.STATE device show {interface}"
             stdout, stderr, code = sshContext.run_command(verify_cmd)
             if "100" not in stdout:
                 raise HTTPException(
                     status_code=500,
-                    detail=f"Interface {interface.value} did not reach connected state"
+                    detail=f"Interface {interface} did not reach connected state"
                 )
 
         return {"status": "connected", "mode": "dhcp"}
@@ -187,25 +151,26 @@ def set_eth_dhcp(interface: EthernetInterfaceEnum = Form(...)):
 
 @router.post("/ethernet/static", dependencies=[Depends(get_current_user(USER_ROLE))])
 def set_eth_static(
-    interface: EthernetInterfaceEnum = Form(...),
+    interface: str = Form(...),
     ip_address: str = Form(...),
     netmask: str = Form(default="255.255.255.0"),
     gateway: str = Form(...),
     dns: str = Form(default="8.8.8.8,1.1.1.1")
 ):
+    INTERFACES.require(interface, ETHERNET)
     cidr = netmask_to_cidr(netmask)
 
     try:
         with SSHClient() as sshContext:
             # Step 1: Disconnect the interface (ignore errors)
-            sshContext.run_command(f"nmcli device disconnect {interface.value} 2>/dev/null || true")
+            sshContext.run_command(f"nmcli device disconnect {interface} 2>/dev/null || true")
 
             # Step 2: Delete existing temp connection (ignore errors)
-            sshContext.run_command(f"nmcli con delete temp_{interface.value} 2>/dev/null || true")
+            sshContext.run_command(f"nmcli con delete temp_{interface} 2>/dev/null || true")
 
             # Step 3: Add new ethernet connection with static IP config
             add_cmd = (
-                f"nmcli con add type ethernet ifname {interface.value} con-name temp_{interface.value} "
+                f"nmcli con add type ethernet ifname {interface} con-name temp_{interface} "
                 f"ipv4.method manual ipv4.addresses {ip_address}/{cidr} ipv4.gateway {gateway} "
                 f"ipv4.dns \"{dns}\""
             )
@@ -213,26 +178,26 @@ def set_eth_static(
             if code != 0:
                 raise HTTPException(
                     status_code=500,
-                    detail=f"Failed to add connection temp_{interface.value}: {(stderr or stdout).strip()}"
+                    detail=f"Failed to add connection temp_{interface}: {(stderr or stdout).strip()}"
                 )
 
             # Step 4: Bring up the new connection
-            up_cmd = f"nmcli con up temp_{interface.value}"
+            up_cmd = f"nmcli con up temp_{interface}"
             stdout, stderr, code = sshContext.run_command(up_cmd)
             combined_output = (stdout + "\n" + stderr).lower()
             if code != 0 or "error" in combined_output:
                 raise HTTPException(
                     status_code=500,
-                    detail=f"Failed to activate connection temp_{interface.value}: {(stderr or stdout).strip()}"
+                    detail=f"Failed to activate connection temp_{interface}: {(stderr or stdout).strip()}"
                 )
 
             # Optional Step 5: Verify the interface is connected
-            verify_cmd = f"nmcli -t -f GENERAL.STATE device show {interface.value}"
+            verify_cmd = f"nmcli -t -f GENERAL.STATE device show {interface}"
             stdout, stderr, code = sshContext.run_command(verify_cmd)
             if "100" not in stdout:
                 raise HTTPException(
                     status_code=500,
-                    detail=f"Interface {interface.value} did not reach connected state"
+                    detail=f"Interface {interface} did not reach connected state"
                 )
 
         return {"status": "connected", "mode": "static"}
@@ -242,10 +207,11 @@ def set_eth_static(
 
 @router.post("/wifi/dhcp", dependencies=[Depends(get_current_user(USER_ROLE))])
 def set_wifi_dhcp(
-    interface: WiFiInterfaceEnum = Form(...),
+    interface: str = Form(...),
     ssid: str = Form(...),
     password: str = Form(...)
 ):
+    INTERFACES.require(interface, WIFI)
     try:
         with SSHClient() as sshContext:
             # Step 1: Turn Wi-Fi on
@@ -258,14 +224,14 @@ def set_wifi_dhcp(
 
             # Step 2: Delete existing temp connection (ignore failures)
             sshContext.run_command(
-                f"nmcli con delete temp_{interface.value}_wifi 2>/dev/null || true"
+                f"nmcli con delete temp_{interface}_wifi 2>/dev/null || true"
             )
 
             # Step 3: Attempt to connect
             connect_cmd = (
                 f"nmcli device wifi connect '{ssid}' "
-                f"password '{password}' ifname {interface.value} "
-                f"name temp_{interface.value}_wifi"
+                f"password '{password}' ifname {interface} "
+                f"name temp_{interface}_wifi"
             )
             stdout, stderr, code = sshContext.run_command(connect_cmd)
 
@@ -274,16 +240,16 @@ def set_wifi_dhcp(
             if code != 0 or "error" in combined_output:
                 raise HTTPException(
                     status_code=500,
-                    detail=f"Failed to connect {interface.value} to Wi-Fi '{ssid}': {(stderr or stdout).strip()}"
+                    detail=f"Failed to connect {interface} to Wi-Fi '{ssid}': {(stderr or stdout).strip()}"
                 )
 
             # Optional: Verify the device is actually connected
-            verify_cmd = f"nmcli -t -f GENERAL.STATE device show {interface.value}"
+            verify_cmd = f"nmcli -t -f GENERAL.STATE device show {interface}"
             stdout, stderr, code = sshContext.run_command(verify_cmd)
             if "100" not in stdout:  # 100 means connected
                 raise HTTPException(
                     status_code=500,
-                    detail=f"Interface {interface.value} did not reach connected state"
+                    detail=f"Interface {interface} did not reach connected state"
                 )
 
         return {"status": "connected", "ssid": ssid}
@@ -293,7 +259,7 @@ def set_wifi_dhcp(
     
 @router.post("/wifi/static", dependencies=[Depends(get_current_user(USER_ROLE))])
 def set_wifi_static(
-    interface: WiFiInterfaceEnum = Form(...),
+    interface: str = Form(...),
     ssid: str = Form(...),
     password: str = Form(...),
     ip_address: str = Form(...),
@@ -301,6 +267,7 @@ def set_wifi_static(
     gateway: str = Form(...),
     dns: str = Form(default="8.8.8.8,1.1.1.1")
 ):
+    INTERFACES.require(interface, WIFI)
     cidr = netmask_to_cidr(netmask)  # Your helper to convert netmask to CIDR
 
     try:
@@ -314,24 +281,24 @@ def set_wifi_static(
                 )
 
             # Step 2: Delete existing temp connection (ignore failure)
-            sshContext.run_command(f"nmcli con delete temp_{interface.value}_wifi 2>/dev/null || true")
+            sshContext.run_command(f"nmcli con delete temp_{interface}_wifi 2>/dev/null || true")
 
             # Step 3: Connect to Wi-Fi (creates the connection profile)
             connect_cmd = (
                 f"nmcli device wifi connect '{ssid}' password '{password}' "
-                f"ifname {interface.value} name temp_{interface.value}_wifi"
+                f"ifname {interface} name temp_{interface}_wifi"
             )
             stdout, stderr, code = sshContext.run_command(connect_cmd)
             combined_output = (stdout + "\n" + stderr).lower()
             if code != 0 or "error" in combined_output:
                 raise HTTPException(
                     status_code=500,
-                    detail=f"Failed to connect {interface.value} to Wi-Fi '{ssid}': {(stderr or stdout).strip()}"
+                    detail=f"Failed to connect {interface} to Wi-Fi '{ssid}': {(stderr or stdout).strip()}"
                 )
 
             # Step 4: Modify connection to use static IP
             mod_cmd = (
-                f"nmcli con mod temp_{interface.value}_wifi ipv4.method manual "
+                f"nmcli con mod temp_{interface}_wifi ipv4.method manual "
                 f"ipv4.addresses {ip_address}/{cidr} ipv4.gateway {gateway} ipv4.dns {dns}"
             )
             stdout, stderr, code = sshContext.run_command(mod_cmd)
@@ -342,7 +309,7 @@ def set_wifi_static(
                 )
 
             # Step 5: Bring up the connection with static config
-            up_cmd = f"nmcli con up temp_{interface.value}_wifi"
+            up_cmd = f"nmcli con up temp_{interface}_wifi"
             stdout, stderr, code = sshContext.run_command(up_cmd)
             combined_output = (stdout + "\n" + stderr).lower()
             if code != 0 or "error" in combined_output:
@@ -352,12 +319,12 @@ def set_wifi_static(
                 )
 
             # Step 6 (optional): Verify the interface is connected
-            verify_cmd = f"nmcli -t -f GENERAL.STATE device show {interface.value}"
+            verify_cmd = f"nmcli -t -f GENERAL.STATE device show {interface}"
             stdout, stderr, code = sshContext.run_command(verify_cmd)
             if "100" not in stdout:
                 raise HTTPException(
                     status_code=500,
-                    detail=f"Interface {interface.value} did not reach connected state"
+                    detail=f"Interface {interface} did not reach connected state"
                 )
 
         return {"status": "connected", "ssid": ssid, "ip": ip_address}
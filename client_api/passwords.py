@@ -0,0 +1,200 @@
+# passwords.py
+import os
+import json
+import time
+import asyncio
+import threading
+import multiprocessing
+from pathlib import Path
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import bcrypt
+from fastapi import HTTPException
+
+# Kept free of the other API modules: the worker processes import this file
+AUTH_SETTINGS_FILE = Path("/etc/device.d/auth.json")
+DEFAULT_BCRYPT_ROUNDS = 12  # What bcrypt.gensalt() used, so existing hashes are not rehashed
+MIN_BCRYPT_ROUNDS = 10
+MAX_BCRYPT_ROUNDS = 16
+HASH_WORKERS = max(1, min(2, (os.cpu_count() or 1) // 2))  # Leave cores for the API and the services
+HASH_MAX_PENDING = 8  # Hashes queued or running, beyond that requests are turned away
+HASH_RETRY_AFTER_SECS = 2
+
+LOGIN_FREE_FAILURES = 3  # Failed logins before backoff starts
+LOGIN_BACKOFF_SECS = 2  # Doubles with every further failure
+LOGIN_MAX_BACKOFF_SECS = 300
+LOGIN_FAILURE_TTL_SECS = 900  # Failures older than this are forgotten
+LOGIN_MAX_TRACKED = 10000  # Usernames and addresses tracked at once, oldest dropped first
+
+# === Worker side ===
+def _hash(password: bytes, rounds: int) -> bytes:
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds))
+
+def _check(password: bytes, hashed: bytes) -> bool:
+    return bcrypt.checkpw(password, hashed)
+
+def hash_rounds(hashed: str):
+    """Cost factor of a bcrypt hash ("$2b$12$..."), None if it is not one."""
+    try:
+        return int(hashed.split("$")[2])
+    except (IndexError, ValueError):
+        return None
+
+class PasswordHasher:
+    """
+    bcrypt on a small process pool instead of the API's threads.
+
+    A check costs a few hundred milliseconds of CPU on the gateways, so running them inline let a
+    burst of logins starve every other endpoint. At most HASH_WORKERS cores ever hash, at most
+    HASH_MAX_PENDING hashes wait or run (more get a 503 right away) and callers await the result
+    without holding a thread. The work factor is a device setting in AUTH_SETTINGS_FILE.
+    """
+
+    def __init__(self, settings_file=AUTH_SETTINGS_FILE, workers=HASH_WORKERS, max_pending=HASH_MAX_PENDING):
+        self.settings_file = settings_file
+        self.workers = workers
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._pool = None
+
+    # === Settings ===
+    def _settings(self):
+        try:
+            with open(self.settings_file, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    @property
+    def rounds(self):
+        return self._settings().get("bcrypt_rounds", DEFAULT_BCRYPT_ROUNDS)
+
+    def set_rounds(self, rounds: int):
+        with self._lock:
+            tmp = self.settings_file.with_suffix(".tmp")
+            with open(tmp, "w") as f:
+                json.dump({**self._settings(), "bcrypt_rounds": rounds}, f)
+            os.replace(tmp, self.settings_file)
+
+    # === Pool ===
+    def _executor(self):
+        with self._lock:
+            if self._pool is None:
+                # Workers fork from a clean server process, not from the threaded API
+                self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("forkserver"))
+            return self._pool
+
+    async def _run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            raise HTTPException(
+                status_code=503,
+                detail="Too many password checks in progress, try again shortly",
+                headers={"Retry-After": str(HASH_RETRY_AFTER_SECS)},
+            )
+        try:
+            return await asyncio.wrap_future(self._executor().submit(fn, *args))
+        except BrokenProcessPool:
+            with self._lock:
+                self._pool = None  # A worker died (e.g. OOM), start over on the next call
+            raise HTTPException(status_code=503, detail="Password hashing is unavailable, try again")
+        finally:
+            self._slots.release()
+
+    async def hash(self, password: str) -> str:
+        return (await self._run(_hash, password.encode(), self.rounds)).decode()
+
+    async def check(self, password: str, hashed: str) -> bool:
+        try:
+            return await self._run(_check, password.encode(), hashed.encode())
+        except ValueError:
+            return False  # Not a bcrypt hash
+
+    def needs_rehash(self, hashed: str) -> bool:
+        return hash_rounds(hashed) != self.rounds
+
+    def shutdown(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False, cancel_futures=True)
+                self._pool = None
+
+class LoginThrottle:
+    """
+    Exponential backoff after repeated failed logins, per username and per client address.
+
+    Once a key has LOGIN_FREE_FAILURES failures, each further one doubles how long it has to wait
+    (up to LOGIN_MAX_BACKOFF_SECS). Attempts during the wait are refused before any hashing, so
+    guessing passwords costs the attacker time rather than the device CPU. Attempts still being
+    checked count as failures until they finish, so parallel guesses cannot all slip through before
+    the first one is recorded: past the free failures a key gets one attempt in flight at a time.
+    """
+
+    def __init__(self, max_tracked=LOGIN_MAX_TRACKED):
+        self.max_tracked = max_tracked
+        self._lock = threading.Lock()
+        self._failures = OrderedDict()  # key -> (failures, last failure, blocked until)
+        self._pending = {}  # key -> attempts admitted by check() and not finished yet
+
+    def check(self, *keys):
+        """
+        Raise 429 if any of `keys` is still backing off, otherwise reserve an attempt for them.
+        Every admitted attempt must end in failed(), succeeded() or release().
+        """
+        now = time.time()
+        with self._lock:
+            wait = 0
+            for key in keys:
+                failures, last, blocked = self._failures.get(key, (0, 0, 0))
+                if now - last > LOGIN_FAILURE_TTL_SECS:
+                    failures = 0
+                pending = self._pending.get(key, 0)
+                wait = max(wait, blocked - now)
+                if pending and failures + pending >= LOGIN_FREE_FAILURES:
+                    wait = max(wait, 1)  # Until the attempts in flight have been decided
+            if wait <= 0:
+                for key in keys:
+                    self._pending[key] = self._pending.get(key, 0) + 1
+        if wait > 0:
+            raise HTTPException(
+                status_code=429,
+                detail=f"Too many failed logins, try again in {int(wait) + 1}s",
+                headers={"Retry-After": str(int(wait) + 1)},
+            )
+
+    def _release(self, keys):
+        # Call with lock held
+        for key in keys:
+            pending = self._pending.pop(key, 0) - 1
+            if pending > 0:
+                self._pending[key] = pending
+
+    def release(self, *keys):
+        """End an attempt that was neither a failure nor a success (e.g. the hasher was busy)."""
+        with self._lock:
+            self._release(keys)
+
+    def failed(self, *keys):
+        now = time.time()
+        with self._lock:
+            self._release(keys)
+            for key in keys:
+                failures, last, _ = self._failures.pop(key, (0, 0, 0))
+                if now - last > LOGIN_FAILURE_TTL_SECS:
+                    failures = 0
+                failures += 1
+                backoff = 0
+                if failures > LOGIN_FREE_FAILURES:
+                    backoff = min(LOGIN_MAX_BACKOFF_SECS, LOGIN_BACKOFF_SECS * 2 ** (failures - LOGIN_FREE_FAILURES - 1))
+                self._failures[key] = (failures, now, now + backoff)
+            while len(self._failures) > self.max_tracked:
+                self._failures.popitem(last=False)
+
+    def succeeded(self, *keys):
+        with self._lock:
+            self._release(keys)
+            for key in keys:
+                self._failures.pop(key, None)
+
+HASHER = PasswordHasher()
+LOGIN_THROTTLE = LoginThrottle()
@@ -0,0 +1,370 @@
+# progress.py
+import json
+import time
+import asyncio
+import threading
+from itertools import islice
+from collections import deque
+from fastapi.responses import StreamingResponse
+
+PROGRESS_TTL_SECONDS = 60  # How long finished entries stay readable
+PROGRESS_STALE_SECONDS = 3600  # Entries that stopped reporting are dropped after this
+PROGRESS_MAX_ENTRIES = 256
+PROGRESS_PUSH_INTERVAL = 0.25  # Minimum seconds between pushed updates for one entry
+PROGRESS_RATE_WINDOW = 0.5  # Minimum seconds between rate samples
+PROGRESS_RATE_SMOOTHING = 0.3  # Weight of the newest sample in the moving average
+PROGRESS_KEEPALIVE_SECONDS = 15
+LOG_MAX_LINES = 5000  # Lines a LogBuffer keeps, older ones are dropped
+
+ACTIVE = "active"
+COMPLETE = "complete"
+ERROR = "error"
+
+class ProgressRegistry:
+    """
+    Thread-safe registry of progress for long running operations (uploads, decryption, ...).
+
+    Each entry tracks bytes done/total for its current phase, a smoothed rate and an ETA.
+    Finished entries are evicted after `ttl` seconds and entries that stop reporting after
+    `stale_ttl` seconds, so the registry stays bounded. Subscribers get updates pushed to them.
+    """
+
+    def __init__(self, ttl=PROGRESS_TTL_SECONDS, stale_ttl=PROGRESS_STALE_SECONDS, max_entries=PROGRESS_MAX_ENTRIES):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._subscribers = {}  # key -> set of (loop, queue)
+
+    # === Writers ===
+    def start(self, key, phase="starting", total=None, **info):
+        now = time.time()
+        with self._lock:
+            self._evict_locked(now, reserve=1)
+            self._entries[key] = {
+                "id": key,
+                "status": ACTIVE,
+                "phase": phase,
+                "done": 0,
+                "total": total,
+                "rate": 0.0,
+                "error": None,
+                "info": dict(info),
+                "started": now,
+                "phase_started": now,
+                "updated": now,
+                "sample_time": now,
+                "sample_done": 0,
+                "pushed": 0.0,
+            }
+            self._publish_locked(key, force=True)
+
+    def phase(self, key, phase, total=None, **info):
+        """Move an entry to a new phase, resetting its byte counters and rate."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            entry.update({
+                "phase": phase,
+                "done": 0,
+                "total": total,
+                "rate": 0.0,
+                "phase_started": now,
+                "updated": now,
+                "sample_time": now,
+                "sample_done": 0,
+            })
+            entry["info"].update(info)
+            self._publish_locked(key, force=True)
+
+    def update(self, key, done=None, total=None, **info):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            if total is not None:
+                entry["total"] = total
+            if done is not None:
+                entry["done"] = done
+                self._sample_rate_locked(entry, now)
+            entry["info"].update(info)
+            entry["updated"] = now
+            self._publish_locked(key, force=bool(info))
+
+    def advance(self, key, amount):
+        with self._lock:
+            entry = self._entries.get(key)
+            done = entry["done"] + amount if entry else None
+        if done is not None:
+            self.update(key, done=done)
+
+    def finish(self, key, phase=COMPLETE, **info):
+        self._close(key, COMPLETE, phase, None, info)
+
+    def fail(self, key, error, **info):
+        self._close(key, ERROR, ERROR, str(error), info)
+
+    def _close(self, key, status, phase, error, info):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            entry.update({"status": status, "phase": phase, "error": error, "updated": now})
+            entry["info"].update(info)
+            self._publish_locked(key, force=True)
+
+    # === Readers ===
+    def get(self, key):
+        with self._lock:
+            self._evict_locked(time.time())
+            entry = self._entries.get(key)
+            return self._snapshot(entry) if entry else None
+
+    async def subscribe(self, key, keepalive=PROGRESS_KEEPALIVE_SECONDS):
+        """
+        Yield snapshots for `key` as they change until the entry finishes or disappears.
+        Yields None every `keepalive` seconds without updates so callers can ping clients.
+        """
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=1)
+        subscriber = (loop, queue)
+        with self._lock:
+            self._subscribers.setdefault(key, set()).add(subscriber)
+            entry = self._entries.get(key)
+            if entry:
+                queue.put_nowait(self._snapshot(entry))
+        seen = False
+        try:
+            while True:
+                try:
+                    snapshot = await asyncio.wait_for(queue.get(), timeout=keepalive)
+                except asyncio.TimeoutError:
+                    # Entry was evicted while we were waiting on it
+                    if seen and self.get(key) is None:
+                        return
+                    yield None
+                    continue
+                seen = True
+                yield snapshot
+                if snapshot["status"] != ACTIVE:
+                    return
+        finally:
+            with self._lock:
+                subscribers = self._subscribers.get(key)
+                if subscribers:
+                    subscribers.discard(subscriber)
+                    if not subscribers:
+                        del self._subscribers[key]
+
+    # === Internals (call with lock held) ===
+    def _sample_rate_locked(self, entry, now):
+        elapsed = now - entry["sample_time"]
+        if elapsed < PROGRESS_RATE_WINDOW:
+            return
+        sample = max(0, entry["done"] - entry["sample_done"]) / elapsed
+        if entry["rate"]:
+            sample = PROGRESS_RATE_SMOOTHING * sample + (1 - PROGRESS_RATE_SMOOTHING) * entry["rate"]
+        entry["rate"] = sample
+        entry["sample_time"] = now
+        entry["sample_done"] = entry["done"]
+
+    def _publish_locked(self, key, force=False):
+        entry = self._entries[key]
+        subscribers = self._subscribers.get(key)
+        if not subscribers:
+            return
+        now = time.time()
+        if not force and now - entry["pushed"] < PROGRESS_PUSH_INTERVAL:
+            return
+        entry["pushed"] = now
+        snapshot = self._snapshot(entry)
+        for loop, queue in list(subscribers):
+            try:
+                loop.call_soon_threadsafe(_offer_latest, queue, snapshot)
+            except RuntimeError:
+                # Subscriber's event loop is gone
+                subscribers.discard((loop, queue))
+
+    def _evict_locked(self, now, reserve=0):
+        for key, entry in list(self._entries.items()):
+            age = now - entry["updated"]
+            if (entry["status"] != ACTIVE and age > self.ttl) or age > self.stale_ttl:
+                del self._entries[key]
+
+        overflow = len(self._entries) - self.max_entries + reserve
+        if overflow > 0:
+            oldest = sorted(self._entries.values(), key=lambda e: (e["status"] == ACTIVE, e["updated"]))
+            for entry in oldest[:overflow]:
+                del self._entries[entry["id"]]
+
+    @staticmethod
+    def _snapshot(entry):
+        now = time.time()
+        done, total, rate = entry["done"], entry["total"], entry["rate"]
+        percent = None
+        eta = None
+        if entry["status"] == COMPLETE:
+            percent = 100
+            eta = 0
+        elif total:
+            percent = min(100, int(done / total * 100))
+            if rate > 0:
+                eta = round(max(0, total - done) / rate, 1)
+
+        snapshot = dict(entry["info"])
+        snapshot.update({
+            "id": entry["id"],
+            "status": entry["status"],
+            "phase": entry["phase"],
+            "done": done,
+            "total": total,
+            "percent": percent,
+            "rate_bps": round(rate, 1),
+            "eta_secs": eta,
+            "elapsed_secs": round(now - entry["started"], 1),
+            "phase_elapsed_secs": round(now - entry["phase_started"], 1),
+            "error": entry["error"],
+        })
+        return snapshot
+
+def _offer_latest(queue, snapshot):
+    # Subscribers only care about the newest state, so replace anything not yet consumed
+    if queue.full():
+        queue.get_nowait()
+    queue.put_nowait(snapshot)
+
+class LogBuffer:
+    """
+    Thread-safe, bounded log of lines with monotonically increasing offsets.
+
+    Line n has offset n for the lifetime of the log. Readers pass the offset of the last line
+    they have and get only newer ones; lines that fell out of the buffer in between are counted
+    as dropped instead of being resent. `follow` pushes new lines to async readers.
+    """
+
+    def __init__(self, max_lines=LOG_MAX_LINES, start=0, lines=()):
+        self._lock = threading.Lock()
+        self._lines = deque(maxlen=max_lines)
+        self._next = start  # Offset of the next line
+        self._closed = False
+        self._subscribers = set()  # (loop, event)
+        self.append(lines)
+
+    @classmethod
+    def load(cls, data, max_lines=LOG_MAX_LINES):
+        return cls(max_lines, start=data.get("start", 0), lines=data.get("lines", []))
+
+    def dump(self):
+        with self._lock:
+            return {"start": self._next - len(self._lines), "lines": list(self._lines)}
+
+    @property
+    def offset(self):
+        """Offset of the newest line, -1 while empty."""
+        with self._lock:
+            return self._next - 1
+
+    def append(self, lines):
+        lines = list(lines)
+        if not lines:
+            return
+        with self._lock:
+            self._lines.extend(lines)
+            self._next += len(lines)
+            self._notify_locked()
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self._notify_locked()
+
+    def read(self, after=-1, limit=None):
+        """
+        Lines with an offset greater than `after`, at most `limit` of them. `offset` in the result is
+        the cursor to pass as `after` next time, `dropped` how many lines after `after` are gone.
+        """
+        with self._lock:
+            first = self._next - len(self._lines)
+            start = max(first, after + 1)
+            stop = None if limit is None else start - first + limit
+            lines = list(islice(self._lines, start - first, stop))
+            return {
+                "lines": lines,
+                "offset": start + len(lines) - 1,
+                "dropped": max(0, first - (after + 1)),
+                "closed": self._closed and start + len(lines) >= self._next,
+            }
+
+    async def follow(self, after=-1, keepalive=PROGRESS_KEEPALIVE_SECONDS):
+        """
+        Yield `read` results as lines arrive until the log is closed.
+        Yields None every `keepalive` seconds without new lines so callers can ping clients.
+        """
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+        subscriber = (loop, event)
+        with self._lock:
+            self._subscribers.add(subscriber)
+        try:
+            while True:
+                event.clear()
+                batch = self.read(after)
+                if batch["lines"] or batch["dropped"]:
+                    after = batch["offset"]
+                    yield batch
+                    continue
+                if batch["closed"]:
+                    return
+                try:
+                    await asyncio.wait_for(event.wait(), timeout=keepalive)
+                except asyncio.TimeoutError:
+                    yield None
+        finally:
+            with self._lock:
+                self._subscribers.discard(subscriber)
+
+    def _notify_locked(self):
+        for loop, event in list(self._subscribers):
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                # Subscriber's event loop is gone
+                self._subscribers.discard((loop, event))
+
+def progress_event_stream(registry, key):
+    """
+    Server-Sent Events response pushing snapshots of `key` until it finishes.
+    """
+    async def stream():
+        async for snapshot in registry.subscribe(key):
+            if snapshot is None:
+                yield ": keep-alive\n\n"
+            else:
+                yield f"event: progress\ndata: {json.dumps(snapshot)}\n\n"
+        yield "event: end\ndata: {}\n\n"
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return StreamingResponse(stream(), media_type="text/event-stream", headers=headers)
+
+def log_event_stream(log: LogBuffer, after=-1):
+    """
+    Server-Sent Events response with the lines of `log` after offset `after` as they are written.
+    Each event carries its offset as the event id, so a reconnecting EventSource resumes from it.
+    """
+    async def stream():
+        async for batch in log.follow(after):
+            if batch is None:
+                yield ": keep-alive\n\n"
+            else:
+                yield f"id: {batch['offset']}\nevent: log\ndata: {json.dumps(batch)}\n\n"
+        yield "event: end\ndata: {}\n\n"
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return StreamingResponse(stream(), media_type="text/event-stream", headers=headers)
+
+PROGRESS = ProgressRegistry()
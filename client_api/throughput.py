@@ -0,0 +1,227 @@
+# throughput.py
+import io
+import os
+import json
+import lzma
+import time
+import zlib
+import gzip
+import shutil
+import tarfile
+import threading
+from pathlib import Path
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.padding import PKCS7
+import zstandard as zstd
+from helpers import DEVICE_DIR, STAGE_DIR, logger
+from bundle import OPENSSL_MAGIC, BundlePipeline, derive_key_iv
+from decompress import (
+    GZIP, ZSTD, XZ, DECOMPRESS_WORKERS, ParallelDecompressor, compress_bgzf, compress_zstd_frames
+)
+
+THROUGHPUT_PROFILE_FILE = Path(f"{DEVICE_DIR}/throughput.json")  # Per-device calibration profile
+THROUGHPUT_SMOOTHING = 0.3  # Weight of the newest measurement
+BENCHMARK_BYTES = 16 * 1024 * 1024
+BENCHMARK_BLOCK_BYTES = 1024 * 1024
+BENCHMARK_FILES = 4  # Files in the sample bundle of the format benchmark
+
+class ThroughputProfile:
+    """
+    Measured throughput of the update phases on this device.
+
+    Byte phases (decrypt, extract, verify, load_images) keep an exponentially weighted rate in bytes/sec,
+    fixed-cost phases (compose_up, prune) a weighted duration. Every finished operation and every
+    calibration run feeds it, so ETAs match the hardware instead of a hard-coded speed.
+    """
+
+    def __init__(self, path=THROUGHPUT_PROFILE_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._profile = self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {"rates": {}, "durations": {}}
+        except (OSError, ValueError) as e:
+            logger.warning(f"Warning: could not read throughput profile: {e}")
+            return {"rates": {}, "durations": {}}
+
+    def _save(self):
+        # Call with lock held
+        tmp = self.path.with_suffix(".tmp")
+        with open(tmp, "w") as f:
+            json.dump(self._profile, f)
+        os.replace(tmp, self.path)
+
+    @staticmethod
+    def _smooth(entry, value):
+        if entry.get("value"):
+            value = THROUGHPUT_SMOOTHING * value + (1 - THROUGHPUT_SMOOTHING) * entry["value"]
+        entry.update({"value": value, "samples": entry.get("samples", 0) + 1, "updated": time.time()})
+
+    def record(self, phase, nbytes, seconds, source="measured"):
+        """Record that `phase` processed `nbytes` in `seconds`."""
+        if nbytes <= 0 or seconds <= 0:
+            return
+        with self._lock:
+            entry = self._profile["rates"].setdefault(phase, {})
+            self._smooth(entry, nbytes / seconds)
+            entry["source"] = source
+            self._save()
+
+    def record_duration(self, phase, seconds):
+        with self._lock:
+            self._smooth(self._profile["durations"].setdefault(phase, {}), seconds)
+            self._save()
+
+    def rate(self, phase):
+        with self._lock:
+            return self._profile["rates"].get(phase, {}).get("value")
+
+    def duration(self, phase):
+        with self._lock:
+            return self._profile["durations"].get(phase, {}).get("value")
+
+    def eta(self, phase, remaining_bytes, live_rate=None):
+        """
+        Seconds left for `remaining_bytes` of `phase`: the live rate once one was measured,
+        the profile's rate before that. None if neither is known.
+        """
+        rate = live_rate or self.rate(phase)
+        if not rate:
+            return None
+        return round(max(0, remaining_bytes) / rate, 1)
+
+    def snapshot(self):
+        with self._lock:
+            return json.loads(json.dumps(self._profile))
+
+def _benchmark_data(size):
+    # Half random, half repetitive, compresses roughly like an image bundle
+    block = os.urandom(BENCHMARK_BLOCK_BYTES // 2) + b"layer.tar manifest.json " * (BENCHMARK_BLOCK_BYTES // 50)
+    return block * max(1, size // len(block))
+
+def _benchmark_bundle(data, password):
+    """An encrypted bundle (as `openssl enc -aes-256-cbc -salt -pbkdf2` writes it) carrying `data` as its image."""
+    plain = io.BytesIO()
+    with tarfile.open(fileobj=plain, mode="w:gz", compresslevel=6) as tar:
+        for name in ("cmount", "images"):
+            info = tarfile.TarInfo(name)
+            info.type = tarfile.DIRTYPE
+            tar.addfile(info)
+        members = {".version": b"benchmark", ".env": b"", "docker-compose.yml": b"services: {}\n", "images/sample.tar": data}
+        for name, content in members.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+    salt = os.urandom(8)
+    key, iv = derive_key_iv(password, salt)
+    padder = PKCS7(algorithms.AES.block_size).padder()
+    padded = padder.update(plain.getvalue()) + padder.finalize()
+    encryptor = Cipher(algorithms.AES(key), modes.CBC(iv)).encryptor()
+    return OPENSSL_MAGIC + salt + encryptor.update(padded) + encryptor.finalize()
+
+def run_benchmark(size: int = BENCHMARK_BYTES):
+    """
+    Quick calibration of the decrypt and extract phases on `size` bytes, recorded in the profile.
+    Decrypt runs a sample bundle through the same BundlePipeline an upload goes through (decryption,
+    unpadding, the write to disk and the tar inspection), so its rate is comparable to real uploads.
+    Extract times gunzip + write to the stage directory.
+    """
+    data = _benchmark_data(size)
+
+    password = os.urandom(16).hex()
+    encrypted = _benchmark_bundle(data, password)
+    stage = STAGE_DIR / ".benchmark"
+    shutil.rmtree(stage, ignore_errors=True)
+    stage.mkdir(parents=True)
+    try:
+        pipeline = BundlePipeline(password, stage_dir=stage)
+        try:
+            for offset in range(0, len(encrypted), BENCHMARK_BLOCK_BYTES):
+                pipeline.feed(encrypted[offset:offset + BENCHMARK_BLOCK_BYTES])
+            pipeline.finish()
+        except BaseException:
+            pipeline.abort()
+            raise
+        decrypt_secs = pipeline.busy_secs
+    finally:
+        shutil.rmtree(stage, ignore_errors=True)
+
+    compressed = zlib.compress(data, 6)
+    target = STAGE_DIR / ".benchmark"
+    started = time.perf_counter()
+    try:
+        inflater = zlib.decompressobj()
+        with open(target, "wb") as f:
+            for offset in range(0, len(compressed), BENCHMARK_BLOCK_BYTES):
+                f.write(inflater.decompress(compressed[offset:offset + BENCHMARK_BLOCK_BYTES]))
+            f.write(inflater.flush())
+            f.flush()
+            os.fsync(f.fileno())
+        extract_secs = time.perf_counter() - started
+    finally:
+        target.unlink(missing_ok=True)
+
+    # Extract progress counts compressed bytes, so that is what the rate is measured in
+    THROUGHPUT.record("decrypt", len(encrypted), decrypt_secs, source="benchmark")
+    THROUGHPUT.record("extract", len(compressed), extract_secs, source="benchmark")
+    return {
+        "bytes": len(data),
+        "decrypt_bps": round(len(encrypted) / decrypt_secs, 1),
+        "decrypt_secs": round(decrypt_secs, 3),
+        "extract_bps": round(len(compressed) / extract_secs, 1),
+        "extract_secs": round(extract_secs, 3),
+        "profile": THROUGHPUT.snapshot(),
+    }
+
+def run_format_benchmark(size: int = BENCHMARK_BYTES, workers: int = DECOMPRESS_WORKERS):
+    """
+    Wall time to decompress and extract the same tar of `size` bytes in each bundle format,
+    the way the extract phase does it. Nothing is recorded, the result is for choosing a format.
+    """
+    data = _benchmark_data(size // BENCHMARK_FILES)
+    plain = io.BytesIO()
+    with tarfile.open(fileobj=plain, mode="w") as tar:
+        for i in range(BENCHMARK_FILES):
+            info = tarfile.TarInfo(f"images/sample{i}.tar")
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    plain = plain.getvalue()
+
+    formats = {
+        "gzip": (GZIP, lambda: gzip.compress(plain, 6)),
+        "gzip_bgzf": (GZIP, lambda: compress_bgzf(plain, 6)),
+        "zstd": (ZSTD, lambda: zstd.ZstdCompressor(level=3).compress(plain)),
+        "zstd_frames": (ZSTD, lambda: compress_zstd_frames(plain, 3)),
+        "xz": (XZ, lambda: lzma.compress(plain, preset=1)),
+    }
+    target = STAGE_DIR / ".benchmark"
+    results = {}
+    try:
+        for name, (compression, compress) in formats.items():
+            compressed = compress()
+            shutil.rmtree(target, ignore_errors=True)
+            started = time.perf_counter()
+            with ParallelDecompressor(io.BytesIO(compressed), compression, workers) as source:
+                with tarfile.open(fileobj=source, mode="r|") as tar:
+                    tar.extractall(path=target)
+                parallel_tasks = source.parallel_tasks
+            secs = time.perf_counter() - started
+            results[name] = {
+                "compressed_bytes": len(compressed),
+                "ratio": round(len(plain) / len(compressed), 2),
+                "parallel_tasks": parallel_tasks,  # 0 or 1: decompressed on one core
+                "secs": round(secs, 3),
+                "bps": round(len(plain) / secs, 1),
+            }
+    finally:
+        shutil.rmtree(target, ignore_errors=True)
+    fastest = min(results, key=lambda name: results[name]["secs"])
+    logger.info(f"Bundle format benchmark ({len(plain)} bytes, {workers} workers): fastest is {fastest}")
+    return {"bytes": len(plain), "workers": workers, "fastest": fastest, "formats": results}
+
+THROUGHPUT = ThroughputProfile()
@@ -1,29 +1,26 @@
 # update.py
-import os, sys, time, tarfile
-from fastapi import APIRouter, UploadFile, File, Depends, HTTPException, Form, BackgroundTasks
+from fastapi import APIRouter, UploadFile, File, Depends, HTTPException, Form, Query, Request
+from fastapi.concurrency import run_in_threadpool
 from helpers import (
-    CURRENT_DIR, STAGE_DIR, CURRENT_OVERRIDE_SCRIPT_PATH, get_version,
-    SSHClient, clear_stage_dir, clear_current_dir, get_device_token,
-    get_stage_version, clean_ansi_and_whitespace, USER_ROLE
+    clear_stage_dir, get_device_token, get_version, get_stage_version, active_slot, inactive_slot,
+    slot_dir, clear_slot, get_slot_version, SLOTS, USER_ROLE
 )
-from users import get_current_user
+from users import get_current_user, get_current_user_manual
+from progress import PROGRESS, progress_event_stream, log_event_stream
+from bundle import BundlePipeline, BUNDLE_STEM
+from decompress import BUNDLE_EXTENSIONS
+from update_jobs import UPDATE_JOBS, IMAGE_LOAD_WORKERS, MAX_IMAGE_LOAD_WORKERS
+from throughput import THROUGHPUT, run_benchmark, run_format_benchmark
+from backups import BACKUPS, MAX_RETAIN
+from integrity import INTEGRITY_MANIFEST, IntegrityError, read_integrity_manifest, verify_tree
 
 SUCCESS = 0
 router = APIRouter(tags=["Update"])
 
-FILE_SIZE_TOTALS = {}
-DISK_WRITE_PROGRESS = {}
-BUNDLE_VERSIONS = {}
-DECRYPT_START_TIME = {}
-UPDATE_PROGRESS = {}
+BUNDLE_UPLOAD_NAMES = {f"{BUNDLE_STEM}{extension}.enc" for extension in BUNDLE_EXTENSIONS.values()}
 
-def delayed_cleanup(filename: str, delay: int = 3):
-    time.sleep(delay)
-    DISK_WRITE_PROGRESS.pop(filename, None)
-    BUNDLE_VERSIONS.pop(filename, None)
-    DECRYPT_START_TIME.pop(filename, None)
-    FILE_SIZE_TOTALS.pop(filename, None)
-    return None
+def upload_progress_key(filename: str) -> str:
+    return f"updates:{filename}"
 
 @router.get("/version", dependencies=[Depends(get_current_user(USER_ROLE))])
 def get_software_version():
@@ -33,274 +30,326 @@ def get_software_version():
 def get_software_version_stage():
     return get_stage_version()
 
-@router.post("/upload", dependencies=[Depends(get_current_user(USER_ROLE))])
-def upload(
-    file: UploadFile = File(...),
-    total_size: int = Form(...),
-):
-    if file.filename != "bundle.tar.gz.enc":
-        raise HTTPException(status_code=400, detail='File must have name "bundle.tar.gz.enc"')
+def start_bundle_upload(filename: str, total_size: int):
+    if filename not in BUNDLE_UPLOAD_NAMES:
+        raise HTTPException(status_code=400, detail=f"File must be named one of {', '.join(sorted(BUNDLE_UPLOAD_NAMES))}")
+    job = UPDATE_JOBS.get()
+    if job and job["status"] in ("queued", "running"):
+        raise HTTPException(status_code=409, detail="An update is running, wait for it to finish before uploading")
 
     clear_stage_dir()
-    target_path = STAGE_DIR / file.filename
-    decrypt_path = STAGE_DIR / "bundle.tar.gz"
-    
-    FILE_SIZE_TOTALS[file.filename] = total_size
-    DISK_WRITE_PROGRESS[file.filename] = 0
-    BUNDLE_VERSIONS[file.filename] = None
-    DECRYPT_START_TIME[file.filename] = None
-
-    # Write file and update progress
-    total_bytes = 0
-    chunk_size = 1024 * 1024  # 1MB
-    with open(target_path, "wb") as f:
-        while chunk := file.file.read(chunk_size):
-            f.write(chunk)
-            total_bytes += len(chunk)
-            DISK_WRITE_PROGRESS[file.filename] = total_bytes
-
-    # Start decryption timer
-    DECRYPT_START_TIME[file.filename] = time.time()
-
-    with SSHClient() as sshContext:
-        stdout, stderr, code = sshContext.run_command(
-            f'openssl enc -aes-256-cbc -d -salt -pbkdf2 -in "{target_path}" '
-            f'-out "{decrypt_path}" -pass pass:"{get_device_token()}"'
-        )
-    if code != 0:
-        raise HTTPException(status_code=500, detail=f"File decryption failed: {stderr.strip()}")
-    os.remove(target_path)
-
-    # Validate archive contents
-    required_files = {"docker-compose.yml", ".version", ".env"}
-    required_dirs = {"cmount", "images"}
-    found_files = set()
-    found_dirs = set()
-    version_string = None
-    contains_override = False
+    key = upload_progress_key(filename)
+    PROGRESS.start(key, phase="receiving", total=total_size, version=None)
+    return key, BundlePipeline(get_device_token(), key)
 
+def finish_bundle_upload(key: str, filename: str, pipeline: BundlePipeline):
     try:
-        with tarfile.open(decrypt_path, "r:gz") as tar:
-            for member in tar.getmembers():
-                name = member.name.split("/")[-1]
-
-                if name in required_files:
-                    found_files.add(name)
-                if name in required_dirs:
-                    found_dirs.add(name)
-                if name == "override.sh" and member.isfile():
-                    contains_override = True
-                if name == ".version" and member.isfile():
-                    version_file = tar.extractfile(member)
-                    if version_file:
-                        version_string = version_file.read().decode("utf-8", errors="ignore").strip()
-                        BUNDLE_VERSIONS[file.filename] = version_string
-                        # Write version_string to a .version file inside STAGE_DIR
-                        version_path = STAGE_DIR / ".version"
-                        with open(version_path, "w", encoding="utf-8") as vf:
-                            vf.write(version_string)
-
-        missing_files = required_files - found_files
-        missing_dirs = required_dirs - found_dirs
-        if missing_files or missing_dirs:
-            detail = ""
-            if missing_files:
-                detail += f"Missing required file(s): {', '.join(missing_files)}. "
-            if missing_dirs:
-                detail += f"Missing required directory(s): {', '.join(missing_dirs)}."
-            clear_stage_dir()
-            raise HTTPException(status_code=400, detail=detail.strip())
-
-    except tarfile.TarError as e:
-        clear_stage_dir()
-        raise HTTPException(status_code=500, detail=f"Failed to read archive: {e}")
+        result = pipeline.finish()
+    except Exception as e:
+        fail_bundle_upload(key, pipeline, e)
+        raise
 
+    THROUGHPUT.record("decrypt", pipeline.received, pipeline.busy_secs)
+    PROGRESS.finish(key, version=result["version"])
     status = "Upload successful!"
-    if contains_override:
+    if result["contains_override"]:
         status += " WARNING: Bundle contains an override script!"
 
     return {
         "status": status,
-        "filename": file.filename,
-        "version": version_string,
+        "filename": filename,
+        "version": result["version"],
+        "base_version": result["delta"]["base_version"] if result["delta"] else None,
+        "compression": result["compression"],
+        "integrity_files": result["integrity_files"],
     }
 
-@router.get("/upload/progress", dependencies=[Depends(get_current_user(USER_ROLE))])
-def upload_progress(filename: str, background_tasks: BackgroundTasks):
+def fail_bundle_upload(key: str, pipeline: BundlePipeline, error: Exception):
+    pipeline.abort()
+    clear_stage_dir()
+    PROGRESS.fail(key, error.detail if isinstance(error, HTTPException) else error)
+
+@router.post("/upload", dependencies=[Depends(get_current_user(USER_ROLE))])
+def upload(
+    file: UploadFile = File(...),
+    total_size: int = Form(...),
+):
+    key, pipeline = start_bundle_upload(file.filename, total_size)
+    chunk_size = 1024 * 1024  # 1MB
+    try:
+        while chunk := file.file.read(chunk_size):
+            pipeline.feed(chunk)
+    except Exception as e:
+        fail_bundle_upload(key, pipeline, e)
+        raise
+    return finish_bundle_upload(key, file.filename, pipeline)
+
+@router.post("/upload/stream", dependencies=[Depends(get_current_user(USER_ROLE))])
+async def upload_stream(
+    request: Request,
+    filename: str = Query(...),
+    total_size: int = Query(...),
+):
     """
-    Return upload and decryption progress + estimate for the given filename.
-    Assumes decryption speed is 30 MB/s.
+    Upload the bundle as the raw request body. It is decrypted and validated while it
+    arrives, so it is ready to install as soon as the last byte lands.
     """
-    total_size = FILE_SIZE_TOTALS.get(filename)
-    bytes_written = DISK_WRITE_PROGRESS.get(filename, 0)
-    upload_version = BUNDLE_VERSIONS.get(filename, None)
-    decrypt_start = DECRYPT_START_TIME.get(filename)
+    key, pipeline = await run_in_threadpool(start_bundle_upload, filename, total_size)
+    chunk_size = 1024 * 1024  # Hand the pipeline 1MB at a time, not every small body chunk
+    buffer = bytearray()
+    try:
+        async for chunk in request.stream():
+            buffer += chunk
+            if len(buffer) >= chunk_size:
+                await run_in_threadpool(pipeline.feed, bytes(buffer))
+                buffer.clear()
+        if buffer:
+            await run_in_threadpool(pipeline.feed, bytes(buffer))
+    except HTTPException as e:
+        fail_bundle_upload(key, pipeline, e)
+        raise
+    except Exception as e:
+        # Client went away mid-upload
+        fail_bundle_upload(key, pipeline, HTTPException(status_code=400, detail=f"Upload interrupted: {e}"))
+        raise
+    return await run_in_threadpool(finish_bundle_upload, key, filename, pipeline)
 
-    if not total_size:
+@router.get("/upload/progress", dependencies=[Depends(get_current_user(USER_ROLE))])
+def upload_progress(filename: str):
+    """
+    Return upload progress for the given filename.
+    Decryption and validation run while the upload arrives, so they finish with it.
+    """
+    snapshot = PROGRESS.get(upload_progress_key(filename))
+    if snapshot is None:
         raise HTTPException(status_code=404, detail="No upload info found for this filename")
 
-    # Upload progress percentage (0-100)
-    disk_write_percent = int((bytes_written / total_size) * 100)
-
-    # Decryption time estimate in minutes
-    decryption_speed_bps = 20 * 1024 * 1024  # 20 MB/s in bytes
-    estimated_decrypt_secs = total_size / decryption_speed_bps
-
-    decrypt_elapsed_secs = 0
-    decrypt_remaining_secs = estimated_decrypt_secs
-
-    if decrypt_start:
-        decrypt_elapsed_secs = time.time() - decrypt_start
-        decrypt_remaining_secs = max(0, estimated_decrypt_secs - decrypt_elapsed_secs)
+    receiving = snapshot["phase"] == "receiving"
+    disk_write_percent = (snapshot["percent"] or 0) if receiving else 100
 
-    if upload_version is not None:
-        background_tasks.add_task(delayed_cleanup, filename, 3)
+    # Live rate once measured, the device's calibrated decrypt rate before that
+    eta_secs = snapshot["eta_secs"]
+    if receiving and eta_secs is None and snapshot["total"]:
+        eta_secs = THROUGHPUT.eta("decrypt", snapshot["total"] - snapshot["done"])
 
     return {
+        "phase": snapshot["phase"],
+        "status": snapshot["status"],
+        "error": snapshot["error"],
         "disk_write_percent": disk_write_percent,
-        "upload_version": upload_version,
-        "decryption_elapsed_secs": round(decrypt_elapsed_secs, 1),
-        "decryption_remaining_secs": round(decrypt_remaining_secs, 1),
-        "estimated_decrypt_minutes": round(estimated_decrypt_secs / 60, 2),
+        "disk_write_rate_bps": snapshot["rate_bps"] if receiving else None,
+        "disk_write_eta_secs": eta_secs if receiving else None,
+        "upload_version": snapshot["version"],
+        "decryption_elapsed_secs": snapshot["elapsed_secs"],
+        "decryption_remaining_secs": (eta_secs or 0) if receiving else 0,
+        "estimated_decrypt_minutes": round((eta_secs or 0) / 60, 2) if receiving else 0,
+        "decrypt_rate_bps": THROUGHPUT.rate("decrypt"),
     }
 
-@router.post("/update", dependencies=[Depends(get_current_user(USER_ROLE))])
-def update():
-    tarballs = sorted([
-        f for f in STAGE_DIR.glob("*.tar.gz")
-        if "backup" not in f.name
-    ])
-
-    if not tarballs:
-        raise HTTPException(status_code=404, detail="No update bundle found.")
-
-    clear_current_dir()
-    bundle = tarballs[0]
-    bundle_size_bytes = bundle.stat().st_size
-
-    UPDATE_PROGRESS.clear()
-    UPDATE_PROGRESS.update({
-        "status": "extracting",
-        "percent": 0,
-        "log": "",
-        "time_start": time.time(),
-        "file_size": bundle_size_bytes
-    })
-
-    # Extract update
-    try:
-        with tarfile.open(bundle) as tar:
-            tar.extractall(path=CURRENT_DIR)
-    except Exception as e:
-        UPDATE_PROGRESS.update({
-            "status": "error",
-            "percent": 0,
-            "log": f"Extraction failed: {e}",
-        })
-        raise HTTPException(status_code=500, detail="Failed to extract update bundle")
-    
-    UPDATE_PROGRESS.update({
-        "status": "running",
-        "percent": 0,
-        "log": "",
-    })
-
-    script = f"""
-    docker ps -a --format '{{{{.ID}}}} {{{{.Names}}}}' \
-        | grep -v -w 'device_manager' \
-        | awk '{{print $1}}' \
-        | xargs -r docker rm -f && \
-    cd {CURRENT_DIR} && \
-    for img in images/*.tar.gz; do docker load -i "$img"; done && \
-    docker-compose up -d && \
-    docker system prune -af
+@router.get("/upload/progress/stream")
+def stream_upload_progress(filename: str, token: str = Query(...)):
+    """
+    Server-Sent Events stream of upload, decryption and validation progress.
+    Authenticated with a `token` query parameter since EventSource cannot send headers.
     """
+    get_current_user_manual(token, required_role=USER_ROLE)
+    return progress_event_stream(PROGRESS, upload_progress_key(filename))
 
-    if CURRENT_OVERRIDE_SCRIPT_PATH.exists():
-        os.chmod(CURRENT_OVERRIDE_SCRIPT_PATH, 0o777)
+@router.post("/update", dependencies=[Depends(get_current_user(USER_ROLE))])
+def update(image_workers: int = Query(IMAGE_LOAD_WORKERS, ge=1, le=MAX_IMAGE_LOAD_WORKERS)):
+    """
+    Start installing the staged bundle as a background job and return its id.
+    Up to `image_workers` images are loaded at once.
+    Follow it with /jobs/{job_id}, /jobs/{job_id}/stream or /update-progress.
+    """
+    job_id = UPDATE_JOBS.start(image_workers)
+    return {"detail": "Update started", "job_id": job_id}
 
-        # Override warning wrapper
-        script = f"""
-        echo "⚠️  WARNING: Override script detected — you are now in no-man's land." && \\
-        sleep 3 && \\
-        cd {CURRENT_DIR} && \\
-        ./override.sh
-        """
+@router.get("/slots", dependencies=[Depends(get_current_user(USER_ROLE))])
+def get_slots():
+    """The A/B slots and the version installed in each; CURRENT_DIR points at the active one."""
+    active = active_slot()
+    return {
+        "active": active,
+        "slots": [
+            {"slot": slot, "version": get_slot_version(slot), "active": slot == active}
+            for slot in SLOTS
+        ],
+    }
 
-        UPDATE_PROGRESS.update({
-            "log": "Update running in override mode.",
-        })
+@router.post("/verify", dependencies=[Depends(get_current_user(USER_ROLE))])
+def verify_install(slot: str = Query(None)):
+    """
+    Check the installed version (or the one in `slot`) against the SHA256SUMS its bundle carried,
+    hashing on all cores. Mismatched or missing files fail the check, unlisted ones are only reported.
+    """
+    if slot is None:
+        slot = active_slot()
+    elif slot not in SLOTS:
+        raise HTTPException(status_code=400, detail=f"Slot must be one of {', '.join(SLOTS)}")
+    job = UPDATE_JOBS.get()
+    if job and job["status"] in ("queued", "running"):
+        raise HTTPException(status_code=409, detail="An update is running, verify once it has finished")
+    try:
+        files = read_integrity_manifest(slot_dir(slot))
+    except IntegrityError as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    if files is None:
+        raise HTTPException(status_code=404, detail=f"Slot {slot} has no {INTEGRITY_MANIFEST} to verify against")
+    return {"slot": slot, "version": get_slot_version(slot), **verify_tree(slot_dir(slot), files)}
+
+@router.post("/rollback", dependencies=[Depends(get_current_user(USER_ROLE))])
+def rollback(image_workers: int = Query(IMAGE_LOAD_WORKERS, ge=1, le=MAX_IMAGE_LOAD_WORKERS)):
+    """
+    Switch back to the version in the inactive slot and restart it, as a job like /update.
+    Nothing is extracted again; its images are normally still present and only re-tagged.
+    """
+    job_id = UPDATE_JOBS.rollback(image_workers)
+    return {"detail": "Rollback started", "job_id": job_id}
+
+@router.get("/jobs/current", dependencies=[Depends(get_current_user(USER_ROLE))])
+def get_current_job():
+    job = UPDATE_JOBS.get()
+    if job is None:
+        raise HTTPException(status_code=404, detail="No update job found")
+    return job
+
+@router.get("/jobs/{job_id}", dependencies=[Depends(get_current_user(USER_ROLE))])
+def get_job(job_id: str):
+    job = UPDATE_JOBS.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Update job not found")
+    return job
+
+@router.post("/jobs/{job_id}/cancel", dependencies=[Depends(get_current_user(USER_ROLE))])
+def cancel_job(job_id: str):
+    UPDATE_JOBS.cancel(job_id)
+    return {"detail": f"Cancelling update {job_id}"}
+
+@router.get("/jobs/{job_id}/stream")
+def stream_job(job_id: str, token: str = Query(...)):
+    """
+    Server-Sent Events stream of the job's phase progress (bytes extracted, image bytes loaded).
+    """
+    get_current_user_manual(token, required_role=USER_ROLE)
+    return progress_event_stream(PROGRESS, UPDATE_JOBS.progress_key(job_id))
+
+@router.get("/backups", dependencies=[Depends(get_current_user(USER_ROLE))])
+def list_backups():
+    """Snapshots of previously installed versions, newest first, and how many are kept."""
+    return {"retain": BACKUPS.retain, "snapshots": BACKUPS.list()}
+
+@router.put("/backups/settings", dependencies=[Depends(get_current_user(USER_ROLE))])
+def set_backup_settings(retain: int = Query(..., ge=0, le=MAX_RETAIN)):
+    """Number of snapshots to keep, 0 turns the snapshot before each update off. Extra ones are removed."""
+    BACKUPS.set_retain(retain)
+    return {"retain": retain}
+
+@router.post("/backups", dependencies=[Depends(get_current_user(USER_ROLE))])
+def create_backup():
+    job = UPDATE_JOBS.get()
+    if job and job["status"] in ("queued", "running"):
+        raise HTTPException(status_code=409, detail="An update is running, wait for it to finish")
+    return BACKUPS.create()
+
+@router.delete("/backups/{name}", dependencies=[Depends(get_current_user(USER_ROLE))])
+def delete_backup(name: str):
+    BACKUPS.delete(name)
+    return {"detail": f"Snapshot {name} deleted"}
+
+@router.post("/backups/{name}/restore", dependencies=[Depends(get_current_user(USER_ROLE))])
+def restore_backup(name: str):
+    """
+    Restore a snapshot into the inactive slot, replacing what is there.
+    POST /rollback then switches to it.
+    """
+    job = UPDATE_JOBS.get()
+    if job and job["status"] in ("queued", "running"):
+        raise HTTPException(status_code=409, detail="An update is running, wait for it to finish")
+    BACKUPS.path(name)
+    slot = inactive_slot()
+    clear_slot(slot)
+    BACKUPS.restore(name, slot_dir(slot))
+    return {"detail": f"Snapshot {name} restored to slot {slot}", "slot": slot, "version": get_slot_version(slot)}
+
+def get_job_log(job_id: str = None):
+    log = UPDATE_JOBS.log(job_id)
+    if log is None:
+        raise HTTPException(status_code=404, detail="Update job not found")
+    return log
+
+@router.get("/jobs/{job_id}/log", dependencies=[Depends(get_current_user(USER_ROLE))])
+def read_job_log(job_id: str, after: int = Query(-1, ge=-1), limit: int = Query(None, ge=1)):
+    """
+    Log lines after offset `after`. Pass the returned `offset` as `after` next time to get only
+    new lines; `dropped` counts lines that were no longer kept.
+    """
+    return get_job_log(job_id).read(after, limit)
 
+@router.get("/jobs/{job_id}/log/stream")
+def stream_job_log(job_id: str, request: Request, token: str = Query(...), after: int = Query(-1, ge=-1)):
+    """
+    Server-Sent Events stream of log lines after offset `after` until the job ends.
+    A reconnecting EventSource resumes after the Last-Event-ID it received.
+    """
+    get_current_user_manual(token, required_role=USER_ROLE)
+    last_event_id = request.headers.get("last-event-id", "")
+    if last_event_id.lstrip("-").isdigit():
+        after = int(last_event_id)
+    return log_event_stream(get_job_log(job_id), after)
 
-    data = b""
-    try:
-        with SSHClient() as ssh:
-            transport = ssh.client.get_transport()
-            channel = transport.open_session()
-            channel.set_combine_stderr(True)
-            channel.exec_command(script)
-
-            while True:
-                if channel.recv_ready():
-                    chunk = channel.recv(1024)
-                    sys.stdout.buffer.write(chunk)
-                    sys.stdout.flush()
-                    data += chunk
-                    decoded = chunk.decode("utf-8", errors="replace")
-                    cleaned = clean_ansi_and_whitespace(decoded)
-                    UPDATE_PROGRESS["log"] += cleaned
-
-                    # Optional: naive progress estimation
-                    UPDATE_PROGRESS["percent"] = min(100, UPDATE_PROGRESS["percent"] + 1)
-
-                if channel.exit_status_ready():
-                    break
-
-            exit_code = channel.recv_exit_status()
+@router.get("/update-progress", dependencies=[Depends(get_current_user(USER_ROLE))])
+def get_update_progress(after: int = Query(None, ge=-1)):
+    """
+    State of the current job. With `after`, `log` only holds the lines after that offset;
+    pass the returned `log_offset` as `after` on the next poll.
+    """
+    job = UPDATE_JOBS.get()
+    if job is None:
+        return {}
+    log = UPDATE_JOBS.log(job["id"]).read(-1 if after is None else after)
+
+    # "extracting" / "running" / final status, as reported before updates became jobs
+    status = job["status"]
+    if status in ("queued", "running"):
+        status = "extracting" if (job["phase"] or job["phases"][0]) == "extract" else "running"
+    return {
+        "status": status,
+        "percent": job["percent"],
+        "log": "".join(f"{line}\n" for line in log["lines"]),
+        "log_offset": log["offset"],
+        "job_id": job["id"],
+        "phase": job["phase"],
+        "images_loaded": job["images_loaded"],
+        "images_total": job["images_total"],
+        "eta_secs": job["eta_secs"],
+        "phase_eta_secs": job["phase_eta_secs"],
+        "error": job["error"],
+    }
 
-    except Exception as e:
-        UPDATE_PROGRESS.update({
-            "status": "error",
-            "percent": UPDATE_PROGRESS.get("percent", 0),
-            "log": UPDATE_PROGRESS["log"] + f"\nAccess error: {e}",
-        })
-        clear_stage_dir()
-        clear_current_dir()
-        raise HTTPException(status_code=500, detail="Access or command execution failed")
-
-    if exit_code != 0:
-        UPDATE_PROGRESS.update({
-            "status": "error",
-            "percent": 100,
-            "log": UPDATE_PROGRESS["log"] + f"\nScript failed with exit code {exit_code}",
-        })
-        clear_stage_dir()
-        clear_current_dir()
-        raise HTTPException(status_code=500, detail="Script failed")
-
-    UPDATE_PROGRESS.update({
-        "status": "complete",
-        "percent": 100,
-    })
+@router.get("/throughput", dependencies=[Depends(get_current_user(USER_ROLE))])
+def get_throughput_profile():
+    """Measured per-phase throughput of this device, used for update ETAs."""
+    return THROUGHPUT.snapshot()
 
-    clear_stage_dir()
-    return {"detail": "Update complete"}
+@router.post("/throughput/calibrate", dependencies=[Depends(get_current_user(USER_ROLE))])
+def calibrate_throughput():
+    """
+    Run a short decrypt and extract benchmark (a few seconds at most) and record it in the profile,
+    so the first update on a device already gets a realistic ETA.
+    """
+    job = UPDATE_JOBS.get()
+    if job and job["status"] in ("queued", "running"):
+        raise HTTPException(status_code=409, detail="An update is running, calibrate once it has finished")
+    return run_benchmark()
 
-@router.get("/update-progress", dependencies=[Depends(get_current_user(USER_ROLE))])
-def get_update_progress():
-    if UPDATE_PROGRESS.get("status", "unknown") == "extracting":
-        extraction_speed_mbps = 20
-        extraction_speed_bps = extraction_speed_mbps * 1024 * 1024
-        elapsed = time.time() - UPDATE_PROGRESS["time_start"]
-        file_size_bytes = UPDATE_PROGRESS["file_size"]
-        total_expected_time = file_size_bytes / extraction_speed_bps
-        approx_percent_complete = (elapsed / total_expected_time) * 100
-        if approx_percent_complete > 100:
-            approx_percent_complete = "Unknown"
-        return {
-            "status": "extracting",
-            "percent": round(approx_percent_complete),
-            "log": ""
-        }
-        
-    return UPDATE_PROGRESS
+@router.post("/throughput/formats", dependencies=[Depends(get_current_user(USER_ROLE))])
+def benchmark_bundle_formats():
+    """
+    Time decompression plus extraction of the same sample bundle in every supported format
+    (plain and BGZF gzip, single and multi-frame zstd, xz) on this device, to pick a bundle format.
+    """
+    job = UPDATE_JOBS.get()
+    if job and job["status"] in ("queued", "running"):
+        raise HTTPException(status_code=409, detail="An update is running, benchmark once it has finished")
+    return run_format_benchmark()
@@ -0,0 +1,327 @@
+# update_delta.py
+import os
+import sys
+import json
+import shutil
+import hashlib
+import tarfile
+from pathlib import Path
+import zstandard as zstd
+from helpers import STAGE_DIR, logger
+
+DELTA_MANIFEST = "delta.json"  # Marks a bundle as a delta against an installed version
+DELTA_FORMAT = 1
+DELTA_DIR = Path(f"{STAGE_DIR}/delta")  # Extracted delta bundle
+HASH_BLOCK_BYTES = 1024 * 1024
+PATCH_LEVEL = 19
+PATCH_MAX_BYTES = 256 * 1024 * 1024  # Larger files are shipped whole, patches hold both versions in memory
+IMAGE_COMPRESS_LEVEL = 1  # Rebuilt image tarballs are only read once, by `docker load`
+
+# A delta bundle carries `.version`, `delta.json` and:
+#   files/<path>        files that are new or changed too much to patch
+#   patches/<path>      zstd patches against the installed file (`zstd --patch-from`)
+#   images/<name>       `docker save` tarballs without the layers the installed image already has
+# delta.json lists the complete resulting tree, so anything not listed is dropped:
+#   {"format": 1, "base_version": "1.0.0", "version": "1.1.0",
+#    "dirs": ["cmount", ...], "links": {"<path>": "<target>"},
+#    "files": {"<path>": {"source": "base" | "added" | "patch", "sha256": "...", "base_sha256": "...", "mode": 420}},
+#    "images": {"images/<name>": {"base": "images/<name>", "reused": {"<layer member>": "<sha256>"}}}}
+
+class DeltaError(Exception):
+    pass
+
+def file_sha256(path, check_cancel=None):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while block := f.read(HASH_BLOCK_BYTES):
+            if check_cancel:
+                check_cancel()
+            digest.update(block)
+    return digest.hexdigest()
+
+def safe_delta_path(root: Path, relpath: str) -> Path:
+    path = (root / relpath).resolve()
+    if path == root.resolve() or root.resolve() not in path.parents:
+        raise DeltaError(f"Path escapes the bundle: {relpath}")
+    return path
+
+def read_delta_manifest(path):
+    with open(path, "r") as f:
+        return parse_delta_manifest(f.read())
+
+def parse_delta_manifest(text):
+    try:
+        manifest = json.loads(text)
+    except ValueError as e:
+        raise DeltaError(f"Invalid {DELTA_MANIFEST}: {e}")
+    if not isinstance(manifest, dict) or manifest.get("format") != DELTA_FORMAT:
+        raise DeltaError(f"Unsupported {DELTA_MANIFEST} format")
+    for field in ("base_version", "version", "files"):
+        if field not in manifest:
+            raise DeltaError(f"{DELTA_MANIFEST} is missing '{field}'")
+    manifest.setdefault("dirs", [])
+    manifest.setdefault("links", {})
+    manifest.setdefault("images", {})
+    return manifest
+
+# === Binary patches ===
+def _patch_window_log(size):
+    # The window has to reach back over the whole old file for it to act as a dictionary
+    return max(zstd.WINDOWLOG_MIN, min(zstd.WINDOWLOG_MAX, (max(size, 1) - 1).bit_length() + 1))
+
+def make_patch(base: bytes, new: bytes) -> bytes:
+    window_log = _patch_window_log(max(len(base), len(new)))
+    params = zstd.ZstdCompressionParameters.from_level(
+        PATCH_LEVEL, window_log=window_log, enable_ldm=True, write_content_size=True,
+    )
+    dictionary = zstd.ZstdCompressionDict(base, dict_type=zstd.DICT_TYPE_RAWCONTENT)
+    return zstd.ZstdCompressor(dict_data=dictionary, compression_params=params).compress(new)
+
+def apply_patch(base: bytes, patch: bytes) -> bytes:
+    window_log = _patch_window_log(max(len(base), zstd.frame_content_size(patch)))
+    dictionary = zstd.ZstdCompressionDict(base, dict_type=zstd.DICT_TYPE_RAWCONTENT)
+    decompressor = zstd.ZstdDecompressor(dict_data=dictionary, max_window_size=1 << window_log)
+    return decompressor.decompress(patch)
+
+# === Images ===
+def _image_layers(tar):
+    """Layer members named by the manifest.json of an open `docker save` tarball."""
+    member = tar.getmember("manifest.json")
+    manifest = json.load(tar.extractfile(member))
+    return {layer for entry in manifest for layer in entry["Layers"]}
+
+def rebuild_image(partial: Path, base: Path, out: Path, reused: dict, check_cancel=None):
+    """
+    Write a complete `docker save` tarball to `out`: every member of `partial` plus the layers it
+    left out, copied from the installed tarball `base` and checked against their sha256 in `reused`.
+    """
+    with tarfile.open(partial, "r:*") as tar:
+        present = set(tar.getnames())
+        missing = _image_layers(tar) - present
+    unknown = missing - set(reused)
+    if unknown:
+        raise DeltaError(f"{partial.name}: no digest for reused layer(s) {', '.join(sorted(unknown))}")
+    # Classic layout keeps a layer's json/VERSION next to its layer.tar
+    layer_dirs = {os.path.dirname(layer) for layer in missing if not layer.startswith("blobs/")}
+
+    with tarfile.open(out, "w:gz", compresslevel=IMAGE_COMPRESS_LEVEL) as dest:
+        with tarfile.open(partial, "r|*") as tar:
+            for member in tar:
+                dest.addfile(member, tar.extractfile(member) if member.isfile() else None)
+        with tarfile.open(base, "r|*") as tar:
+            for member in tar:
+                if check_cancel:
+                    check_cancel()
+                if member.name in present:
+                    continue
+                if member.name in missing:
+                    source = _HashingReader(tar.extractfile(member))
+                    dest.addfile(member, source)
+                    if source.hexdigest() != reused[member.name]:
+                        raise DeltaError(f"{partial.name}: reused layer {member.name} does not match its digest")
+                    missing.discard(member.name)
+                elif member.name in layer_dirs or os.path.dirname(member.name) in layer_dirs:
+                    dest.addfile(member, tar.extractfile(member) if member.isfile() else None)
+    if missing:
+        raise DeltaError(f"{partial.name}: layer(s) {', '.join(sorted(missing))} not found in {base.name}")
+
+class _HashingReader:
+    def __init__(self, f):
+        self.f = f
+        self.digest = hashlib.sha256()
+
+    def read(self, n=-1):
+        data = self.f.read(n)
+        self.digest.update(data)
+        return data
+
+    def hexdigest(self):
+        return self.digest.hexdigest()
+
+# === Applying ===
+def _link_or_copy(source: Path, dest: Path):
+    try:
+        os.link(source, dest)
+    except OSError:
+        shutil.copy2(source, dest)
+
+def _carry_over(relpath: str, source: Path, dest: Path):
+    # Image tarballs are never written to, so both slots can share them.
+    # Anything else is copied: services may rewrite files in place and must not change the other slot.
+    if relpath.startswith("images/"):
+        _link_or_copy(source, dest)
+    else:
+        shutil.copy2(source, dest)
+
+def apply_delta(manifest: dict, bundle_dir: Path, base_dir: Path, work_dir: Path, check_cancel=None, log=logger.info):
+    """
+    Build the tree described by `manifest` in `work_dir` from the installed tree `base_dir` and the
+    extracted delta bundle `bundle_dir`, then verify every file against its sha256.
+    `base_dir` is only read; unchanged image tarballs are hard linked where possible.
+    """
+    check_cancel = check_cancel or (lambda: None)
+    if work_dir.exists():
+        shutil.rmtree(work_dir)
+    work_dir.mkdir(parents=True)
+    stats = {"base": 0, "added": 0, "patch": 0, "images": 0, "bytes": 0}
+
+    for relpath in manifest["dirs"]:
+        safe_delta_path(work_dir, relpath).mkdir(parents=True, exist_ok=True)
+
+    for relpath, entry in manifest["files"].items():
+        check_cancel()
+        dest = safe_delta_path(work_dir, relpath)
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        source = entry.get("source", "base")
+        if source == "base":
+            base = safe_delta_path(base_dir, relpath)
+            if not base.is_file():
+                raise DeltaError(f"{relpath} is missing from the installed version")
+            _carry_over(relpath, base, dest)
+        elif source == "added":
+            shutil.copy2(safe_delta_path(bundle_dir / "files", relpath), dest)
+        elif source == "patch":
+            base = safe_delta_path(base_dir, relpath)
+            if not base.is_file() or file_sha256(base, check_cancel) != entry.get("base_sha256"):
+                raise DeltaError(f"{relpath} differs from the version the patch was made against")
+            with open(base, "rb") as f:
+                old = f.read()
+            with open(safe_delta_path(bundle_dir / "patches", relpath), "rb") as f:
+                patch = f.read()
+            try:
+                new = apply_patch(old, patch)
+            except zstd.ZstdError as e:
+                raise DeltaError(f"Patching {relpath} failed: {e}")
+            with open(dest, "wb") as f:
+                f.write(new)
+            shutil.copymode(base, dest)
+        else:
+            raise DeltaError(f"{relpath}: unknown source '{source}'")
+        if "mode" in entry:
+            os.chmod(dest, entry["mode"])
+        stats[source] += 1
+
+    for relpath, target in manifest["links"].items():
+        dest = safe_delta_path(work_dir, relpath)
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        os.symlink(target, dest)
+
+    for relpath, spec in manifest["images"].items():
+        check_cancel()
+        dest = safe_delta_path(work_dir, relpath)
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        log(f"Rebuilding {relpath} from {spec['base']}")
+        rebuild_image(
+            safe_delta_path(bundle_dir, relpath), safe_delta_path(base_dir, spec["base"]),
+            dest, spec.get("reused", {}), check_cancel,
+        )
+        stats["images"] += 1
+
+    log(f"Verifying {len(manifest['files'])} file(s)")
+    for relpath, entry in manifest["files"].items():
+        path = work_dir / relpath
+        if file_sha256(path, check_cancel) != entry["sha256"]:
+            raise DeltaError(f"{relpath} does not match its sha256 after applying the delta")
+        stats["bytes"] += path.stat().st_size
+    return stats
+
+# === Building ===
+def _image_layer_digests(path: Path):
+    digests = {}
+    with tarfile.open(path, "r:*") as tar:
+        layers = _image_layers(tar)
+        for member in tar:
+            if member.name in layers:
+                reader = _HashingReader(tar.extractfile(member))
+                while reader.read(HASH_BLOCK_BYTES):
+                    pass
+                digests[member.name] = reader.hexdigest()
+    return digests
+
+def build_delta(base_dir: Path, new_dir: Path, out_dir: Path):
+    """
+    Write the delta bundle tree turning the bundle tree `base_dir` into `new_dir` to `out_dir`.
+    Pack it like a full bundle: `tar -czf bundle.tar.gz -C out_dir .` and encrypt.
+    """
+    base_version = (base_dir / ".version").read_text().strip()
+    version = (new_dir / ".version").read_text().strip()
+    manifest = {
+        "format": DELTA_FORMAT, "base_version": base_version, "version": version,
+        "dirs": [], "links": {}, "files": {}, "images": {},
+    }
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    for root, dirs, files in os.walk(new_dir):
+        root = Path(root)
+        for name in sorted(dirs):
+            path = root / name
+            if path.is_symlink():
+                manifest["links"][str(path.relative_to(new_dir))] = os.readlink(path)
+            else:
+                manifest["dirs"].append(str(path.relative_to(new_dir)))
+        for name in sorted(files):
+            path = root / name
+            relpath = str(path.relative_to(new_dir))
+            if path.is_symlink():
+                manifest["links"][relpath] = os.readlink(path)
+                continue
+            base = base_dir / relpath
+            sha256 = file_sha256(path)
+            entry = {"sha256": sha256, "mode": path.stat().st_mode & 0o7777}
+
+            if base.is_file() and file_sha256(base) == sha256:
+                entry["source"] = "base"
+            elif base.is_file() and relpath.startswith("images/") and relpath.endswith(".tar.gz"):
+                if _write_partial_image(base, path, out_dir / relpath, manifest["images"], relpath):
+                    continue
+                entry["source"] = "added"
+            elif base.is_file() and max(base.stat().st_size, path.stat().st_size) <= PATCH_MAX_BYTES:
+                patch = make_patch(base.read_bytes(), path.read_bytes())
+                if len(patch) < path.stat().st_size:
+                    entry["source"] = "patch"
+                    entry["base_sha256"] = file_sha256(base)
+                    dest = out_dir / "patches" / relpath
+                    dest.parent.mkdir(parents=True, exist_ok=True)
+                    dest.write_bytes(patch)
+                else:
+                    entry["source"] = "added"
+            else:
+                entry["source"] = "added"
+
+            if entry["source"] == "added":
+                dest = out_dir / "files" / relpath
+                dest.parent.mkdir(parents=True, exist_ok=True)
+                shutil.copy2(path, dest)
+            manifest["files"][relpath] = entry
+
+    shutil.copy2(new_dir / ".version", out_dir / ".version")
+    with open(out_dir / DELTA_MANIFEST, "w") as f:
+        json.dump(manifest, f, indent=1)
+    return manifest
+
+def _write_partial_image(base: Path, new: Path, dest: Path, images: dict, relpath: str):
+    """Save `new` without the layers `base` has. False if nothing would be reused."""
+    base_layers = _image_layer_digests(base)
+    new_layers = _image_layer_digests(new)
+    reused = {name: digest for name, digest in new_layers.items() if base_layers.get(name) == digest}
+    if not reused:
+        return False
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    with tarfile.open(new, "r:*") as tar, tarfile.open(dest, "w:gz") as out:
+        layer_dirs = {os.path.dirname(name) for name in reused if not name.startswith("blobs/")}
+        for member in tar:
+            if member.name in reused or os.path.dirname(member.name) in layer_dirs or member.name in layer_dirs:
+                continue
+            out.addfile(member, tar.extractfile(member) if member.isfile() else None)
+    images[relpath] = {"base": relpath, "reused": reused}
+    return True
+
+if __name__ == "__main__":
+    if len(sys.argv) != 4:
+        print(f"Usage: {sys.argv[0]} <installed bundle dir> <new bundle dir> <output dir>")
+        sys.exit(1)
+    result = build_delta(Path(sys.argv[1]), Path(sys.argv[2]), Path(sys.argv[3]))
+    sources = [entry["source"] for entry in result["files"].values()]
+    print(f"{result['base_version']} -> {result['version']}: "
+          f"{sources.count('base')} unchanged, {sources.count('patch')} patched, "
+          f"{sources.count('added')} added, {len(result['images'])} image(s) sharing layers")
@@ -0,0 +1,741 @@
+# update_jobs.py
+import os
+import json
+import time
+import uuid
+import shutil
+import socket
+import tarfile
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import HTTPException
+from helpers import (
+    DEVICE_DIR, CURRENT_DIR, STAGE_DIR, CURRENT_OVERRIDE_SCRIPT_PATH, COMPOSE_COMMAND, SSHClient,
+    clear_stage_dir, clean_ansi_and_whitespace, slot_dir, active_slot, inactive_slot, switch_slot,
+    clear_slot, get_slot_version, logger
+)
+from progress import PROGRESS, LogBuffer
+from throughput import THROUGHPUT
+from backups import BACKUPS
+from update_delta import DELTA_MANIFEST, DELTA_DIR, DeltaError, read_delta_manifest, apply_delta
+from decompress import BUNDLE_EXTENSIONS, DecompressError, ParallelDecompressor, detect_compression
+from integrity import INTEGRITY_MANIFEST, IntegrityError, read_integrity_manifest, verify_tree
+
+UPDATE_JOB_FILE = Path(f"{DEVICE_DIR}/update_job.json")  # Outlives the API container
+JOB_SAVE_INTERVAL = 1.0  # Seconds between progress writes of the job file
+JOB_POLL_SECONDS = 0.5
+IMAGE_LOAD_WORKERS = 2  # Default number of concurrent `docker load`s
+MAX_IMAGE_LOAD_WORKERS = 8
+SLOT_IMAGES_FILE = ".image_tags"  # Image ID -> tags of the images a slot runs on, written once they are loaded
+
+UPDATE = "update"
+ROLLBACK = "rollback"
+
+QUEUED = "queued"
+RUNNING = "running"
+COMPLETE = "complete"
+ERROR = "error"
+CANCELLED = "cancelled"
+
+SNAPSHOT = "snapshot"
+EXTRACT = "extract"
+VERIFY = "verify"
+LOAD_IMAGES = "load_images"
+SWITCH = "switch"
+COMPOSE_UP = "compose_up"
+PRUNE = "prune"
+OVERRIDE = "override"
+PHASES = [SNAPSHOT, EXTRACT, VERIFY, LOAD_IMAGES, SWITCH, COMPOSE_UP, PRUNE]
+OVERRIDE_PHASES = [SNAPSHOT, EXTRACT, VERIFY, SWITCH, OVERRIDE]
+ROLLBACK_PHASES = [LOAD_IMAGES, SWITCH, COMPOSE_UP]
+PHASE_WEIGHTS = {SNAPSHOT: 5, EXTRACT: 25, VERIFY: 5, LOAD_IMAGES: 45, SWITCH: 0, COMPOSE_UP: 15, PRUNE: 5, OVERRIDE: 60}  # Share of the overall percent
+
+REMOVE_CONTAINERS_SCRIPT = """
+docker ps -a --format '{{.ID}} {{.Names}}' \\
+    | grep -v -w 'device_manager' \\
+    | awk '{print $1}' \\
+    | xargs -r docker rm -f
+"""
+
+# Image IDs in use by any container, the images the running compose project was created from
+USED_IMAGES_SCRIPT = """
+docker ps -aq | xargs -r docker inspect --format '{{.Image}}'
+"""
+
+class JobCancelled(Exception):
+    pass
+
+class CountingReader:
+    """File wrapper reporting how many (compressed) bytes have been consumed."""
+
+    def __init__(self, f, on_read):
+        self.f = f
+        self.on_read = on_read
+        self.consumed = 0
+
+    def read(self, n=-1):
+        data = self.f.read(n)
+        self.consumed += len(data)
+        self.on_read(self.consumed)
+        return data
+
+def read_image_manifest(path):
+    """
+    Return [(image_id, repo_tags)] from the manifest.json of a `docker save` tarball.
+    The manifest usually sits at the end, but gunzipping is far cheaper than `docker load`.
+    """
+    with tarfile.open(path, "r|*") as tar:
+        for member in tar:
+            if member.name.lstrip("./") == "manifest.json":
+                manifest = json.load(tar.extractfile(member))
+                break
+        else:
+            return []
+    images = []
+    for entry in manifest:
+        # "<hex>.json" in the classic layout, "blobs/sha256/<hex>" in the OCI one
+        digest = entry["Config"].rsplit("/", 1)[-1].removesuffix(".json")
+        images.append((f"sha256:{digest}", entry.get("RepoTags") or []))
+    return images
+
+class UpdateJobManager:
+    """
+    Runs one software update (or rollback) at a time as a background job.
+
+    An update is installed into the inactive A/B slot while the active one keeps running, then
+    CURRENT_DIR is switched over to it. The previous slot stays intact, so rolling back is another
+    switch. The job walks through explicit phases and records byte/image level progress and its log in
+    UPDATE_JOB_FILE, so the state can be read after an API restart and a job interrupted by one
+    (e.g. when compose recreates this container) is resumed at the phase it was in.
+    """
+
+    def __init__(self, state_file=UPDATE_JOB_FILE):
+        self.state_file = state_file
+        self._lock = threading.Lock()
+        self._cancel = threading.Event()
+        self._thread = None
+        self._saved = 0.0
+        self._phase_started = None
+        self._job = self._load()
+        self._log_buffer = self._load_log()
+
+    # === Persistence ===
+    def _load(self):
+        try:
+            with open(self.state_file, "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"Warning: could not read update job state: {e}")
+            return None
+
+    def _load_log(self):
+        log = self._job.pop("log", None) if self._job else None
+        if isinstance(log, dict):
+            buffer = LogBuffer.load(log)
+        else:
+            # A plain string in state written before the log had offsets
+            buffer = LogBuffer(lines=(log or "").splitlines())
+        if not self._job or self._job["status"] not in (QUEUED, RUNNING):
+            buffer.close()
+        return buffer
+
+    def _save(self, force=False):
+        # Call with lock held
+        now = time.time()
+        if not force and now - self._saved < JOB_SAVE_INTERVAL:
+            return
+        self._saved = now
+        tmp = self.state_file.with_suffix(".tmp")
+        with open(tmp, "w") as f:
+            json.dump({**self._job, "log": self._log_buffer.dump()}, f)
+        os.replace(tmp, self.state_file)
+
+    def _update(self, force=False, **fields):
+        with self._lock:
+            self._job.update(fields)
+            self._job["updated"] = time.time()
+            self._job["percent"] = self._percent()
+            self._save(force)
+
+    def _log(self, text, prefix=""):
+        """Append whole lines of output to the log."""
+        cleaned = clean_ansi_and_whitespace(text)
+        if cleaned:
+            self._log_buffer.append(f"{prefix}{line}" for line in cleaned.split("\n"))
+
+    # === Control ===
+    def start(self, image_workers=IMAGE_LOAD_WORKERS):
+        tarballs = sorted([
+            f for extension in BUNDLE_EXTENSIONS.values() for f in STAGE_DIR.glob(f"*{extension}")
+            if "backup" not in f.name
+        ])
+        if not tarballs:
+            raise HTTPException(status_code=404, detail="No update bundle found.")
+
+        delta = None
+        if (STAGE_DIR / DELTA_MANIFEST).exists():
+            manifest = read_delta_manifest(STAGE_DIR / DELTA_MANIFEST)
+            delta = {"base_version": manifest["base_version"], "version": manifest["version"]}
+
+        bundle = tarballs[0]
+        return self._new_job(
+            kind=UPDATE,
+            phases=list(PHASES),
+            bundle=str(bundle),
+            bundle_bytes=bundle.stat().st_size,
+            delta=delta,
+            image_workers=image_workers,
+        )
+
+    def rollback(self, image_workers=IMAGE_LOAD_WORKERS):
+        """Switch back to the version in the inactive slot."""
+        if get_slot_version(inactive_slot()) is None:
+            raise HTTPException(status_code=404, detail="No previous version to roll back to.")
+        return self._new_job(kind=ROLLBACK, phases=list(ROLLBACK_PHASES), image_workers=image_workers)
+
+    def _new_job(self, **fields):
+        with self._lock:
+            if self._job and self._job["status"] in (QUEUED, RUNNING):
+                raise HTTPException(status_code=409, detail=f"Update {self._job['id']} is already running")
+            now = time.time()
+            self._job = {
+                "id": uuid.uuid4().hex,
+                "kind": UPDATE,
+                "status": QUEUED,
+                "phase": None,
+                "phases": [],
+                "slot": inactive_slot(),  # Slot being installed or rolled back to
+                "previous_slot": active_slot(),
+                "switched": False,  # Whether CURRENT_DIR already points at `slot`
+                "bundle": None,
+                "bundle_bytes": 0,
+                "delta": None,
+                "snapshot": None,  # Snapshot of the version running before the update
+                "extracted_bytes": 0,
+                "verify_bytes": 0,
+                "verified_bytes": 0,
+                "verify": None,  # Result of checking the slot against the bundle's SHA256SUMS
+                "images_total": 0,
+                "images_loaded": 0,
+                "images_bytes_total": 0,
+                "images_bytes_loaded": 0,
+                "loaded": [],
+                "images_skipped": 0,
+                "image_tags": {},  # Image ID -> repo tags of everything the version runs on
+                "image_workers": IMAGE_LOAD_WORKERS,
+                "percent": 0,
+                "error": None,
+                "created": now,
+                "updated": now,
+                "finished": None,
+                "resumed": 0,
+            }
+            self._job.update(fields)
+            self._log_buffer.close()
+            self._log_buffer = LogBuffer()
+            self._save(force=True)
+            job_id = self._job["id"]
+        self._launch()
+        return job_id
+
+    def resume(self):
+        """Pick up a job that was running when the API stopped."""
+        with self._lock:
+            if not self._job or self._job["status"] not in (QUEUED, RUNNING):
+                return
+            self._job["resumed"] += 1
+            self._log_buffer.append([f"Resuming {self._job['kind']} at phase {self._job['phase'] or self._job['phases'][0]} after API restart"])
+            self._save(force=True)
+        logger.info(f"Resuming update job {self._job['id']}")
+        self._launch()
+
+    def cancel(self, job_id):
+        with self._lock:
+            if not self._job or self._job["id"] != job_id:
+                raise HTTPException(status_code=404, detail="Update job not found")
+            if self._job["status"] not in (QUEUED, RUNNING):
+                raise HTTPException(status_code=409, detail=f"Update job is already {self._job['status']}")
+        self._cancel.set()
+
+    def get(self, job_id=None):
+        with self._lock:
+            if not self._job or (job_id and self._job["id"] != job_id):
+                return None
+            job = dict(self._job)
+        job["log_offset"] = self._log_buffer.offset
+        job["phase_eta_secs"], job["eta_secs"] = self._estimate(job)
+        return job
+
+    def log(self, job_id=None):
+        """The LogBuffer of the job, None if it is not the current one."""
+        with self._lock:
+            if not self._job or (job_id and self._job["id"] != job_id):
+                return None
+            return self._log_buffer
+
+    def progress_key(self, job_id):
+        return f"updates:job:{job_id}"
+
+    def _launch(self):
+        self._cancel.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _check_cancel(self):
+        if self._cancel.is_set():
+            raise JobCancelled()
+
+    # === Progress ===
+    def _percent(self):
+        # Call with lock held
+        job = self._job
+        if job["status"] == COMPLETE:
+            return 100
+        total = sum(PHASE_WEIGHTS[p] for p in job["phases"])
+        done = 0.0
+        for phase in job["phases"]:
+            if phase == job["phase"]:
+                done += PHASE_WEIGHTS[phase] * self._phase_fraction(phase)
+                break
+            done += PHASE_WEIGHTS[phase]
+        else:
+            done = 0.0 if job["phase"] is None else total
+        return min(100, int(done / total * 100))
+
+    def _phase_fraction(self, phase):
+        job = self._job
+        if phase == EXTRACT and job["bundle_bytes"]:
+            return job["extracted_bytes"] / job["bundle_bytes"]
+        if phase == VERIFY and job["verify_bytes"]:
+            return job["verified_bytes"] / job["verify_bytes"]
+        if phase == LOAD_IMAGES and job["images_bytes_total"]:
+            return job["images_bytes_loaded"] / job["images_bytes_total"]
+        return 0.0
+
+    def _estimate(self, job):
+        """
+        (current phase, whole job) seconds left. The current phase uses its live smoothed rate
+        once one was measured; later phases come from the device's throughput profile.
+        """
+        if job["status"] not in (QUEUED, RUNNING):
+            return 0, 0
+        snapshot = PROGRESS.get(self.progress_key(job["id"]))
+        live_rate = snapshot["rate_bps"] if snapshot and snapshot["phase"] == job["phase"] else None
+        # Images are most of a bundle, so its size stands in until they are extracted
+        image_bytes = job["images_bytes_total"] or job["bundle_bytes"]
+
+        phases = job["phases"]
+        current = job["phase"] or phases[0]
+        phase_eta = None
+        total = 0
+        for phase in phases[phases.index(current):]:
+            if phase == EXTRACT:
+                eta = THROUGHPUT.eta(EXTRACT, job["bundle_bytes"] - job["extracted_bytes"], live_rate if phase == current else None)
+            elif phase == VERIFY:
+                # Unknown until the phase starts, the bundle size is a lower bound of what gets hashed
+                remaining = (job["verify_bytes"] or job["bundle_bytes"]) - (job["verified_bytes"] if phase == current else 0)
+                eta = THROUGHPUT.eta(VERIFY, remaining, live_rate if phase == current else None)
+            elif phase == SWITCH:
+                eta = 0
+            elif phase == LOAD_IMAGES:
+                remaining = image_bytes - (job["images_bytes_loaded"] if phase == current else 0)
+                eta = THROUGHPUT.eta(LOAD_IMAGES, remaining, live_rate if phase == current else None)
+            else:
+                eta = THROUGHPUT.duration(phase)
+                if eta is not None and phase == current and snapshot:
+                    eta = round(max(0, eta - snapshot["phase_elapsed_secs"]), 1)
+            if phase == current:
+                phase_eta = eta
+            total = None if eta is None or total is None else round(total + eta, 1)
+        return phase_eta, total
+
+    def _measure(self, phase, nbytes=None):
+        """Feed how long the phase that just finished took into the throughput profile."""
+        seconds = time.time() - self._phase_started
+        if nbytes is None:
+            THROUGHPUT.record_duration(phase, seconds)
+        else:
+            THROUGHPUT.record(phase, nbytes, seconds)
+
+    def _enter_phase(self, phase, total=None):
+        key = self.progress_key(self._job["id"])
+        if PROGRESS.get(key) is None:
+            PROGRESS.start(key, phase=phase, total=total)
+        else:
+            PROGRESS.phase(key, phase, total=total)
+        self._phase_started = time.time()
+        self._update(force=True, phase=phase)
+        self._log(f"=== {phase} ===")
+
+    # === Phases ===
+    def _run(self):
+        try:
+            self._run_phases()
+        finally:
+            self._log_buffer.close()
+
+    def _run_phases(self):
+        job_id = self._job["id"]
+        key = self.progress_key(job_id)
+        kind = self._job["kind"].capitalize()
+        try:
+            with self._lock:
+                self._job["status"] = RUNNING
+                phases = self._job["phases"]
+                resume_at = self._job["phase"] or phases[0]
+            for phase in phases[phases.index(resume_at):]:
+                self._check_cancel()
+                getattr(self, f"_phase_{phase}")()
+                if phase == VERIFY and (slot_dir(self._job["slot"]) / "override.sh").exists():
+                    # Run the bundle's own script instead of the standard phases
+                    self._update(force=True, phases=list(OVERRIDE_PHASES))
+                    self._phase_switch()
+                    self._phase_override()
+                    break
+        except JobCancelled:
+            self._log(f"{kind} cancelled")
+            self._try_undo()
+            self._update(force=True, status=CANCELLED, finished=time.time())
+            PROGRESS.fail(key, "cancelled")
+            return
+        except Exception as e:
+            self._log(f"{kind} failed: {e}")
+            self._try_undo()
+            self._update(force=True, status=ERROR, error=str(e), finished=time.time())
+            PROGRESS.fail(key, e)
+            if self._job["kind"] == UPDATE:
+                clear_stage_dir()
+            return
+
+        self._update(force=True, status=COMPLETE, finished=time.time())
+        PROGRESS.finish(key)
+        if self._job["kind"] == UPDATE:
+            clear_stage_dir()
+
+    def _try_undo(self):
+        # The job has to end either way, one left RUNNING blocks every later upload and update
+        try:
+            self._undo()
+        except Exception as e:
+            logger.warning(f"Warning: undoing {self._job['kind']} job {self._job['id']} failed: {e}")
+            self._log(f"Undo failed: {e}")
+
+    def _undo(self):
+        """
+        Leave the device on the version it ran before the job. Before the switch nothing but the
+        inactive slot was touched; after it CURRENT_DIR is switched back and that version restarted.
+        A failed prune is not undone, the new version is already up by then.
+        """
+        job = self._job
+        if not job["switched"]:
+            if job["kind"] == UPDATE:
+                clear_slot(job["slot"])
+            return
+        if job["phase"] == PRUNE:
+            return
+
+        previous = job["previous_slot"]
+        self._cancel.clear()
+        switch_slot(previous)
+        self._update(force=True, switched=False)
+        self._log(f"Switched back to slot {previous} ({get_slot_version(previous)})")
+        if get_slot_version(previous) is None:
+            return
+        try:
+            self._tag_images(self._slot_image_tags(previous) or {})
+            self._run_remote(REMOVE_CONTAINERS_SCRIPT, "Removing containers failed")
+            self._run_remote(f"cd {CURRENT_DIR} && {COMPOSE_COMMAND} up -d", "docker-compose up failed")
+        except Exception as e:
+            self._log(f"Restarting the previous version failed: {e}")
+
+    def _phase_snapshot(self):
+        """Snapshot the running version before anything changes. Unchanged files cost a hard link."""
+        self._enter_phase(SNAPSHOT)
+        previous = self._job["previous_slot"]
+        if BACKUPS.retain == 0:
+            self._log("Snapshots are turned off")
+            return
+        if get_slot_version(previous) is None:
+            self._log("Nothing installed to snapshot")
+            return
+        meta = BACKUPS.create(slot_dir(previous), check_cancel=self._check_cancel)
+        self._update(force=True, snapshot=meta["name"])
+        self._log(
+            f"Snapshot {meta['name']}: {meta['copied']} file(s) copied ({meta['copied_bytes']} bytes), "
+            f"{meta['linked']} unchanged file(s) linked"
+        )
+        self._measure(SNAPSHOT)
+
+    def _extract_bundle(self, dest):
+        key = self.progress_key(self._job["id"])
+
+        def on_read(consumed):
+            PROGRESS.update(key, done=consumed)
+            self._update(extracted_bytes=consumed)
+
+        try:
+            with open(self._job["bundle"], "rb") as f:
+                compression = detect_compression(f.read(6))
+                f.seek(0)
+                # Decompression runs ahead on other cores while this thread writes the files
+                with ParallelDecompressor(CountingReader(f, on_read), compression) as source:
+                    with tarfile.open(fileobj=source, mode="r|") as tar:
+                        for member in tar:
+                            self._check_cancel()
+                            tar.extract(member, path=dest)
+                    parallel_bytes = source.parallel_bytes
+        except (OSError, tarfile.TarError, DecompressError) as e:
+            raise RuntimeError(f"Extraction failed: {e}")
+        self._log(
+            f"Decompressed {compression} bundle, {parallel_bytes} of {self._job['bundle_bytes']} bytes "
+            f"on {source.workers} worker(s)"
+        )
+
+    def _phase_extract(self):
+        """Install the bundle into the inactive slot, the running version is not touched."""
+        self._enter_phase(EXTRACT, total=self._job["bundle_bytes"])
+        self._update(extracted_bytes=0)
+        slot = self._job["slot"]
+        clear_slot(slot)
+        if self._job["delta"]:
+            self._apply_delta()
+        else:
+            self._extract_bundle(slot_dir(slot))
+        self._update(force=True, extracted_bytes=self._job["bundle_bytes"])
+        self._measure(EXTRACT, self._job["bundle_bytes"])
+
+    def _phase_verify(self):
+        """Check every file of the new slot against the bundle's SHA256SUMS before anything runs it."""
+        self._enter_phase(VERIFY)
+        slot = slot_dir(self._job["slot"])
+        try:
+            files = read_integrity_manifest(slot)
+        except IntegrityError as e:
+            raise RuntimeError(f"Integrity check failed: {e}")
+        if files is None:
+            self._log(f"Bundle has no {INTEGRITY_MANIFEST}, skipping integrity check")
+            return
+        key = self.progress_key(self._job["id"])
+
+        def on_progress(done, total):
+            PROGRESS.update(key, done=done, total=total)
+            self._update(verified_bytes=done, verify_bytes=total)
+
+        result = verify_tree(slot, files, check_cancel=self._check_cancel, on_progress=on_progress)
+        self._update(force=True, verify=result, verify_bytes=result["bytes"], verified_bytes=result["bytes"])
+        for kind in ("mismatched", "missing"):
+            for path in result[kind]:
+                self._log(f"{kind}: {path}")
+        counts = result["counts"]
+        if not result["ok"]:
+            raise RuntimeError(
+                f"Integrity check failed: {counts['mismatched']} file(s) do not match {INTEGRITY_MANIFEST}, "
+                f"{counts['missing']} missing"
+            )
+        self._log(
+            f"Verified {result['files']} file(s), {result['bytes']} bytes on {result['workers']} worker(s) "
+            f"in {result['secs']}s" + (f", {counts['unlisted']} unlisted" if counts["unlisted"] else "")
+        )
+        self._measure(VERIFY, result["bytes"])
+
+    def _apply_delta(self):
+        """Build the new version in the inactive slot from the delta and the active slot, verifying every file's hash."""
+        delta = self._job["delta"]
+        base = self._job["previous_slot"]
+        installed = get_slot_version(base)
+        if installed != delta["base_version"]:
+            raise RuntimeError(f"Delta applies to version {delta['base_version']}, installed is {installed}")
+        shutil.rmtree(DELTA_DIR, ignore_errors=True)
+        DELTA_DIR.mkdir(parents=True)
+        self._extract_bundle(DELTA_DIR)
+        self._log(f"Applying delta {delta['base_version']} -> {delta['version']}")
+        try:
+            stats = apply_delta(
+                read_delta_manifest(DELTA_DIR / DELTA_MANIFEST), DELTA_DIR, slot_dir(base), slot_dir(self._job["slot"]),
+                check_cancel=self._check_cancel, log=self._log,
+            )
+        except (OSError, tarfile.TarError, DeltaError) as e:
+            raise RuntimeError(f"Applying delta failed: {e}")
+        finally:
+            shutil.rmtree(DELTA_DIR, ignore_errors=True)
+        self._log(
+            f"{stats['base']} unchanged, {stats['patch']} patched, {stats['added']} added, "
+            f"{stats['images']} image(s) rebuilt; {stats['bytes']} bytes verified"
+        )
+
+    def _slot_image_tags(self, slot):
+        try:
+            with open(slot_dir(slot) / SLOT_IMAGES_FILE, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _phase_load_images(self):
+        """
+        Load the slot's images, `image_workers` at a time. An image whose ID is already known to
+        docker is only (re)tagged, so unchanged images cost a manifest read instead of a load.
+        """
+        slot = self._job["slot"]
+        images = sorted(slot_dir(slot).glob("images/*.tar.gz"))
+        sizes = {image.name: image.stat().st_size for image in images}
+        self._enter_phase(LOAD_IMAGES, total=sum(sizes.values()))
+        loaded = set(self._job["loaded"])  # Already loaded before a restart
+        self._update(
+            force=True,
+            images_total=len(images),
+            images_bytes_total=sum(sizes.values()),
+            images_loaded=len(loaded),
+            images_bytes_loaded=sum(sizes[name] for name in loaded if name in sizes),
+        )
+        key = self.progress_key(self._job["id"])
+        resumed_bytes = self._job["images_bytes_loaded"]
+
+        with SSHClient() as ssh:
+            stdout, stderr, code = ssh.run_command("docker image ls -q --no-trunc")
+        if code != 0:
+            raise RuntimeError(f"Listing docker images failed: {stderr.strip()}")
+        present = set(stdout.split())
+
+        recorded = self._slot_image_tags(slot)
+        if recorded is not None and set(recorded) <= present:
+            # Rolling back to a slot whose images were kept: tagging them again is all it takes
+            self._tag_images(recorded)
+            self._log(f"All {len(recorded)} image(s) of slot {slot} are present, nothing to load")
+            self._update(
+                force=True, image_tags=recorded, loaded=[image.name for image in images],
+                images_loaded=len(images), images_skipped=len(images), images_bytes_loaded=sum(sizes.values()),
+            )
+            return
+
+        def load(image):
+            self._check_cancel()
+            try:
+                manifest = read_image_manifest(image)
+            except (OSError, tarfile.TarError, ValueError, KeyError) as e:
+                # Let docker load it and report what is wrong with it
+                self._log(f"Could not read manifest: {e}", prefix=f"[{image.name}] ")
+                manifest = []
+            ids = [image_id for image_id, _ in manifest]
+            if manifest and all(image_id in present for image_id in ids):
+                tags = " && ".join(f"docker tag {image_id} {tag}" for image_id, tags in manifest for tag in tags)
+                if tags:
+                    self._run_remote(tags, f"Tagging {image.name} failed", prefix=f"[{image.name}] ")
+                self._log(f"{image.name} is already loaded, skipped", prefix=f"[{image.name}] ")
+                skipped = True
+            else:
+                self._run_remote(
+                    f'cd {slot_dir(slot)} && docker load -i "images/{image.name}"',
+                    f"Loading {image.name} failed",
+                    prefix=f"[{image.name}] ",
+                )
+                skipped = False
+            with self._lock:
+                self._job["loaded"].append(image.name)
+                self._job["image_tags"].update(dict(manifest))
+                self._job["images_loaded"] += 1
+                self._job["images_skipped"] += skipped
+                self._job["images_bytes_loaded"] += sizes[image.name]
+                done, count = self._job["images_bytes_loaded"], self._job["images_loaded"]
+            PROGRESS.update(key, done=done, images_loaded=count)
+            self._update(force=True)
+
+        pending = [image for image in images if image.name not in loaded]
+        workers = max(1, min(self._job.get("image_workers", IMAGE_LOAD_WORKERS), MAX_IMAGE_LOAD_WORKERS))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(load, image) for image in pending]
+            try:
+                for future in futures:
+                    future.result()
+            except BaseException:
+                # Stop the loads still running and skip the ones not started
+                self._cancel.set()
+                for future in futures:
+                    future.cancel()
+                raise
+        with open(slot_dir(slot) / SLOT_IMAGES_FILE, "w") as f:
+            json.dump(self._job["image_tags"], f)
+        self._measure(LOAD_IMAGES, self._job["images_bytes_loaded"] - resumed_bytes)
+
+    def _tag_images(self, image_tags):
+        """Point the tags back at the given image IDs, the other slot may have moved them."""
+        tags = " && ".join(f"docker tag {image_id} {tag}" for image_id, tags in image_tags.items() for tag in tags)
+        if tags:
+            self._run_remote(tags, "Tagging images failed")
+
+    def _phase_switch(self):
+        self._enter_phase(SWITCH)
+        slot = self._job["slot"]
+        switch_slot(slot)
+        self._update(force=True, switched=True)
+        self._log(f"Switched to slot {slot} ({get_slot_version(slot)})")
+
+    def _phase_compose_up(self):
+        self._enter_phase(COMPOSE_UP)
+        self._run_remote(REMOVE_CONTAINERS_SCRIPT, "Removing old containers failed")
+        self._run_remote(f"cd {CURRENT_DIR} && {COMPOSE_COMMAND} up -d", "docker-compose up failed")
+        self._measure(COMPOSE_UP)
+
+    def _phase_prune(self):
+        """
+        Remove only images that neither a container nor the new bundle uses, instead of
+        `docker system prune -af`, so layers shared with the next update stay cached.
+        """
+        self._enter_phase(PRUNE)
+        with SSHClient() as ssh:
+            stdout, stderr, code = ssh.run_command("docker image ls -q --no-trunc")
+            if code != 0:
+                raise RuntimeError(f"Listing docker images failed: {stderr.strip()}")
+            present = set(stdout.split())
+            used, stderr, code = ssh.run_command(USED_IMAGES_SCRIPT)
+            if code != 0:
+                raise RuntimeError(f"Listing images in use failed: {stderr.strip()}")
+
+        # The previous slot's images stay too, so rolling back does not need a single load
+        keep = set(used.split()) | set(self._job["image_tags"]) | set(self._slot_image_tags(self._job["previous_slot"]) or {})
+        unused = sorted(present - keep)
+        self._log(f"Removing {len(unused)} unused image(s), keeping {len(present & keep)}")
+        if unused:
+            # Without -f, docker refuses to remove anything still needed and we carry on
+            self._run_remote(f"docker rmi {' '.join(unused)} || true", "Removing unused images failed")
+        self._run_remote("docker image prune -f", "Pruning dangling images failed")
+        self._measure(PRUNE)
+
+    def _phase_override(self):
+        self._enter_phase(OVERRIDE)
+        os.chmod(CURRENT_OVERRIDE_SCRIPT_PATH, 0o777)
+        self._log("⚠️  WARNING: Override script detected — you are now in no-man's land.")
+        self._run_remote(f"sleep 3 && cd {CURRENT_DIR} && ./override.sh", "Override script failed")
+
+    def _run_remote(self, command, failure, prefix=""):
+        """Run `command` on the host, streaming its output into the log. Cancelling closes the channel."""
+        tail = ""  # Partial output line, logged once complete
+        with SSHClient() as ssh:
+            channel = ssh.client.get_transport().open_session()
+            channel.set_combine_stderr(True)
+            channel.settimeout(JOB_POLL_SECONDS)
+            channel.exec_command(command)
+            try:
+                while True:
+                    self._check_cancel()
+                    try:
+                        chunk = channel.recv(65536)
+                    except socket.timeout:
+                        continue
+                    if not chunk:
+                        break
+                    lines, _, tail = (tail + chunk.decode("utf-8", errors="replace")).rpartition("\n")
+                    if lines:
+                        self._log(lines, prefix)
+                        self._update()
+                code = channel.recv_exit_status()
+            finally:
+                channel.close()
+        if tail:
+            self._log(tail, prefix)
+        if code != 0:
+            raise RuntimeError(f"{failure} with exit code {code}")
+
+UPDATE_JOBS = UpdateJobManager()
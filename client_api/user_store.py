@@ -0,0 +1,269 @@
+# user_store.py
+import os
+import json
+import time
+import uuid
+import sqlite3
+import hashlib
+import secrets
+import threading
+from pathlib import Path
+from fastapi import HTTPException
+from helpers import DEVICE_DIR, logger
+
+USERS_DB = Path(f"{DEVICE_DIR}/users.db")
+LEGACY_USERS_FILE = Path(f"{DEVICE_DIR}/users.json")  # Imported on first start, then renamed
+MIGRATED_SUFFIX = ".migrated"
+SCHEMA_VERSION = 1
+SESSION_SECS = 30 * 24 * 3600  # Refresh token lifetime, restarted by every refresh
+MAX_SESSIONS_PER_USER = 32  # Oldest sessions of a user are dropped beyond this
+STORE_SYNC_SECS = 1.0  # How often to look for commits by other processes (e.g. the sqlite3 CLI)
+USER_FIELDS = ("username", "password", "role", "token_version")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY,
+    password TEXT NOT NULL,
+    role TEXT NOT NULL,
+    token_version INTEGER NOT NULL DEFAULT 0,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sessions (
+    id TEXT PRIMARY KEY,
+    username TEXT NOT NULL REFERENCES users(username) ON DELETE CASCADE ON UPDATE CASCADE,
+    refresh_hash BLOB NOT NULL UNIQUE,
+    client TEXT,
+    created REAL NOT NULL,
+    last_used REAL NOT NULL,
+    expires REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sessions_username ON sessions(username);
+CREATE INDEX IF NOT EXISTS sessions_expires ON sessions(expires);
+"""
+
+def _refresh_hash(refresh_token: str) -> bytes:
+    return hashlib.sha256(refresh_token.encode()).digest()
+
+class UserStore:
+    """
+    Users, their sessions and refresh tokens in an SQLite database.
+
+    The database runs in WAL mode with a connection per thread, so any number of readers proceed
+    while one writer commits; writes are serialized behind a lock. The checks made on every request
+    (a user's token version, whether a session is still open) are answered from in-memory indexes
+    kept in step with every write here, and reloaded when another process commits to the file.
+    Revoking a session deletes it, so its access tokens fail the next check and its refresh token
+    no longer matches anything.
+    """
+
+    def __init__(self, path=USERS_DB, legacy_file=LEGACY_USERS_FILE, default_user=None):
+        self.path = path
+        self.legacy_file = legacy_file
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._versions = {}  # username -> token_version
+        self._sessions = {}  # session id -> (username, expires)
+        self._data_version = None
+        self._watch = None  # Connection that notices commits, see _sync
+        self._synced = 0.0
+        self._open(default_user)
+
+    # === Connections ===
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA foreign_keys = ON")
+            conn.execute("PRAGMA synchronous = NORMAL")  # Durable enough with WAL, far fewer fsyncs
+            self._local.conn = conn
+        return conn
+
+    def _write(self, sql, params=()):
+        # Call with lock held. Returns the rows of a RETURNING clause
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(sql, params).fetchall()
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return rows
+
+    def _open(self, default_user):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.executescript(SCHEMA)
+        self._watch = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+        conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        with self._lock:
+            if conn.execute("SELECT 1 FROM users LIMIT 1").fetchone() is None:
+                if self.legacy_file.exists():
+                    self._migrate()
+                elif default_user:
+                    user = default_user()
+                    self._write(
+                        "INSERT INTO users (username, password, role, token_version, created) VALUES (?, ?, ?, ?, ?)",
+                        (user["username"], user["password"], user["role"], user.get("token_version", 0), time.time()),
+                    )
+            self._load()
+
+    def _migrate(self):
+        # Call with lock held
+        with open(self.legacy_file, "r") as f:
+            users = json.load(f)
+        now = time.time()
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(
+                "INSERT OR REPLACE INTO users (username, password, role, token_version, created) VALUES (?, ?, ?, ?, ?)",
+                [(u["username"], u["password"], u["role"], u.get("token_version", 0), now) for u in users],
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        os.replace(self.legacy_file, self.legacy_file.with_name(self.legacy_file.name + MIGRATED_SUFFIX))
+        logger.info(f"Migrated {len(users)} user(s) from {self.legacy_file} to {self.path}")
+
+    # === In-memory indexes ===
+    def _load(self):
+        # Call with lock held
+        conn = self._conn()
+        self._versions = {row["username"]: row["token_version"] for row in conn.execute("SELECT username, token_version FROM users")}
+        self._sessions = {
+            row["id"]: (row["username"], row["expires"])
+            for row in conn.execute("SELECT id, username, expires FROM sessions WHERE expires > ?", (time.time(),))
+        }
+        self._data_version = self._watch.execute("PRAGMA data_version").fetchone()[0]
+
+    def _sync(self):
+        now = time.monotonic()
+        if now - self._synced < STORE_SYNC_SECS:
+            return
+        with self._lock:
+            self._synced = now
+            # Changes whenever any other connection committed, those of our threads included
+            if self._watch.execute("PRAGMA data_version").fetchone()[0] != self._data_version:
+                self._load()
+
+    def token_version(self, username: str):
+        """Version tokens of `username` must carry, None if there is no such user."""
+        self._sync()
+        return self._versions.get(username)
+
+    def session_user(self, session_id: str):
+        """User an open session belongs to, None once it is revoked or expired."""
+        self._sync()
+        username, expires = self._sessions.get(session_id, (None, 0))
+        return username if expires > time.time() else None
+
+    # === Users ===
+    def get(self, username: str):
+        row = self._conn().execute(
+            "SELECT username, password, role, token_version FROM users WHERE username = ?", (username,)
+        ).fetchone()
+        return dict(row) if row else None
+
+    def list(self):
+        rows = self._conn().execute("SELECT username, password, role, token_version FROM users ORDER BY rowid")
+        return [dict(row) for row in rows]
+
+    def create(self, user: dict):
+        with self._lock:
+            try:
+                self._write(
+                    "INSERT INTO users (username, password, role, token_version, created) VALUES (?, ?, ?, ?, ?)",
+                    (user["username"], user["password"], user["role"], user.get("token_version", 0), time.time()),
+                )
+            except sqlite3.IntegrityError:
+                raise HTTPException(status_code=400, detail="User already exists")
+            self._versions[user["username"]] = user.get("token_version", 0)
+
+    def update(self, username: str, **fields):
+        unknown = set(fields) - set(USER_FIELDS[1:])
+        if unknown:
+            raise ValueError(f"Unknown user field(s): {', '.join(sorted(unknown))}")
+        with self._lock:
+            assignments = ", ".join(f"{field} = ?" for field in fields)
+            if not self._write(f"UPDATE users SET {assignments} WHERE username = ? RETURNING 1", (*fields.values(), username)):
+                raise HTTPException(status_code=404, detail="User not found")
+            if "token_version" in fields:
+                self._versions[username] = fields["token_version"]
+
+    def delete(self, username: str):
+        with self._lock:
+            self._write("DELETE FROM users WHERE username = ?", (username,))  # Sessions go with it
+            self._versions.pop(username, None)
+            self._sessions = {sid: entry for sid, entry in self._sessions.items() if entry[0] != username}
+
+    # === Sessions ===
+    def create_session(self, username: str, client: str = None):
+        """Open a session, returns its id and refresh token. Only a hash of the token is stored."""
+        session_id = uuid.uuid4().hex
+        refresh_token = secrets.token_urlsafe(32)
+        now = time.time()
+        with self._lock:
+            self._write(
+                "INSERT INTO sessions (id, username, refresh_hash, client, created, last_used, expires) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (session_id, username, _refresh_hash(refresh_token), client, now, now, now + SESSION_SECS),
+            )
+            self._sessions[session_id] = (username, now + SESSION_SECS)
+            self._prune(username)
+        return session_id, refresh_token
+
+    def refresh_session(self, refresh_token: str):
+        """
+        Trade a refresh token for a new one (rotation: each works once) and extend its session.
+        Returns (session id, username, new refresh token).
+        """
+        new_token = secrets.token_urlsafe(32)
+        now = time.time()
+        with self._lock:
+            row = self._conn().execute(
+                "SELECT id, username FROM sessions WHERE refresh_hash = ? AND expires > ?",
+                (_refresh_hash(refresh_token), now),
+            ).fetchone()
+            if row is None:
+                raise HTTPException(status_code=401, detail="Invalid or expired refresh token")
+            self._write(
+                "UPDATE sessions SET refresh_hash = ?, last_used = ?, expires = ? WHERE id = ?",
+                (_refresh_hash(new_token), now, now + SESSION_SECS, row["id"]),
+            )
+            self._sessions[row["id"]] = (row["username"], now + SESSION_SECS)
+        return row["id"], row["username"], new_token
+
+    def list_sessions(self, username: str = None):
+        sql = "SELECT id, username, client, created, last_used, expires FROM sessions WHERE expires > ?"
+        params = [time.time()]
+        if username is not None:
+            sql += " AND username = ?"
+            params.append(username)
+        return [dict(row) for row in self._conn().execute(sql + " ORDER BY last_used DESC", params)]
+
+    def revoke_session(self, session_id: str):
+        with self._lock:
+            self._write("DELETE FROM sessions WHERE id = ?", (session_id,))
+            return self._sessions.pop(session_id, None) is not None
+
+    def revoke_sessions(self, username: str, keep: str = None):
+        """Close every session of `username` except `keep`, returns how many were closed."""
+        with self._lock:
+            closed = self._write("DELETE FROM sessions WHERE username = ? AND id IS NOT ? RETURNING id", (username, keep))
+            for row in closed:
+                self._sessions.pop(row["id"], None)
+            return len(closed)
+
+    def _prune(self, username):
+        # Call with lock held. Drops expired sessions and the oldest of `username` beyond the limit
+        dropped = self._write("DELETE FROM sessions WHERE expires <= ? RETURNING id", (time.time(),))
+        dropped += self._write(
+            "DELETE FROM sessions WHERE username = ? AND id NOT IN "
+            "(SELECT id FROM sessions WHERE username = ? ORDER BY last_used DESC LIMIT ?) RETURNING id",
+            (username, username, MAX_SESSIONS_PER_USER),
+        )
+        for row in dropped:
+            self._sessions.pop(row["id"], None)
@@ -1,14 +1,20 @@
 # network.py
 import jwt
-import json
+import time
 import bcrypt
+import hashlib
+import threading
 import subprocess
-from pathlib import Path
+from typing import Optional
+from collections import OrderedDict
 from pydantic import BaseModel
 from datetime import datetime, timedelta
 from fastapi.security import OAuth2PasswordBearer
-from fastapi import APIRouter, Form, HTTPException, Depends
-from helpers import ADMIN_ROLE
+from fastapi import APIRouter, Form, HTTPException, Depends, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from helpers import ADMIN_ROLE, logger
+from passwords import HASHER, LOGIN_THROTTLE, MIN_BCRYPT_ROUNDS, MAX_BCRYPT_ROUNDS
+from user_store import UserStore
 
 router = APIRouter(tags=["Users"])
 
@@ -21,48 +27,29 @@ def get_boot_time():
     return "0"
 
 # === Config ===
-USERS_FILE = Path("/etc/device.d/users.json")
 JWT_SECRET = get_boot_time()
 JWT_ALGORITHM = "HS256"
 JWT_EXPIRATION_MINUTES = 1440
 DEFAULT_USER = "admin"
 DEFAULT_PASS = "admin"
 DEFAULT_ROLE = ADMIN_ROLE
+TOKEN_CACHE_SIZE = 1024  # Verified tokens kept, far more than the sessions a device sees
+INTERNAL_USER = "internal_service"  # Subject of INTERNAL_TOKEN, not an account in USERS
 
 # === Models ===
 class Token(BaseModel):
     access_token: str
     token_type: str
     role: str
+    refresh_token: Optional[str] = None
 
 class User(BaseModel):
     username: str
     role: str
 
-# === File Helpers ===
-def init_users():
-    if not USERS_FILE.exists():
-        hashed = bcrypt.hashpw(DEFAULT_PASS.encode(), bcrypt.gensalt()).decode()
-        USERS_FILE.parent.mkdir(parents=True, exist_ok=True)
-        with open(USERS_FILE, "w") as f:
-            json.dump(
-                [{"username": DEFAULT_USER, "password": hashed, "role": DEFAULT_ROLE}],
-                f
-            )
-
-def load_users():
-    if not USERS_FILE.exists():
-        init_users()
-    with open(USERS_FILE, "r") as f:
-        return json.load(f)
-
-def save_users(users):
-    with open(USERS_FILE, "w") as f:
-        json.dump(users, f)
-
 # === Password / Auth Helpers ===
-def verify_password(plain_password: str, hashed_password: str):
-    return bcrypt.checkpw(plain_password.encode(), hashed_password.encode())
+async def verify_password(plain_password: str, hashed_password: str):
+    return await HASHER.check(plain_password, hashed_password)
 
 def create_access_token(data: dict, expires_delta: timedelta = None):
     to_encode = data.copy()
@@ -70,90 +57,178 @@ def create_access_token(data: dict, expires_delta: timedelta = None):
     to_encode.update({"exp": expire})
     return jwt.encode(to_encode, JWT_SECRET, algorithm=JWT_ALGORITHM)
 
-def authenticate_user(username: str, password: str):
-    users = load_users()
-    for u in users:
-        if u["username"] == username and verify_password(password, u["password"]):
-            return u
+async def authenticate_user(username: str, password: str):
+    user = USERS.get(username)
+    if user and await verify_password(password, user["password"]):
+        return user
     return None
 
-oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/users/login")
+def client_address(request: Request):
+    return request.client.host if request.client else "unknown"
 
-def get_current_user(required_role: str = None):
-    def dependency(token: str = Depends(oauth2_scheme)):
-        try:
-            payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-            username = payload.get("sub")
-            role = payload.get("role")
-            if not username or not role:
-                raise HTTPException(status_code=401, detail="Invalid token")
-        except jwt.ExpiredSignatureError:
-            raise HTTPException(status_code=401, detail="Token expired")
-        except jwt.PyJWTError:
-            raise HTTPException(status_code=401, detail="Invalid token")
-
-        if required_role and role != required_role:
-            # Allow admin to bypass lower-role restrictions
-            if role != "admin":
-                raise HTTPException(status_code=403, detail="Insufficient privileges")
-
-        return {"username": username, "role": role}
-    return dependency
+def issue_token(user: dict, session: str):
+    return create_access_token({"sub": user["username"], "role": user["role"], "ver": user.get("token_version", 0), "sid": session})
 
-def get_current_user_manual(token: str, required_role: str = None):
+async def rehash_password(username: str, password: str):
+    """Store the password again at the current work factor, now that it is known to be right."""
     try:
-        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-        username = payload.get("sub")
-        role = payload.get("role")
-
-        if not username or not role:
-            raise HTTPException(status_code=401, detail="Invalid authentication credentials")
-
-        # Role enforcement with admin override
-        if required_role and role != required_role:
-            if role != "admin":
-                raise HTTPException(status_code=403, detail="Insufficient privileges")
+        hashed = await HASHER.hash(password)
+    except HTTPException:
+        return  # Busy, the next login tries again
+    await run_in_threadpool(USERS.update, username, password=hashed)
+    logger.info(f"Rehashed the password of {username} with work factor {HASHER.rounds}")
 
-        return {"username": username, "role": role}
+oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/users/login")
 
+class TokenCache:
+    """
+    Claims of tokens whose signature has been verified, keyed by the token's sha256 and kept until
+    their `exp`, least recently used first out. Dashboards poll several endpoints every few seconds
+    with the same token, so a hit replaces the HMAC check and JSON parsing with a hash and a lookup.
+    Only the signature check is cached, revocation is checked on every request (see decode_token).
+    """
+
+    def __init__(self, size=TOKEN_CACHE_SIZE):
+        self.size = size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def decode(self, token: str):
+        key = hashlib.sha256(token.encode()).digest()
+        with self._lock:
+            payload = self._entries.get(key)
+            if payload is not None:
+                if payload["exp"] > time.time():
+                    self._entries.move_to_end(key)
+                    return payload
+                del self._entries[key]
+        # Expired tokens fall through to jwt.decode, which raises for them
+        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM], options={"require": ["exp"]})
+        with self._lock:
+            self._entries[key] = payload
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+        return payload
+
+def decode_token(token: str, required_role: str = None):
+    try:
+        payload = TOKEN_CACHE.decode(token)
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token expired")
     except jwt.PyJWTError:
         raise HTTPException(status_code=401, detail="Invalid token")
 
+    username = payload.get("sub")
+    role = payload.get("role")
+    if not username or not role:
+        raise HTTPException(status_code=401, detail="Invalid token")
+
+    # Tokens carry the user's version from when they were issued, changing the password or role
+    # (or deleting the user) bumps it and so revokes every token issued before. Only INTERNAL_TOKEN
+    # carries the "internal" claim, the subject alone could be spoofed by an account of that name
+    if not payload.get("internal") and payload.get("ver", 0) != USERS.token_version(username):
+        raise HTTPException(status_code=401, detail="Token revoked")
+
+    # And the session they were issued for, closed by logging out or revoking it
+    session = payload.get("sid")
+    if session is not None and USERS.session_user(session) != username:
+        raise HTTPException(status_code=401, detail="Session revoked")
+
+    if required_role and role != required_role:
+        # Allow admin to bypass lower-role restrictions
+        if role != ADMIN_ROLE:
+            raise HTTPException(status_code=403, detail="Insufficient privileges")
+
+    return {"username": username, "role": role, "session": session}
+
+def get_current_user(required_role: str = None):
+    def dependency(token: str = Depends(oauth2_scheme)):
+        return decode_token(token, required_role)
+    return dependency
+
+def get_current_user_manual(token: str, required_role: str = None):
+    return decode_token(token, required_role)
+
 # === Routes ===
 @router.post("/login", response_model=Token)
-def login(username: str = Form(...), password: str = Form(...)):
-    user = authenticate_user(username, password)
+async def login(request: Request, username: str = Form(...), password: str = Form(...)):
+    throttle_keys = (f"user:{username}", f"ip:{client_address(request)}")
+    LOGIN_THROTTLE.check(*throttle_keys)
+    try:
+        user = await authenticate_user(username, password)
+    except BaseException:
+        LOGIN_THROTTLE.release(*throttle_keys)
+        raise
     if not user:
+        LOGIN_THROTTLE.failed(*throttle_keys)
         raise HTTPException(status_code=401, detail="Invalid username or password")
-    token = create_access_token({"sub": user["username"], "role": user["role"]})
-    return {"access_token": token, "token_type": "bearer", "role": user["role"]}
+    LOGIN_THROTTLE.succeeded(*throttle_keys)
+    if HASHER.needs_rehash(user["password"]):
+        await rehash_password(username, password)
+    session, refresh_token = await run_in_threadpool(USERS.create_session, username, client_address(request))
+    return {"access_token": issue_token(user, session), "token_type": "bearer", "role": user["role"], "refresh_token": refresh_token}
+
+@router.post("/refresh", response_model=Token)
+def refresh(refresh_token: str = Form(...)):
+    """New access token for a session. The refresh token is rotated: the one sent stops working."""
+    session, username, refresh_token = USERS.refresh_session(refresh_token)
+    user = USERS.get(username)
+    if not user:
+        raise HTTPException(status_code=401, detail="Invalid or expired refresh token")
+    return {"access_token": issue_token(user, session), "token_type": "bearer", "role": user["role"], "refresh_token": refresh_token}
+
+@router.post("/logout")
+def logout(current_user=Depends(get_current_user())):
+    if current_user["session"]:
+        USERS.revoke_session(current_user["session"])
+    return {"status": "success"}
+
+@router.get("/sessions")
+def list_sessions(username: str = Query(None), current_user=Depends(get_current_user())):
+    """Open sessions of the caller, admins may ask for another user's (or, with no username, everyone's)."""
+    if current_user["role"] != ADMIN_ROLE:
+        if username not in (None, current_user["username"]):
+            raise HTTPException(status_code=403, detail="Cannot list sessions of other users")
+        username = current_user["username"]
+    sessions = USERS.list_sessions(username)
+    for s in sessions:
+        s["current"] = s["id"] == current_user["session"]
+    return sessions
+
+@router.delete("/sessions/{session_id}")
+def revoke_session(session_id: str, current_user=Depends(get_current_user())):
+    owner = USERS.session_user(session_id)
+    if owner is None:
+        raise HTTPException(status_code=404, detail="Session not found")
+    if owner != current_user["username"] and current_user["role"] != ADMIN_ROLE:
+        raise HTTPException(status_code=403, detail="Cannot revoke sessions of other users")
+    USERS.revoke_session(session_id)
+    return {"status": "success"}
 
 @router.get("/users", dependencies=[Depends(get_current_user(ADMIN_ROLE))])
 def list_users():
-    users = load_users()
-    return [{"username": u["username"], "role": u["role"]} for u in users]
+    return [{"username": u["username"], "role": u["role"]} for u in USERS.list()]
 
 @router.post("/users", dependencies=[Depends(get_current_user(ADMIN_ROLE))])
-def create_user(username: str = Form(...), password: str = Form(...), role: str = Form(...)):
-    users = load_users()
-    if any(u["username"] == username for u in users):
+async def create_user(username: str = Form(...), password: str = Form(...), role: str = Form(...)):
+    if username == INTERNAL_USER:
+        raise HTTPException(status_code=400, detail=f"{INTERNAL_USER} is reserved")
+    if USERS.get(username):
         raise HTTPException(status_code=400, detail="User already exists")
-    hashed = bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode()
-    users.append({"username": username, "password": hashed, "role": role})
-    save_users(users)
+    hashed = await HASHER.hash(password)
+    # Not starting at 0, so tokens of a deleted user with the same name stay revoked
+    user = {"username": username, "password": hashed, "role": role, "token_version": int(time.time())}
+    await run_in_threadpool(USERS.create, user)
     return {"status": "success"}
 
 @router.put("/users/{username}")
-def update_user(
+async def update_user(
     username: str,
     password: str = Form(None),
     role: str = Form(None),
     current_user=Depends(get_current_user())
 ):
-    users = load_users()
-    target = next((u for u in users if u["username"] == username), None)
+    target = USERS.get(username)
     if not target:
         raise HTTPException(status_code=404, detail="User not found")
 
@@ -161,9 +236,10 @@ def update_user(
     if current_user["username"] != username and current_user["role"] != ADMIN_ROLE:
         raise HTTPException(status_code=403, detail="Cannot modify other users")
 
+    changes = {}
     # Password update allowed for self or admins
     if password:
-        target["password"] = bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode()
+        changes["password"] = await HASHER.hash(password)
 
     # Role update only if admin
     if role:
@@ -175,24 +251,46 @@ def update_user(
             raise HTTPException(status_code=403, detail="Admin cannot self-update roll. Do so with another admin account.")
 
         # Otherwise, update role
-        target["role"] = role
-
-    save_users(users)
+        if role != target["role"]:
+            changes["role"] = role
+
+    if not changes:
+        return {"status": "success"}
+    # Revokes the tokens issued so far and signs out every session but the one making the change
+    changes["token_version"] = target.get("token_version", 0) + 1
+    own = username == current_user["username"]
+    await run_in_threadpool(USERS.update, username, **changes)
+    await run_in_threadpool(USERS.revoke_sessions, username, current_user["session"] if own else None)
+    if own:
+        return {"status": "success", "access_token": issue_token({**target, **changes}, current_user["session"])}
     return {"status": "success"}
 
 @router.delete("/users/{username}")
 def delete_user(username: str, current_user=Depends(get_current_user(ADMIN_ROLE))):
     if username == current_user["username"]:
         raise HTTPException(status_code=400, detail="Cannot delete yourself")
-    users = load_users()
-    users = [u for u in users if u["username"] != username]
-    save_users(users)
+    USERS.delete(username)
     return {"status": "success"}
 
+@router.get("/settings", dependencies=[Depends(get_current_user(ADMIN_ROLE))])
+def get_auth_settings():
+    return {"bcrypt_rounds": HASHER.rounds}
+
+@router.put("/settings", dependencies=[Depends(get_current_user(ADMIN_ROLE))])
+def set_auth_settings(bcrypt_rounds: int = Query(..., ge=MIN_BCRYPT_ROUNDS, le=MAX_BCRYPT_ROUNDS)):
+    """bcrypt work factor for new password hashes, existing ones are rehashed at their next login."""
+    HASHER.set_rounds(bcrypt_rounds)
+    return {"bcrypt_rounds": bcrypt_rounds}
+
 @router.get("/check_token")
 def check_token(_: str = Depends(get_current_user())):
     return True
 
-init_users()
+def default_admin():
+    hashed = bcrypt.hashpw(DEFAULT_PASS.encode(), bcrypt.gensalt(HASHER.rounds)).decode()
+    return {"username": DEFAULT_USER, "password": hashed, "role": DEFAULT_ROLE}
+
+USERS = UserStore(default_user=default_admin)  # Imports users.json or creates the default admin on first start
+TOKEN_CACHE = TokenCache()
 HUNDRED_YEARS_IN_DAYS = 36500
-INTERNAL_TOKEN = create_access_token({"sub": "internal_service", "role": ADMIN_ROLE}, expires_delta=timedelta(days=HUNDRED_YEARS_IN_DAYS))
+INTERNAL_TOKEN = create_access_token({"sub": INTERNAL_USER, "role": ADMIN_ROLE, "internal": True}, expires_delta=timedelta(days=HUNDRED_YEARS_IN_DAYS))
@@ -16,6 +16,7 @@ export default function LoginPage({ onLogin }) {
       const res = await axios.post(`${API_BASE}/users/login`, params);
       localStorage.setItem("token", res.data.access_token);
       localStorage.setItem("role", res.data.role);
+      localStorage.setItem("refresh_token", res.data.refresh_token);
       onLogin(res.data.access_token); // update App state
       navigate("/main");
     } catch (err) {
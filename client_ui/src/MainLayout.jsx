@@ -5,6 +5,8 @@ import Update from "./pages/Update";
 import Terminal from "./pages/Terminal";
 import Files from "./pages/Files";
 import Users from "./pages/Users";
+import axios from "axios";
+import { API_BASE } from "./common";
 import "./MainLayout.css";
 
 export default function MainLayout() {
@@ -13,7 +15,10 @@ export default function MainLayout() {
   const token = localStorage.getItem("token");
 
   const logout = () => {
+    // Close the session on the device too, its refresh token stops working
+    axios.post(`${API_BASE}/users/logout`, null, { headers: { Authorization: `Bearer ${token}` } }).catch(() => {});
     localStorage.removeItem("token");
+    localStorage.removeItem("refresh_token");
     localStorage.removeItem("role");
     navigate("/login");
   };
@@ -16,8 +16,23 @@ export const checkToken = () => {
   })
   .catch(err => {
     if (err.response && err.response.status === 401) {
-      localStorage.removeItem("token");
-      window.location.href = "/login";
+      refreshToken();
     }
   });
 };
+
+// Trade the refresh token for a new access token, back to the login page if the session is gone
+const refreshToken = () => {
+  const params = new URLSearchParams({ refresh_token: localStorage.getItem("refresh_token") || "" });
+  axios.post(`${API_BASE}/users/refresh`, params)
+  .then(res => {
+    localStorage.setItem("token", res.data.access_token);
+    localStorage.setItem("refresh_token", res.data.refresh_token);
+    window.location.reload(); // Pages read the token when they render
+  })
+  .catch(() => {
+    localStorage.removeItem("token");
+    localStorage.removeItem("refresh_token");
+    window.location.href = "/login";
+  });
+};
@@ -33,6 +33,21 @@ export default function Files() {
     fetchDirectory("/");
   }, []);
 
+  // Re-list when the current directory changes on the device, whoever changed it
+  useEffect(() => {
+    const token = localStorage.getItem("token");
+    const ws = new WebSocket(
+      `${API_BASE.replace("http", "ws")}/files/watch?token=${token}&path=${encodeURIComponent(currentPath)}`
+    );
+    ws.onmessage = (event) => {
+      const data = JSON.parse(event.data);
+      if (data.events || data.overflow) {
+        fetchDirectory(currentPath);
+      }
+    };
+    return () => ws.close();
+  }, [currentPath]);
+
   const formatSize = (bytes) => {
     if (bytes == null) return "-";
     if (bytes < 1024) return `${bytes} B`;
@@ -164,32 +179,29 @@ export default function Files() {
         setUploadProgress(0);
         setProcessingProgress(0);
 
-        const pollInterval = setInterval(async () => {
-            try {
-                const progressRes = await axios.get(
-                    `${API_BASE}/files/upload-progress`,
-                    {
-                        params: { upload_id: uploadId },
-                        headers: {
-                            ...AUTH_HEADER,
-                            "Content-Type": "multipart/form-data",
-                        },
-                    }
-                );
-                const progress = progressRes.data.progress || 0;
-                setProcessingProgress(progress);
-                if (progress >= 100) {
-                    clearInterval(pollInterval);
-                    fetchDirectory(currentPath);
-                    setUploadProgress(0);
-                    setProcessingProgress(0);
-                }
-            } catch (e) {
-                clearInterval(pollInterval);
+        // Server pushes processing progress as it changes
+        const progressSource = new EventSource(
+            `${API_BASE}/files/upload-progress/stream?upload_id=${encodeURIComponent(uploadId)}&token=${encodeURIComponent(localStorage.getItem("token"))}`
+        );
+        progressSource.addEventListener("progress", (e) => {
+            const data = JSON.parse(e.data);
+            const progress = data.status === "complete" ? 100 : (data.percent || 0);
+            setProcessingProgress(progress);
+            if (data.status !== "active") {
+                progressSource.close();
+                fetchDirectory(currentPath);
+                setUploadProgress(0);
                 setProcessingProgress(0);
-                console.error("Error polling processing progress:", e);
+                if (data.status === "error") {
+                    alert("Upload failed: " + data.error);
+                }
             }
-        }, 1000);
+        });
+        progressSource.onerror = (e) => {
+            progressSource.close();
+            setProcessingProgress(0);
+            console.error("Error streaming processing progress:", e);
+        };
 
         axios.post(
             `${API_BASE}/files/upload?path=${encodeURIComponent(currentPath)}&upload_id=${encodeURIComponent(uploadId)}`,
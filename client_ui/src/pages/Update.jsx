@@ -26,7 +26,8 @@ import {
   Download as DownloadIcon,
   Info as InfoIcon,
   CheckCircle as CheckIcon,
-  Schedule as ScheduleIcon
+  Schedule as ScheduleIcon,
+  Restore as RollbackIcon
 } from "@mui/icons-material";
 
 function formatTimestamp(date = new Date()) {
@@ -46,13 +47,15 @@ export default function Update() {
   const fitAddon = useRef(null);
   const terminalContainerRef = useRef(null);
   const logsRef = useRef([]);
-  const logOffsetRef = useRef(0);
+  const logOffsetRef = useRef(-1); // Offset of the last update log line written
   const [uploadSuccess, setUploadSuccess] = useState(false); // Indicates whether the upload has succeeded
   const [file, setFile] = useState(null); // Indicates that a file has been chosen to be staged for upload
   const [currentVersion, setCurrentVersion] = useState("Loading...")
   const [targetVersion, setTargetVersion] = useState("Loading...")
   const [uploading, setUploading] = useState(false); // Indicates that update button has been clicked
   const [updatePolling, setUpdatePolling] = useState(false); // For start update call
+  const [previousVersion, setPreviousVersion] = useState(null); // Version in the inactive slot, if any
+  const [rollingBack, setRollingBack] = useState(false); // The running job is a rollback
 
   const AUTH_HEADER = {
     Authorization: `Bearer ${localStorage.getItem("token")}`,
@@ -97,10 +100,7 @@ export default function Update() {
 
   const uploadFile = async () => {
     if (!file) return;
-    const formData = new FormData();
     const fileName = file.name;
-    formData.append("file", file);
-    formData.append("total_size", file.size);
 
     setUploadSuccess(false);
     setUploading(true);
@@ -137,7 +137,7 @@ export default function Update() {
               lastDiskWritePercent = disk_write_percent;
             }
           } else if (lastDiskWritePercent !== 100) {
-            writeLog("Disk write fully completed. Starting decryption...");
+            writeLog("Disk write fully completed. Verifying bundle...");
             lastDiskWritePercent = 100;
           }
 
@@ -179,10 +179,12 @@ export default function Update() {
         }
       }, 1000);
 
-      axios.post(`${API_BASE}/updates/upload`, formData, {
+      // Raw body so the device decrypts and validates the bundle while it arrives
+      axios.post(`${API_BASE}/updates/upload/stream`, file, {
+        params: { filename: fileName, total_size: file.size },
         headers: {
           ...AUTH_HEADER,
-          "Content-Type": "multipart/form-data",
+          "Content-Type": "application/octet-stream",
         },
         onUploadProgress: (progressEvent) => {
           const percent = Math.round((progressEvent.loaded * 100) / progressEvent.total);
@@ -212,7 +214,7 @@ export default function Update() {
 
   const startUpdate = async () => {
     writeLog("Starting update...");
-    logOffsetRef.current = 0;
+    logOffsetRef.current = -1;
     try {
       setUpdatePolling(true);
       await axios.post(`${API_BASE}/updates/update`, "", {
@@ -223,6 +225,30 @@ export default function Update() {
     }
   };
 
+  const fetchPreviousVersion = async () => {
+    try {
+      const res = await axios.get(`${API_BASE}/updates/slots`, { headers: AUTH_HEADER });
+      const inactive = res.data.slots.find((slot) => !slot.active);
+      setPreviousVersion(inactive ? inactive.version : null);
+    } catch (err) {
+      console.error("Failed to get slots:", err);
+    }
+  };
+
+  const startRollback = async () => {
+    writeLog(`Rolling back to ${previousVersion}...`);
+    logOffsetRef.current = -1;
+    try {
+      setRollingBack(true);
+      setUpdatePolling(true);
+      await axios.post(`${API_BASE}/updates/rollback`, "", {
+        headers: AUTH_HEADER,
+      });
+    } catch (err) {
+      console.error(err);
+    }
+  };
+
   // Poll update progress after starting update
   useEffect(() => {
     checkToken();
@@ -233,29 +259,35 @@ export default function Update() {
 
         const res = await axios.get(`${API_BASE}/updates/update-progress`, {
           headers: AUTH_HEADER,
+          params: { after: logOffsetRef.current },
         });
-        const { percent, log, status } = res.data;
+        const { percent, log, log_offset, status, eta_secs } = res.data;
 
         if (status === "extracting") {
-          writeLog(`Extracting bundle - approximately ${percent}% complete.`)
+          const eta = eta_secs != null ? `, about ${Math.round(eta_secs)}s left` : "";
+          writeLog(`Extracting bundle - approximately ${percent}% complete${eta}.`)
         }
 
-        if (log && typeof log === "string" && status === "running") {
-          const newLog = log.slice(logOffsetRef.current);
-          if (newLog) {
-            writeLog(newLog);
-            logOffsetRef.current = log.length;
-          }
+        // Only lines after the offset we sent are returned
+        if (log && typeof log === "string") {
+          writeLog(log);
+        }
+        if (log_offset != null) {
+          logOffsetRef.current = log_offset;
         }
-        if (status === "complete" || status === "error") {
-          const newLog = log.slice(logOffsetRef.current);
-          writeLog(newLog);
-          writeLog(`Update ${status}.`);
-          logOffsetRef.current = log.length;
+        if (status === "complete" || status === "error" || status === "cancelled") {
+          writeLog(`${rollingBack ? "Rollback" : "Update"} ${status}.`);
           clearInterval(interval);
           setUpdatePolling(false);
-          setCurrentVersion(targetVersion);
-          setTargetVersion(targetVersion);
+          if (rollingBack) {
+            setRollingBack(false);
+            const versionRes = await axios.get(`${API_BASE}/updates/version`, { headers: AUTH_HEADER });
+            setCurrentVersion(versionRes.data);
+          } else {
+            setCurrentVersion(targetVersion);
+            setTargetVersion(targetVersion);
+          }
+          fetchPreviousVersion();
         }
       } catch (err) {
         console.error(err);
@@ -293,6 +325,7 @@ export default function Update() {
     };
 
     init(); // Call the async setup function
+    fetchPreviousVersion();
 
     // Set up terminal
     const term = new Terminal({
@@ -397,7 +430,7 @@ export default function Update() {
                   Choose File
                   <input
                     type="file"
-                    accept=".tar.gz.enc"
+                    accept=".tar.gz.enc,.tar.zst.enc,.tar.xz.enc"
                     onChange={handleFileChange}
                     hidden
                   />
@@ -413,7 +446,7 @@ export default function Update() {
               </Box>
               {!file && (
                 <Typography variant="body2" color="text.secondary" sx={{ mt: 1, fontStyle: 'italic' }}>
-                  Select a .tar.gz.enc update package file
+                  Select a .tar.gz.enc, .tar.zst.enc or .tar.xz.enc update package file
                 </Typography>
               )}
             </Box>
@@ -469,7 +502,19 @@ export default function Update() {
                   }
                 }}
               >
-                {updatePolling ? 'Updating...' : 'Start Update'}
+                {updatePolling && !rollingBack ? 'Updating...' : 'Start Update'}
+              </Button>
+
+              <Button
+                variant="outlined"
+                size="large"
+                color="warning"
+                startIcon={<RollbackIcon />}
+                onClick={startRollback}
+                disabled={!previousVersion || updatePolling || uploading}
+                sx={{ minWidth: 140 }}
+              >
+                {rollingBack ? 'Rolling back...' : `Roll back${previousVersion ? ` to ${previousVersion}` : ''}`}
               </Button>
             </Box>
 
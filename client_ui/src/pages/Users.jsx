@@ -71,11 +71,16 @@ export default function Users() {
     e.preventDefault();
     setError(null);
     try {
-      await axios.put(
+      const res = await axios.put(
         `${API_BASE}/users/users/${encodeURIComponent(editUser.username)}`,
         new URLSearchParams(editForm),
         { headers: { ...AUTH_HEADER, "Content-Type": "application/x-www-form-urlencoded" } }
       );
+      // Changing your own password or role revokes your old token, the response carries a new one
+      if (res.data.access_token) {
+        localStorage.setItem("token", res.data.access_token);
+        AUTH_HEADER.Authorization = `Bearer ${res.data.access_token}`;
+      }
       fetchUsers();
       closeEditModal();
     } catch (error) {